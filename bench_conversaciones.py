@@ -0,0 +1,89 @@
+"""
+Benchmark de memoria y serialización del estado de conversaciones.
+
+Compara el diccionario libre que se usaba antes por remitente con la clase
+Conversacion (__slots__, estados enteros, timestamps epoch).
+
+Uso:
+    python bench_conversaciones.py [numero_de_conversaciones]
+"""
+import gc
+import logging
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from server import Conversacion, ESTADOS, SERVICIOS, TIMEZONE
+
+logging.getLogger('server').setLevel(logging.WARNING)
+
+def crear_dicts(n):
+    """Representación anterior: un dict por remitente con datetimes"""
+    servicios = list(SERVICIOS)
+    ahora = datetime.now(TIMEZONE)
+    datos = {}
+    for i in range(n):
+        datos[f"whatsapp:+52155{i:08d}"] = {
+            'estado': 'confirmando_cita',
+            'ultimo_mensaje': datetime.now(TIMEZONE),
+            'servicio': servicios[i % len(servicios)],
+            'nombre': f"Cliente {i}",
+            'telefono': f"442{i:07d}",
+            'fecha': ahora + timedelta(days=1, minutes=30 * (i % 20)),
+        }
+    return datos
+
+def crear_conversaciones(n):
+    """Representación actual: Conversacion con __slots__"""
+    servicios = list(SERVICIOS)
+    ahora = datetime.now(TIMEZONE)
+    datos = {}
+    for i in range(n):
+        conversacion = Conversacion(ESTADOS['confirmando_cita'])
+        conversacion.servicio = servicios[i % len(servicios)]
+        conversacion.nombre = f"Cliente {i}"
+        conversacion.telefono = f"442{i:07d}"
+        conversacion.fecha = ahora + timedelta(days=1, minutes=30 * (i % 20))
+        datos[f"whatsapp:+52155{i:08d}"] = conversacion
+    return datos
+
+def medir(constructor, n):
+    """Devuelve (bytes por conversación, segundos de construcción)"""
+    gc.collect()
+    tracemalloc.start()
+    inicio = time.perf_counter()
+    datos = constructor(n)
+    segundos = time.perf_counter() - inicio
+    actual, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del datos
+    return actual / n, segundos
+
+def medir_serializacion(n):
+    """Devuelve (bytes serializados promedio, µs por ida y vuelta)"""
+    conversaciones = list(crear_conversaciones(n).values())
+    inicio = time.perf_counter()
+    total = 0
+    for conversacion in conversaciones:
+        datos = conversacion.a_bytes()
+        total += len(datos)
+        Conversacion.desde_bytes(datos)
+    segundos = time.perf_counter() - inicio
+    return total / n, segundos / n * 1e6
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    print(f"Conversaciones: {n}")
+
+    por_dict, t_dict = medir(crear_dicts, n)
+    por_slots, t_slots = medir(crear_conversaciones, n)
+    print(f"dict:         {por_dict:8.0f} B/conversación  ({por_dict * n / 2**20:7.1f} MiB, {t_dict:.2f} s)")
+    print(f"Conversacion: {por_slots:8.0f} B/conversación  ({por_slots * n / 2**20:7.1f} MiB, {t_slots:.2f} s)")
+    print(f"Ahorro:       {100 * (1 - por_slots / por_dict):7.1f} %")
+
+    tamano, us = medir_serializacion(min(n, 100_000))
+    print(f"Serialización: {tamano:.0f} B promedio, {us:.2f} µs por ida y vuelta")
+
+if __name__ == "__main__":
+    main()
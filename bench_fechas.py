@@ -0,0 +1,116 @@
+"""
+Benchmark de velocidad y precisión de parsear_fecha / validar_fecha.
+
+Usa el corpus etiquetado corpus_fechas.jsonl (frases reales de clientes con la
+fecha que querían decir) con un "ahora" congelado, y reporta throughput,
+latencia p50/p99, qué proporción de entradas cae en el fallback de dateparser
+y la precisión por familia de patrones.
+
+Uso:
+    python bench_fechas.py [--corpus corpus_fechas.jsonl] [--repeticiones 200] [--fallos]
+"""
+import argparse
+import json
+import logging
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from server import TIMEZONE, parsear_fecha_detallado, validar_fecha
+
+logging.getLogger('server').setLevel(logging.ERROR)
+
+# Instante de referencia del corpus: miércoles 2 de abril de 2025, 11:00 en CDMX
+AHORA = TIMEZONE.localize(datetime(2025, 4, 2, 11, 0))
+
+def cargar_corpus(ruta):
+    """Lee el corpus (una frase etiquetada por línea)"""
+    with open(ruta, encoding='utf-8') as f:
+        casos = [json.loads(linea) for linea in f if linea.strip()]
+    for caso in casos:
+        caso['esperado'] = datetime.fromisoformat(caso['esperado']) if caso['esperado'] else None
+    return casos
+
+def percentil(valores, p):
+    """Percentil por rango más cercano de una lista ordenada"""
+    indice = max(0, min(len(valores) - 1, round(p / 100 * len(valores)) - 1))
+    return valores[indice]
+
+def medir_velocidad(casos, repeticiones):
+    """Devuelve (llamadas por segundo, latencias ordenadas en µs)"""
+    latencias = []
+    inicio_total = time.perf_counter()
+    for _ in range(repeticiones):
+        for caso in casos:
+            inicio = time.perf_counter_ns()
+            parsear_fecha_detallado(caso['texto'], AHORA)
+            latencias.append((time.perf_counter_ns() - inicio) / 1000)
+    total = time.perf_counter() - inicio_total
+    latencias.sort()
+    return len(latencias) / total, latencias
+
+def medir_precision(casos):
+    """Compara cada caso con su etiqueta; devuelve estadísticas por familia y los fallos"""
+    por_familia = defaultdict(Counter)
+    resolutores = Counter()
+    fallos = []
+    for caso in casos:
+        fecha, resolutor = parsear_fecha_detallado(caso['texto'], AHORA)
+        valida, _ = validar_fecha(fecha, AHORA)
+        resolutores[resolutor] += 1
+
+        esperado = caso['esperado']
+        acierto = (fecha is None and esperado is None) or (
+            fecha is not None and esperado is not None and
+            fecha.replace(second=0, microsecond=0) == esperado
+        )
+
+        estadisticas = por_familia[caso['familia']]
+        estadisticas['casos'] += 1
+        estadisticas['aciertos'] += acierto
+        estadisticas['validacion'] += valida == caso['valida']
+        estadisticas['fallback'] += resolutor == 'dateparser'
+
+        if not acierto or valida != caso['valida']:
+            fallos.append((caso, fecha, resolutor, valida))
+    return por_familia, resolutores, fallos
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--corpus', default='corpus_fechas.jsonl')
+    parser.add_argument('--repeticiones', type=int, default=200)
+    parser.add_argument('--fallos', action='store_true', help='lista los casos mal resueltos')
+    args = parser.parse_args()
+
+    casos = cargar_corpus(args.corpus)
+    por_familia, resolutores, fallos = medir_precision(casos)
+    por_segundo, latencias = medir_velocidad(casos, args.repeticiones)
+
+    print(f"Casos: {len(casos)}  (ahora congelado: {AHORA.isoformat()})")
+    print(f"Throughput: {por_segundo:,.0f} fechas/s")
+    print(f"Latencia: p50 {percentil(latencias, 50):.1f} µs  p99 {percentil(latencias, 99):.1f} µs  "
+          f"máx {latencias[-1]:.1f} µs")
+    print(f"Fallback a dateparser: {100 * resolutores['dateparser'] / len(casos):.1f} %")
+    print("Resuelto por: " + ", ".join(f"{r or 'error'}={n}" for r, n in resolutores.most_common()))
+    print()
+    print(f"{'familia':<15}{'casos':>6}{'fecha ok':>10}{'validación ok':>15}{'fallback':>10}")
+    totales = Counter()
+    for familia, estadisticas in sorted(por_familia.items()):
+        totales.update(estadisticas)
+        n = estadisticas['casos']
+        print(f"{familia:<15}{n:>6}{100 * estadisticas['aciertos'] / n:>9.0f}%"
+              f"{100 * estadisticas['validacion'] / n:>14.0f}%{100 * estadisticas['fallback'] / n:>9.0f}%")
+    n = totales['casos']
+    print(f"{'total':<15}{n:>6}{100 * totales['aciertos'] / n:>9.0f}%"
+          f"{100 * totales['validacion'] / n:>14.0f}%{100 * totales['fallback'] / n:>9.0f}%")
+
+    if args.fallos:
+        print()
+        for caso, fecha, resolutor, valida in fallos:
+            esperado = caso['esperado'].isoformat() if caso['esperado'] else None
+            obtenido = fecha.isoformat() if fecha else None
+            print(f"✗ {caso['texto']!r}: esperado {esperado} (válida={caso['valida']}), "
+                  f"obtenido {obtenido} (válida={valida}) vía {resolutor}")
+
+if __name__ == "__main__":
+    main()
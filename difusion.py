@@ -0,0 +1,234 @@
+"""
+Difusión masiva de mensajes (promociones, avisos de cierre) a los clientes.
+
+Lee los destinatarios en streaming de un archivo (uno por línea) o del historial
+de citas en Google Calendar, y los envía por Twilio con varios hilos a una tasa
+máxima. Cada envío queda anotado en un archivo de checkpoint, así que si el job
+se interrumpe basta con volver a lanzarlo con el mismo checkpoint para seguir
+donde se quedó. Los clientes dados de baja ('baja' / 'stop') se omiten siempre.
+
+Corre como proceso aparte, así que no afecta la latencia del webhook, y no importa
+server.py (ni su diario, hilos de log o ejecutores): solo usa mensajeria.py, las
+credenciales del entorno y, con --negocio, el <numero>.json de NEGOCIOS_DIR.
+Los números se normalizan a E.164 ('+52…'); el prefijo 'whatsapp:' solo se
+agrega al enviar.
+
+Uso:
+    python difusion.py --mensaje "Este sábado cerramos a las 2pm" --destinatarios clientes.txt
+    python difusion.py --mensaje-archivo promo.txt --historial 180 --negocio whatsapp:+5215512345678
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+
+from mensajeria import CubetaTokens, RegistroBajas, crear_cliente_twilio, enviar_mensaje, normalizar_numero
+
+logger = logging.getLogger('difusion')
+
+def configuracion_negocio(numero):
+    """
+    (número de origen, calendar_id) de la barbería: su archivo en NEGOCIOS_DIR si
+    se indicó --negocio, o las variables de entorno del negocio por defecto.
+    """
+    digitos = re.sub(r'\D', '', numero or '')
+    directorio = os.getenv("NEGOCIOS_DIR", "")
+    if digitos and directorio:
+        ruta = os.path.join(directorio, f"{digitos}.json")
+        try:
+            with open(ruta, encoding='utf-8') as f:
+                config = json.load(f)
+        except FileNotFoundError:
+            raise SystemExit(f"❌ El número {numero} no tiene configuración en {directorio}")
+        return config.get('numero', f"+{digitos}"), config.get('calendar_id')
+    return numero or os.getenv('TWILIO_PHONE_NUMBER'), os.getenv("GOOGLE_CALENDAR_ID")
+
+def servicio_calendar():
+    """Servicio de Google Calendar con la cuenta de servicio (GOOGLE_CREDENTIALS o credentials.json)"""
+    from google.oauth2 import service_account
+    from googleapiclient.discovery import build
+    
+    alcances = ['https://www.googleapis.com/auth/calendar.readonly']
+    cred_json = os.getenv("GOOGLE_CREDENTIALS")
+    if cred_json:
+        creds = service_account.Credentials.from_service_account_info(json.loads(cred_json), scopes=alcances)
+    else:
+        creds = service_account.Credentials.from_service_account_file('credentials.json', scopes=alcances)
+    return build('calendar', 'v3', credentials=creds, cache_discovery=False)
+
+def destinatarios_archivo(ruta):
+    """Destinatarios de un archivo de texto ('-' = entrada estándar)"""
+    archivo = sys.stdin if ruta == '-' else open(ruta, encoding='utf-8')
+    with archivo:
+        for linea in archivo:
+            numero = linea.strip()
+            if numero and not numero.startswith('#'):
+                yield numero
+
+def destinatarios_historial(dias, calendar_id):
+    """Remitentes guardados en las citas de Calendar de los últimos `dias` días (y las futuras)"""
+    try:
+        service = servicio_calendar()
+    except Exception as e:
+        raise SystemExit(f"❌ No se pudo obtener el servicio de Google Calendar: {e}")
+
+    ahora = datetime.now(timezone.utc)
+    token = None
+    while True:
+        # Un job por lotes puede permitirse los reintentos con backoff de la propia librería
+        eventos = service.events().list(
+            calendarId=calendar_id or 'primary',
+            timeMin=(ahora - timedelta(days=dias)).isoformat(),
+            singleEvents=True,
+            maxResults=2500,
+            pageToken=token,
+            fields='items(extendedProperties),nextPageToken'
+        ).execute(num_retries=5)
+        for evento in eventos.get('items', []):
+            remitente = evento.get('extendedProperties', {}).get('private', {}).get('remitente')
+            if remitente:
+                yield remitente
+        token = eventos.get('nextPageToken')
+        if not token:
+            break
+
+class Checkpoint:
+    """
+    Progreso de la difusión: una línea "ok<TAB>número" o "error<TAB>número" por envío.
+    Al reanudar se omiten los números con "ok"; los que fallaron se reintentan.
+    """
+
+    def __init__(self, ruta):
+        self.enviados = set()
+        try:
+            with open(ruta, encoding='utf-8') as f:
+                for linea in f:
+                    resultado, _, numero = linea.rstrip('\n').partition('\t')
+                    if resultado == 'ok':
+                        # Checkpoints anteriores pueden traer el número tal como venía en la lista
+                        self.enviados.add(normalizar_numero(numero) or numero)
+        except FileNotFoundError:
+            pass
+        self._archivo = open(ruta, 'a', encoding='utf-8', buffering=1)  # una línea por escritura
+        self._lock = threading.Lock()
+
+    def anotar(self, numero, exito):
+        with self._lock:
+            self._archivo.write(f"{'ok' if exito else 'error'}\t{numero}\n")
+
+    def cerrar(self):
+        self._archivo.close()
+
+def difundir(destinatarios, mensaje, checkpoint, tasa, hilos, enviar, bajas):
+    """
+    Envía `mensaje` con `enviar(numero, mensaje)` a cada destinatario nuevo respetando
+    la tasa y los opt-outs. Como mucho hay 2 × `hilos` envíos en vuelo, así que los
+    destinatarios se leen en streaming sin cargar la lista completa. Devuelve los
+    totales por resultado.
+    """
+    cubeta = CubetaTokens(tasa, capacidad=max(1.0, tasa))
+    en_vuelo = threading.BoundedSemaphore(2 * hilos)
+    totales = {'enviados': 0, 'errores': 0, 'omitidos': 0, 'bajas': 0, 'invalidos': 0}
+    lock = threading.Lock()
+    vistos = set()
+
+    def enviar_uno(numero):
+        try:
+            cubeta.esperar()
+            exito = enviar(numero, mensaje)
+            checkpoint.anotar(numero, exito)
+            with lock:
+                totales['enviados' if exito else 'errores'] += 1
+        finally:
+            en_vuelo.release()
+
+    inicio = time.monotonic()
+    with ThreadPoolExecutor(max_workers=hilos, thread_name_prefix='difusion') as ejecutor:
+        for destinatario in destinatarios:
+            numero = normalizar_numero(destinatario)
+            if numero is None:
+                logger.warning("⚠️ Destinatario inválido omitido: %r", destinatario)
+                totales['invalidos'] += 1
+                continue
+            if numero in vistos or numero in checkpoint.enviados:
+                totales['omitidos'] += 1
+                continue
+            vistos.add(numero)
+            if bajas.contiene(numero):
+                totales['bajas'] += 1
+                continue
+            en_vuelo.acquire()
+            ejecutor.submit(enviar_uno, numero)
+
+            if len(vistos) % 500 == 0:
+                logger.info("📣 %d destinatarios en cola (%.1f/s)", len(vistos), len(vistos) / (time.monotonic() - inicio))
+    return totales
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    texto = parser.add_mutually_exclusive_group(required=True)
+    texto.add_argument('--mensaje', help='texto a enviar')
+    texto.add_argument('--mensaje-archivo', help='archivo con el texto a enviar')
+    origen = parser.add_mutually_exclusive_group(required=True)
+    origen.add_argument('--destinatarios', help="archivo con un número por línea ('-' = stdin)")
+    origen.add_argument('--historial', type=int, metavar='DIAS',
+                        help='clientes con citas en los últimos DIAS días según Calendar')
+    parser.add_argument('--negocio', default='', help='número de la barbería que envía (multi-tenant)')
+    parser.add_argument('--checkpoint', default='difusion.ckpt', help='archivo de progreso para reanudar')
+    parser.add_argument('--tasa', type=float, default=10, help='mensajes por segundo')
+    parser.add_argument('--hilos', type=int, default=8, help='envíos concurrentes')
+    parser.add_argument('--simular', action='store_true', help='no envía nada, solo recorre la lista')
+    args = parser.parse_args()
+    if args.tasa <= 0 or args.hilos < 1:
+        parser.error("--tasa debe ser mayor que 0 y --hilos al menos 1")
+    
+    load_dotenv()
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(), format='%(asctime)s %(levelname)s %(message)s')
+
+    if args.mensaje_archivo:
+        with open(args.mensaje_archivo, encoding='utf-8') as f:
+            mensaje = f.read().strip()
+    else:
+        mensaje = args.mensaje
+
+    origen, calendar_id = configuracion_negocio(args.negocio)
+    if args.simular:
+        enviar = lambda numero, texto: True
+    else:
+        cliente = crear_cliente_twilio(os.getenv('TWILIO_ACCOUNT_SID'), os.getenv('TWILIO_AUTH_TOKEN'))
+        if cliente is None:
+            raise SystemExit("❌ Faltan TWILIO_ACCOUNT_SID / TWILIO_AUTH_TOKEN")
+        if not normalizar_numero(origen):
+            raise SystemExit("❌ No hay número de origen: usa --negocio o TWILIO_PHONE_NUMBER")
+        enviar = lambda numero, texto: enviar_mensaje(cliente, origen, numero, texto)
+    
+    if args.destinatarios:
+        destinatarios = destinatarios_archivo(args.destinatarios)
+    else:
+        destinatarios = destinatarios_historial(args.historial, calendar_id)
+
+    checkpoint = Checkpoint(args.checkpoint)
+    if checkpoint.enviados:
+        logger.info("↩️ Reanudando: %d destinatarios ya recibieron el mensaje", len(checkpoint.enviados))
+    try:
+        bajas = RegistroBajas(os.getenv("BAJAS_ARCHIVO", "bajas.txt"))
+        totales = difundir(destinatarios, mensaje, checkpoint, args.tasa, args.hilos, enviar, bajas)
+    finally:
+        checkpoint.cerrar()
+
+    print(f"Enviados: {totales['enviados']}  Errores: {totales['errores']}  "
+          f"Dados de baja: {totales['bajas']}  Omitidos (repetidos o ya enviados): {totales['omitidos']}  "
+          f"Inválidos: {totales['invalidos']}")
+    if totales['errores']:
+        print(f"Vuelve a ejecutar con --checkpoint {args.checkpoint} para reintentar los errores.")
+
+if __name__ == "__main__":
+    main()
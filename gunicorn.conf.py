@@ -0,0 +1,12 @@
+# Configuración de gunicorn (se carga sola desde el directorio de trabajo)
+
+def post_worker_init(worker):
+    import server
+    
+    # Cada worker recupera las conversaciones y toma su propia ranura del diario
+    server.iniciar_diario()
+    
+    # Un worker síncrono atiende una petición a la vez: juntar ráfagas solo añadiría espera
+    if type(worker).__name__ == 'SyncWorker' and server.coalescedor.ventana > 0:
+        server.logger.warning("⚠️ COALESCER_VENTANA_MS requiere workers con hilos (--threads); se desactiva en este worker")
+        server.coalescedor.ventana = 0
@@ -0,0 +1,150 @@
+"""
+Piezas de mensajería compartidas por el servidor y los scripts (difusion.py):
+normalización de números, opt-outs, límite de tasa y envío por Twilio.
+
+Importar este módulo no tiene efectos secundarios: no lee la configuración, no
+arranca hilos ni abre archivos hasta que se usa.
+"""
+import logging
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PREFIJO_WHATSAPP = 'whatsapp:'
+
+def normalizar_numero(numero):
+    """
+    Número en formato E.164 ('+5215512345678') a partir de lo que mande Twilio
+    ('whatsapp:+52…') o de una lista escrita a mano ('+52 1 55-1234-5678').
+    Devuelve None si no parece un número de teléfono.
+    """
+    numero = (numero or '').strip()
+    if numero.lower().startswith(PREFIJO_WHATSAPP):
+        numero = numero[len(PREFIJO_WHATSAPP):]
+    digitos = re.sub(r'[\s\-().]', '', numero).lstrip('+')
+    if not digitos.isdigit() or not 8 <= len(digitos) <= 15:
+        return None
+    return '+' + digitos
+
+def direccion_whatsapp(numero):
+    """Dirección de WhatsApp de Twilio para un número (el prefijo solo se pone al enviar)"""
+    normalizado = normalizar_numero(numero)
+    return PREFIJO_WHATSAPP + normalizado if normalizado else None
+
+class CubetaTokens:
+    """Cubeta de tokens thread-safe: `tasa` tokens por segundo con ráfagas de hasta `capacidad`"""
+
+    def __init__(self, tasa, capacidad=None):
+        if not tasa > 0:
+            raise ValueError(f"La tasa de la cubeta debe ser mayor que 0 (recibida: {tasa})")
+        self.tasa = tasa
+        self.capacidad = capacidad if capacidad is not None else max(1.0, tasa)
+        if not self.capacidad >= 1:
+            raise ValueError(f"La capacidad de la cubeta debe ser al menos 1 (recibida: {self.capacidad})")
+        self._tokens = self.capacidad
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _rellenar(self):
+        ahora = time.monotonic()
+        self._tokens = min(self.capacidad, self._tokens + (ahora - self._ultimo) * self.tasa)
+        self._ultimo = ahora
+
+    def tomar(self, n=1):
+        """Toma `n` tokens si los hay; devuelve si se pudo"""
+        with self._lock:
+            self._rellenar()
+            if self._tokens >= n:
+                self._tokens -= n
+                return True
+            return False
+
+    def esperar(self, n=1):
+        """Bloquea hasta poder tomar `n` tokens"""
+        if n > self.capacidad:
+            raise ValueError(f"No se pueden tomar {n} tokens de una cubeta de capacidad {self.capacidad}")
+        while True:
+            with self._lock:
+                self._rellenar()
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return
+                falta = (n - self._tokens) / self.tasa
+            time.sleep(falta)
+
+# Palabras con las que un cliente se da de baja de las difusiones
+PALABRAS_BAJA = {'baja', 'stop', 'alto', 'cancelar suscripcion', 'cancelar suscripción'}
+
+class RegistroBajas:
+    """
+    Opt-outs de difusiones. Se guardan en un archivo de solo-agregar (una línea por
+    número en E.164, escrita con O_APPEND) para que los workers y el job de difusión
+    lo compartan; cada proceso recarga su copia en memoria cuando el archivo cambia.
+    Los números se normalizan al leer y al consultar, así que 'whatsapp:+52…' y
+    '+52 …' son el mismo cliente (también en archivos escritos antes de normalizar).
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._lock = threading.Lock()
+        self._numeros = set()
+        self._leido = None  # (mtime_ns, tamaño) de la última lectura
+
+    def _recargar(self):
+        try:
+            info = os.stat(self.ruta)
+        except FileNotFoundError:
+            return
+        if self._leido == (info.st_mtime_ns, info.st_size):
+            return
+        with open(self.ruta, encoding='utf-8') as f:
+            self._numeros = {normalizar_numero(linea) for linea in f} - {None}
+        self._leido = (info.st_mtime_ns, info.st_size)
+
+    def contiene(self, numero):
+        numero = normalizar_numero(numero)
+        with self._lock:
+            self._recargar()
+            return numero in self._numeros
+
+    def agregar(self, numero):
+        normalizado = normalizar_numero(numero)
+        if normalizado is None:
+            logger.warning("⚠️ No se pudo dar de baja %r: no es un número válido", numero)
+            return
+        with self._lock:
+            self._recargar()
+            if normalizado in self._numeros:
+                return
+            with open(self.ruta, 'a', encoding='utf-8') as f:
+                f.write(normalizado + "\n")
+            self._numeros.add(normalizado)
+        logger.info("🚫 %s dado de baja de las difusiones", normalizado)
+
+def crear_cliente_twilio(account_sid, auth_token):
+    """Cliente de Twilio, o None si faltan credenciales"""
+    if not (account_sid and auth_token):
+        return None
+    from twilio.rest import Client
+    return Client(account_sid, auth_token)
+
+def enviar_mensaje(cliente, origen, destino, cuerpo):
+    """Envía un mensaje de WhatsApp de `origen` a `destino` (números con o sin prefijo)"""
+    direccion = direccion_whatsapp(destino)
+    if direccion is None:
+        logger.error("❌ Número de destino inválido: %r", destino)
+        return False
+
+    try:
+        cliente.messages.create(
+            body=cuerpo,
+            from_=direccion_whatsapp(origen) or origen,
+            to=direccion
+        )
+        return True
+    except Exception as e:
+        logger.error("Error al enviar mensaje a %s: %s", direccion, e)
+        return False
@@ -1,27 +1,153 @@
 import os
 from datetime import timedelta, datetime
-from flask import Flask, request, Response
+from flask import Flask, request, Response, stream_with_context
 from dotenv import load_dotenv
 import dateparser
 from twilio.twiml.messaging_response import MessagingResponse
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+import google_auth_httplib2
+import httplib2
 import pytz
 import logging
 from twilio.rest import Client
 import json
+import csv
+import io
 import re
+import enum
+import queue
+import struct
+import sys
+import threading
+import time
+import atexit
+import bisect
+import cProfile
+import hmac
+import itertools
+import contextvars
+import random
+import sqlite3
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from contextlib import contextmanager
+from collections import Counter, OrderedDict
 from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
 
-# Configuración de logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
+import mensajeria
+from mensajeria import PALABRAS_BAJA, CubetaTokens, RegistroBajas
 
 # Configuración inicial
 load_dotenv()
 app = Flask(__name__)
 
+# Configuración de logging
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMATO = os.getenv('LOG_FORMATO', 'json')  # 'json' o 'texto'
+LOG_COLA_MAX = int(os.getenv('LOG_COLA_MAX', '10000'))  # registros pendientes antes de descartar
+# Muestreo por evento, ej: "mensaje=1,calendar=0.2,parseo=0.05" (WARNING o más nunca se descarta)
+LOG_MUESTREO = os.getenv('LOG_MUESTREO', '')
+
+# Identificador de la petición en curso: une todas las líneas de log de un webhook
+request_id_actual = contextvars.ContextVar('request_id', default='-')
+
+class FormateadorJSON(logging.Formatter):
+    """Formatea cada registro como una línea JSON"""
+
+    def format(self, record):
+        datos = {
+            'ts': self.formatTime(record),
+            'nivel': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'mensaje': record.getMessage(),
+        }
+        evento = getattr(record, 'evento', None)
+        if evento:
+            datos['evento'] = evento
+        if record.exc_info:
+            datos['excepcion'] = self.formatException(record.exc_info)
+        return json.dumps(datos, ensure_ascii=False)
+
+class FiltroContexto(logging.Filter):
+    """Añade el request_id al registro y aplica el muestreo por evento"""
+
+    def __init__(self, muestreo):
+        super().__init__()
+        self.tasas = {}
+        for par in filter(None, (p.strip() for p in muestreo.split(','))):
+            evento, _, tasa = par.partition('=')
+            self.tasas[evento.strip()] = float(tasa)
+
+    def filter(self, record):
+        evento = getattr(record, 'evento', None)
+        if evento is not None and record.levelno < logging.WARNING:
+            tasa = self.tasas.get(evento)
+            if tasa is not None and random.random() >= tasa:
+                return False
+        record.request_id = request_id_actual.get()
+        return True
+
+class ColaLogs(QueueHandler):
+    """
+    QueueHandler que no bloquea en el hilo de la petición: solo interpola el mensaje
+    (el formato JSON y las excepciones se construyen en el hilo escritor) y, si la
+    cola está llena, el registro se descarta. Los descartes se cuentan, se exponen
+    en /metrics y se avisan con un WARNING en cuanto vuelve a haber sitio.
+    """
+    descartados = 0
+    _avisados = 0
+
+    def prepare(self, record):
+        # Interpolar aquí: los argumentos mutables podrían cambiar antes de que el escritor los lea
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            ColaLogs.descartados += 1
+            return
+        perdidos = ColaLogs.descartados - ColaLogs._avisados
+        if perdidos:
+            aviso = logging.makeLogRecord({
+                'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING', 'request_id': '-',
+                'msg': "⚠️ %d registros de log descartados por cola llena" % perdidos,
+            })
+            try:
+                self.queue.put_nowait(aviso)
+                ColaLogs._avisados += perdidos
+            except queue.Full:
+                pass
+
+def configurar_logging():
+    """Envía los logs a un hilo escritor en segundo plano a través de una cola"""
+    salida = logging.StreamHandler()
+    if LOG_FORMATO == 'json':
+        salida.setFormatter(FormateadorJSON())
+    else:
+        salida.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - [%(request_id)s] %(message)s'))
+    
+    cola = ColaLogs(queue.Queue(maxsize=LOG_COLA_MAX))
+    cola.addFilter(FiltroContexto(LOG_MUESTREO))
+    
+    raiz = logging.getLogger()
+    raiz.handlers[:] = [cola]
+    raiz.setLevel(LOG_LEVEL)
+    
+    escritor = QueueListener(cola.queue, salida, respect_handler_level=True)
+    escritor.start()
+    atexit.register(escritor.stop)
+    return escritor
+
+_escritor_logs = configurar_logging()
+logger = logging.getLogger(__name__)
+
 # Twilio client para enviar mensajes proactivos
 TWILIO_ACCOUNT_SID = os.getenv('TWILIO_ACCOUNT_SID')
 TWILIO_AUTH_TOKEN = os.getenv('TWILIO_AUTH_TOKEN')
@@ -30,17 +156,17 @@ TWILIO_PHONE_NUMBER = os.getenv('TWILIO_PHONE_NUMBER')
 # Registrar las variables de configuración (sin mostrar los valores completos por seguridad)
 def log_config_status():
     if TWILIO_ACCOUNT_SID:
-        logger.info(f"✓ TWILIO_ACCOUNT_SID configurado (comienza con: {TWILIO_ACCOUNT_SID[:5]}...)")
+        logger.info("✓ TWILIO_ACCOUNT_SID configurado (comienza con: %s...)", TWILIO_ACCOUNT_SID[:5])
     else:
         logger.warning("✗ TWILIO_ACCOUNT_SID no configurado")
 
     if TWILIO_AUTH_TOKEN:
-        logger.info(f"✓ TWILIO_AUTH_TOKEN configurado (comienza con: {TWILIO_AUTH_TOKEN[:5]}...)")
+        logger.info("✓ TWILIO_AUTH_TOKEN configurado")
     else:
         logger.warning("✗ TWILIO_AUTH_TOKEN no configurado")
 
     if TWILIO_PHONE_NUMBER:
-        logger.info(f"✓ TWILIO_PHONE_NUMBER configurado: {TWILIO_PHONE_NUMBER}")
+        logger.info("✓ TWILIO_PHONE_NUMBER configurado: %s", TWILIO_PHONE_NUMBER)
         # Verificar si el número de teléfono incluye el prefijo 'whatsapp:'
         if not TWILIO_PHONE_NUMBER.startswith('whatsapp:'):
             logger.warning("⚠️ TWILIO_PHONE_NUMBER no tiene el prefijo 'whatsapp:', podría causar problemas")
@@ -58,7 +184,7 @@ try:
     else:
         logger.warning("✗ No se pudo inicializar el cliente Twilio por falta de credenciales")
 except Exception as e:
-    logger.error(f"✗ Error al inicializar cliente Twilio: {e}", exc_info=True)
+    logger.error("✗ Error al inicializar cliente Twilio: %s", e, exc_info=True)
 
 # Constantes del negocio
 HORARIO = "de lunes a viernes de 10:00 a 20:00, sábado de 10:00 a 17:00"
@@ -71,8 +197,14 @@ HORA_CIERRE_SABADO = 17   # 5 pm (sábado)
 HORA_CIERRE = HORA_CIERRE_LUNES_VIERNES  # Default
 TIMEZONE = pytz.timezone('America/Mexico_City')  # Zona horaria de CDMX/Querétaro
 DURACION_DEFAULT = 30  # minutos
+UNIDAD_MINUTOS = 15  # las citas empiezan en múltiplos de 15 minutos
+DIAS_SUGERENCIA = 7  # días que se rankean cuando el día pedido está lleno
 TIEMPO_EXPIRACION = 30  # minutos para expirar una conversación inactiva
 
+# Twilio corta el webhook a los 15 s; pasado este plazo respondemos y seguimos en segundo plano
+WEBHOOK_PLAZO_SEGUNDOS = float(os.getenv("WEBHOOK_PLAZO_SEGUNDOS", "10"))
+WEBHOOK_MARGEN_SEGUNDOS = 0.5  # tiempo reservado para construir y enviar la respuesta
+
 # Tiempo para recordatorio: ahora 5 horas antes (modificado de 24 horas)
 RECORDATORIO_MINUTOS = 5 * 60  # 5 horas en minutos
 
@@ -111,20 +243,115 @@ MENSAJES = {
                     "Si necesitas reprogramar, responde 'reprogramar cita'."
 }
 
+class Estado(enum.IntEnum):
+    """Estados conversacionales (enteros: ocupan poco en memoria y al serializar)"""
+    inicio = 0
+    listando_servicios = 1
+    solicitando_nombre = 2
+    solicitando_telefono = 3
+    solicitando_fecha = 4
+    confirmando_cita = 5
+    solicitud_cancelacion = 6
+    solicitud_reprogramacion = 7
+
 # Estados conversacionales
-ESTADOS = {
-    'inicio': 'inicio',
-    'listando_servicios': 'listando_servicios',
-    'solicitando_nombre': 'solicitando_nombre',
-    'solicitando_telefono': 'solicitando_telefono',
-    'solicitando_fecha': 'solicitando_fecha',
-    'confirmando_cita': 'confirmando_cita',
-    'solicitud_cancelacion': 'solicitud_cancelacion',
-    'solicitud_reprogramacion': 'solicitud_reprogramacion'
-}
+ESTADOS = {estado.name: estado for estado in Estado}
+
+class Conversacion:
+    """
+    Estado de la conversación con un remitente.
+
+    Usa __slots__ y guarda los instantes como segundos epoch para que cientos de
+    miles de conversaciones quepan en un solo proceso. a_bytes/desde_bytes dan una
+    serialización binaria compacta para guardarla fuera del proceso.
+    """
+    __slots__ = ('estado', 'ultimo_mensaje', 'servicio', 'nombre', 'telefono',
+                 'evento_id', 'reprogramando', 'pendiente', '_fecha')
+
+    # versión, estado, banderas, ultimo_mensaje, fecha (0 = sin fecha)
+    _CABECERA = struct.Struct('<BBBqq')
+    _LONGITUD = struct.Struct('<H')
+    _VERSION = 1
+    _NULO = 0xFFFF
+
+    def __init__(self, estado=Estado.inicio, ultimo_mensaje=None):
+        self.estado = estado
+        self.ultimo_mensaje = int(time.time()) if ultimo_mensaje is None else ultimo_mensaje
+        self.servicio = None
+        self.nombre = None
+        self.telefono = None
+        self.evento_id = None
+        self.reprogramando = False
+        self.pendiente = 0  # token del trabajo diferido en curso (no se serializa)
+        self._fecha = 0
+
+    def tocar(self):
+        """Actualiza el timestamp del último mensaje"""
+        self.ultimo_mensaje = int(time.time())
+
+    @property
+    def fecha(self):
+        """Fecha de la cita como datetime con zona horaria (o None)"""
+        if not self._fecha:
+            return None
+        return datetime.fromtimestamp(self._fecha, negocio_actual().timezone)
+
+    @fecha.setter
+    def fecha(self, valor):
+        if valor is None:
+            self._fecha = 0
+            return
+        if valor.tzinfo is None:
+            valor = negocio_actual().timezone.localize(valor)
+        self._fecha = int(valor.timestamp())
+
+    def a_bytes(self):
+        """Serializa la conversación en formato binario compacto"""
+        partes = [self._CABECERA.pack(self._VERSION, self.estado, 1 if self.reprogramando else 0,
+                                      self.ultimo_mensaje, self._fecha)]
+        for valor in (self.servicio, self.nombre, self.telefono, self.evento_id):
+            if valor is None:
+                partes.append(self._LONGITUD.pack(self._NULO))
+            else:
+                codificado = valor.encode('utf-8')
+                if len(codificado) >= self._NULO:
+                    # Cortar en bytes sin partir un carácter multibyte a la mitad
+                    codificado = codificado[:self._NULO - 1].decode('utf-8', 'ignore').encode('utf-8')
+                partes.append(self._LONGITUD.pack(len(codificado)))
+                partes.append(codificado)
+        return b''.join(partes)
+
+    @classmethod
+    def desde_bytes(cls, datos):
+        """Reconstruye una conversación serializada con a_bytes"""
+        version, estado, banderas, ultimo_mensaje, fecha = cls._CABECERA.unpack_from(datos, 0)
+        if version != cls._VERSION:
+            raise ValueError(f"Versión de conversación no soportada: {version}")
+        
+        conversacion = cls(Estado(estado), ultimo_mensaje)
+        conversacion.reprogramando = bool(banderas & 1)
+        conversacion._fecha = fecha
+        
+        offset = cls._CABECERA.size
+        valores = []
+        for _ in range(4):
+            (longitud,) = cls._LONGITUD.unpack_from(datos, offset)
+            offset += cls._LONGITUD.size
+            if longitud == cls._NULO:
+                valores.append(None)
+            else:
+                valores.append(bytes(datos[offset:offset + longitud]).decode('utf-8'))
+                offset += longitud
+        
+        servicio, conversacion.nombre, conversacion.telefono, conversacion.evento_id = valores
+        # Los nombres de servicio se repiten en miles de conversaciones
+        conversacion.servicio = sys.intern(servicio) if servicio is not None else None
+        return conversacion
 
-# Estados de conversación (diccionario en memoria)
+# Estados de conversación (remitente -> Conversacion, en memoria)
 conversaciones = {}
+# Protege las conversaciones frente a los trabajos diferidos que terminan en otro hilo
+_conversaciones_lock = threading.RLock()
 
 # Traducciones para formato de fecha
 DIAS = {
@@ -166,86 +393,755 @@ def formato_fecha_español(fecha):
     
     return formato_ingles
 
+# Cada cuánto se recorren las conversaciones buscando expiradas (segundos)
+INTERVALO_LIMPIEZA = 60
+_ultima_limpieza = 0.0
+
 def limpiar_conversaciones_expiradas():
-    """Elimina conversaciones inactivas"""
-    ahora = datetime.now(TIMEZONE)
-    expiradas = []
+    """Elimina conversaciones inactivas (como mucho una vez por INTERVALO_LIMPIEZA)"""
+    global _ultima_limpieza
+    ahora = time.time()
+    if ahora - _ultima_limpieza < INTERVALO_LIMPIEZA:
+        return
+    _ultima_limpieza = ahora
     
-    for remitente, datos in conversaciones.items():
-        ultimo_mensaje = datos.get('ultimo_mensaje')
-        if ultimo_mensaje and (ahora - ultimo_mensaje) > timedelta(minutes=TIEMPO_EXPIRACION):
-            expiradas.append(remitente)
+    limite = int(ahora) - TIEMPO_EXPIRACION * 60
+    with _conversaciones_lock:
+        expiradas = [remitente for remitente, conversacion in conversaciones.items()
+                     if conversacion.ultimo_mensaje < limite]
+        for remitente in expiradas:
+            conversaciones.pop(remitente, None)  # Más seguro que del
     
     for remitente in expiradas:
-        logger.info(f"Expirando conversación de {remitente}")
-        conversaciones.pop(remitente, None)  # Más seguro que del
+        logger.info("Expirando conversación de %s", remitente)
+    
+    reofrecer_ofertas_vencidas()
 
-def get_calendar_service():
-    """Obtiene el servicio de Google Calendar"""
-    try:
-        cred_json = os.getenv("GOOGLE_CREDENTIALS")
-        # Usar un ID de calendario explícito en lugar de 'primary'
-        calendar_id = os.getenv("GOOGLE_CALENDAR_ID")
+# Diario persistente de conversaciones (vacío = desactivado)
+DIARIO_RUTA = os.getenv("CONVERSACIONES_DIARIO", "")
+DIARIO_FSYNC_SEGUNDOS = float(os.getenv("CONVERSACIONES_DIARIO_FSYNC", "1"))  # intervalo de escritura + fsync
+DIARIO_COMPACTAR_CADA = int(os.getenv("CONVERSACIONES_DIARIO_COMPACTAR", "5000"))  # registros entre snapshots
+DIARIO_RANURAS = int(os.getenv("CONVERSACIONES_DIARIO_RANURAS", "16"))  # un diario por worker como máximo
+
+class DiarioConversaciones:
+    """
+    Diario append-only de transiciones de conversación con snapshots compactados.
+
+    Los registros se acumulan en memoria y un hilo los escribe y hace fsync cada
+    `intervalo` segundos. Cuando el diario supera `compactar_cada` registros se
+    escribe un snapshot con las conversaciones vivas y el diario se vacía, así que
+    la recuperación al arrancar cuesta lo mismo que el número de chats activos.
+
+    Snapshot y diario empiezan con un registro de generación: un diario de una
+    generación anterior al snapshot ya está incluido en él y no se reaplica.
+
+    El estado vive en memoria por proceso, así que cada worker escribe en su
+    propia ranura (`ruta`, `ruta.1`, `ruta.2`...), reservada con un flock. Al
+    arrancar, todos reconstruyen su estado leyendo todas las ranuras y quedándose
+    con la versión más reciente de cada conversación.
+    """
+    # op, longitud de la clave, longitud de los datos
+    _REGISTRO = struct.Struct('<BHI')
+    _GENERACION = struct.Struct('<Q')
+    OP_GENERACION = 0
+    OP_GUARDAR = 1
+    OP_BORRAR = 2
+
+    def __init__(self, ruta, intervalo, compactar_cada, ranuras=1):
+        self.ruta_base = ruta
+        self.ruta = ruta
+        self.ruta_snapshot = ruta + '.snapshot'
+        self.ranuras = ranuras
+        self.intervalo = intervalo
+        self.compactar_cada = compactar_cada
+        self._pendientes = []
+        self._lock = threading.Lock()  # protege _pendientes
+        self._lock_archivo = threading.Lock()  # serializa escrituras y compactaciones
+        self._archivo = None
+        self._cerrojo = None
+        self._generacion = 0
+        self._escritos = 0
+        self._fuente = None
+        self._detener = threading.Event()
+
+    @classmethod
+    def _codificar(cls, op, clave, datos=b''):
+        clave_bytes = clave.encode('utf-8')
+        return cls._REGISTRO.pack(op, len(clave_bytes), len(datos)) + clave_bytes + datos
+
+    @classmethod
+    def _leer_registros(cls, ruta):
+        """Itera los registros de un archivo, ignorando una cola truncada por un crash"""
+        try:
+            with open(ruta, 'rb') as f:
+                datos = f.read()
+        except FileNotFoundError:
+            return
         
-        if not calendar_id:
-            logger.warning("⚠️ GOOGLE_CALENDAR_ID no configurado, esto puede causar problemas con las cuentas de servicio")
-            calendar_id = "primary"  # Fallback, pero probablemente falle con cuentas de servicio
-            
-        logger.info(f"✓ Usando calendario con ID: {calendar_id}")
+        vista = memoryview(datos)
+        offset = 0
+        while offset + cls._REGISTRO.size <= len(datos):
+            op, longitud_clave, longitud_datos = cls._REGISTRO.unpack_from(datos, offset)
+            inicio = offset + cls._REGISTRO.size
+            fin = inicio + longitud_clave + longitud_datos
+            if fin > len(datos):
+                break
+            clave = bytes(vista[inicio:inicio + longitud_clave]).decode('utf-8')
+            yield op, clave, vista[inicio + longitud_clave:fin]
+            offset = fin
+        
+        if offset < len(datos):
+            logger.warning("⚠️ Registro incompleto al final de %s (%s bytes ignorados)", ruta, len(datos) - offset)
+
+    def guardar(self, clave, conversacion):
+        """Encola el estado actual de una conversación"""
+        registro = self._codificar(self.OP_GUARDAR, clave, conversacion.a_bytes())
+        with self._lock:
+            self._pendientes.append(registro)
+
+    def borrar(self, clave):
+        """Encola el borrado de una conversación"""
+        registro = self._codificar(self.OP_BORRAR, clave)
+        with self._lock:
+            self._pendientes.append(registro)
+
+    def _ruta_ranura(self, ranura):
+        return self.ruta_base if ranura == 0 else f"{self.ruta_base}.{ranura}"
+
+    def _reservar_ranura(self):
+        """Toma la primera ranura libre; devuelve False si todas están en uso"""
+        import fcntl
         
-        if cred_json:
-            logger.info(f"✓ GOOGLE_CREDENTIALS configurado (longitud: {len(cred_json)} caracteres)")
+        for ranura in range(self.ranuras):
+            ruta = self._ruta_ranura(ranura)
+            cerrojo = open(ruta + '.lock', 'a')
             try:
-                json_data = json.loads(cred_json)
-                logger.info(f"✓ GOOGLE_CREDENTIALS parseado correctamente como JSON")
-                
-                # Asegurar que las credenciales tienen toda la información necesaria
-                required_fields = ['type', 'project_id', 'private_key_id', 'private_key', 'client_email']
-                missing_fields = [field for field in required_fields if field not in json_data]
-                
-                if missing_fields:
-                    logger.error(f"❌ Faltan campos en las credenciales: {missing_fields}")
-                    return None
-                
-                creds = service_account.Credentials.from_service_account_info(
-                    json_data,
-                    scopes=['https://www.googleapis.com/auth/calendar']
-                )
-                logger.info(f"✓ Credenciales generadas correctamente para: {json_data.get('client_email', 'unknown')}")
-                
-            except json.JSONDecodeError as e:
-                logger.error(f"❌ Error al parsear GOOGLE_CREDENTIALS como JSON: {e}")
-                logger.error(f"Primeros 100 caracteres de GOOGLE_CREDENTIALS: {cred_json[:100]}...")
-                return None
-        else:
-            logger.warning("⚠️ GOOGLE_CREDENTIALS no configurado, intentando usar archivo local")
+                fcntl.flock(cerrojo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                cerrojo.close()
+                continue
+            self._cerrojo = cerrojo
+            self.ruta = ruta
+            self.ruta_snapshot = ruta + '.snapshot'
+            return True
+        return False
+
+    def iniciar(self, conversaciones_vivas, lock_conversaciones, ttl_segundos):
+        """
+        Recupera el estado en `conversaciones_vivas` y arranca el hilo escritor.
+        Si no queda ranura libre se recupera igual, pero este proceso no escribe
+        en el diario y devuelve False.
+        """
+        inicio = time.perf_counter()
+        escribe = self._reservar_ranura()
+        
+        recuperadas = {}
+        for ranura in range(self.ranuras):
+            ruta = self._ruta_ranura(ranura)
+            generacion, conversaciones_ranura = self._recuperar(ruta, ttl_segundos)
+            if escribe and ruta == self.ruta:
+                self._generacion = generacion
+            for clave, conversacion in conversaciones_ranura.items():
+                # Un remitente pudo pasar por varios workers: gana su último mensaje
+                previa = recuperadas.get(clave)
+                if previa is None or conversacion.ultimo_mensaje > previa.ultimo_mensaje:
+                    recuperadas[clave] = conversacion
+        
+        with lock_conversaciones:
+            conversaciones_vivas.update(recuperadas)
+        
+        if not escribe:
+            logger.warning("⚠️ Las %s ranuras del diario %s están en uso; este worker recuperó "
+                           "%s conversaciones pero no registrará las suyas", self.ranuras, self.ruta_base, len(recuperadas))
+            return False
+        
+        def fuente():
+            # Serializar bajo el lock: el webhook muta las conversaciones en sitio.
+            # Se itera una copia por si algún camino agrega o quita sin tomarlo.
+            with lock_conversaciones:
+                return [(clave, conversacion.a_bytes()) for clave, conversacion in list(conversaciones_vivas.items())]
+        self._fuente = fuente
+        
+        # Compactar de entrada deja el diario vacío con una generación nueva
+        self._archivo = open(self.ruta, 'ab')
+        with self._lock_archivo:
+            self._compactar()
+        
+        logger.info("✓ %s conversaciones recuperadas del diario en %.0f ms (escribiendo en %s)",
+                    len(recuperadas), (time.perf_counter() - inicio) * 1000, self.ruta)
+        
+        threading.Thread(target=self._ciclo, name='diario-conversaciones', daemon=True).start()
+        atexit.register(self.detener)
+        return True
+
+    def _recuperar(self, ruta, ttl_segundos):
+        """Aplica snapshot + diario de una ranura y devuelve (generación, conversaciones no expiradas)"""
+        ultimos = {}
+        generacion_snapshot = 0
+        for op, clave, datos in self._leer_registros(ruta + '.snapshot'):
+            if op == self.OP_GENERACION:
+                (generacion_snapshot,) = self._GENERACION.unpack(datos)
+            elif op == self.OP_GUARDAR:
+                ultimos[clave] = datos
+        
+        aplicar = False
+        for op, clave, datos in self._leer_registros(ruta):
+            if op == self.OP_GENERACION:
+                (generacion,) = self._GENERACION.unpack(datos)
+                aplicar = generacion >= generacion_snapshot
+            elif not aplicar:
+                continue
+            elif op == self.OP_GUARDAR:
+                ultimos[clave] = datos
+            elif op == self.OP_BORRAR:
+                ultimos.pop(clave, None)
+        
+        # Solo se decodifican las conversaciones que sobreviven
+        limite = int(time.time()) - ttl_segundos
+        recuperadas = {}
+        for clave, datos in ultimos.items():
             try:
-                creds = service_account.Credentials.from_service_account_file(
-                    'credentials.json',
-                    scopes=['https://www.googleapis.com/auth/calendar']
-                )
-                logger.info("✓ Credenciales cargadas desde archivo local 'credentials.json'")
+                conversacion = Conversacion.desde_bytes(datos)
+            except (ValueError, struct.error, UnicodeDecodeError) as e:
+                logger.warning("⚠️ Conversación ilegible en el diario para %s: %s", clave, e)
+                continue
+            if conversacion.ultimo_mensaje >= limite:
+                recuperadas[clave] = conversacion
+        return generacion_snapshot, recuperadas
+
+    def _compactar(self):
+        """Escribe un snapshot de las conversaciones vivas y vacía el diario"""
+        generacion = self._generacion + 1
+        cabecera = self._codificar(self.OP_GENERACION, '', self._GENERACION.pack(generacion))
+        
+        temporal = self.ruta_snapshot + '.tmp'
+        with open(temporal, 'wb') as f:
+            f.write(cabecera)
+            for clave, datos in self._fuente():
+                f.write(self._codificar(self.OP_GUARDAR, clave, datos))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporal, self.ruta_snapshot)
+        self._fsync_directorio()
+        
+        self._archivo.truncate(0)
+        self._archivo.write(cabecera)
+        self._archivo.flush()
+        os.fsync(self._archivo.fileno())
+        self._generacion = generacion
+        self._escritos = 0
+
+    def _fsync_directorio(self):
+        descriptor = os.open(os.path.dirname(os.path.abspath(self.ruta_snapshot)), os.O_RDONLY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+    def vaciar(self):
+        """Escribe los registros pendientes con un único fsync (o compacta si toca)"""
+        with self._lock:
+            lote, self._pendientes = self._pendientes, []
+        if not lote:
+            return
+        
+        with self._lock_archivo:
+            try:
+                if self._escritos + len(lote) >= self.compactar_cada:
+                    # Todo lo del lote ya está aplicado en memoria, así que el snapshot lo incluye
+                    self._compactar()
+                    return
+                self._archivo.write(b''.join(lote))
+                self._archivo.flush()
+                os.fsync(self._archivo.fileno())
+                self._escritos += len(lote)
+            except Exception as e:
+                # El hilo escritor no debe morir: el siguiente ciclo lo reintenta con lo nuevo
+                logger.error("❌ Error al escribir el diario de conversaciones: %s", e, exc_info=True)
+
+    def _ciclo(self):
+        while not self._detener.wait(self.intervalo):
+            try:
+                self.vaciar()
             except Exception as e:
-                logger.error(f"❌ Error al cargar archivo credentials.json: {e}")
+                logger.error("❌ Error en el hilo del diario de conversaciones: %s", e, exc_info=True)
+
+    def detener(self):
+        """Escribe lo pendiente y detiene el hilo escritor"""
+        self._detener.set()
+        self.vaciar()
+
+diario = None
+_diario_pid = None
+
+def iniciar_diario():
+    """
+    Recupera las conversaciones y arranca el diario en este proceso.
+    Se llama desde el hook post_worker_init de gunicorn (gunicorn.conf.py) o al
+    ejecutar el servidor directamente, nunca al importar: así ni el master con
+    --preload ni los scripts que importan este módulo toman una ranura.
+    """
+    global diario, _diario_pid
+    if not DIARIO_RUTA or _diario_pid == os.getpid():
+        return
+    _diario_pid = os.getpid()
+    nuevo = DiarioConversaciones(DIARIO_RUTA, DIARIO_FSYNC_SEGUNDOS, DIARIO_COMPACTAR_CADA, DIARIO_RANURAS)
+    if nuevo.iniciar(conversaciones, _conversaciones_lock, TIEMPO_EXPIRACION * 60):
+        diario = nuevo
+
+def registrar_conversacion(clave):
+    """Anota en el diario el estado actual de la conversación (o su borrado)"""
+    if diario is None:
+        return
+    conversacion = conversaciones.get(clave)
+    if conversacion is None:
+        diario.borrar(clave)
+    else:
+        diario.guardar(clave, conversacion)
+
+# Ids que se devuelven cuando la cita no quedó en Calendar: los comparten varias citas
+EVENTOS_SIN_ID = frozenset(["sin-calendario", "error-http", "error-desconocido", "error-permisos", "error-local", "error-sin-id"])
+
+# Perfiles de clientes frecuentes en SQLite (vacío = desactivado)
+CLIENTES_DB = os.getenv("CLIENTES_DB", "")
+HORAS_PREFERIDAS_MAX = 2  # horarios habituales que se sugieren al pedir la fecha
+
+class PerfilCliente:
+    """Lo que recordamos de un cliente entre citas"""
+    __slots__ = ('nombre', 'telefono', 'ultimo_servicio', 'horas')
+
+    def __init__(self, nombre, telefono, ultimo_servicio, horas):
+        self.nombre = nombre
+        self.telefono = telefono
+        self.ultimo_servicio = ultimo_servicio
+        self.horas = horas  # "HH:MM" -> citas agendadas a esa hora
+
+    def horas_preferidas(self):
+        """Las horas a las que más agenda, de la más a la menos frecuente"""
+        return [hora for hora, _ in Counter(self.horas).most_common(HORAS_PREFERIDAS_MAX)]
+
+class RegistroClientes:
+    """
+    Perfiles por clave de conversación (remitente, o negocio|remitente en
+    multi-tenant): nombre, teléfono, último servicio y horas habituales. Se
+    actualizan al confirmar cada cita, que además queda en la tabla `citas`
+    para consultarla sin pasar por Calendar. SQLite en modo WAL admite varios
+    workers.
+
+    Las citas se identifican como en TablaReservas: por su evento de Calendar o,
+    si se guardaron sin id propio ('sin-calendario'...), por la conversación.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._lock = threading.Lock()
+        self._conexion = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None)
+        self._conexion.execute("PRAGMA journal_mode=WAL")
+        self._conexion.execute("PRAGMA busy_timeout=2000")
+        self._conexion.execute(
+            "CREATE TABLE IF NOT EXISTS clientes ("
+            " clave TEXT PRIMARY KEY, nombre TEXT, telefono TEXT,"
+            " ultimo_servicio TEXT, horas TEXT NOT NULL DEFAULT '{}', actualizado INTEGER)"
+        )
+        columnas = [fila[1] for fila in self._conexion.execute("PRAGMA table_info(citas)")]
+        if columnas and 'id' not in columnas:
+            self._migrar_citas()
+        self._conexion.execute(
+            "CREATE TABLE IF NOT EXISTS citas ("
+            " id TEXT PRIMARY KEY, evento_id TEXT, negocio TEXT, clave TEXT, nombre TEXT, telefono TEXT,"
+            " servicio TEXT, inicio INTEGER, fin INTEGER, cancelada INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conexion.execute("CREATE INDEX IF NOT EXISTS citas_por_inicio ON citas (negocio, inicio)")
+
+    def _migrar_citas(self):
+        """Pasa la tabla `citas` con clave evento_id (y columna barbero) a la clave por cita"""
+        logger.info("Migrando la tabla de citas de %s", self.ruta)
+        sin_id = ', '.join('?' * len(EVENTOS_SIN_ID))
+        self._conexion.execute("BEGIN IMMEDIATE")
+        try:
+            self._conexion.execute("ALTER TABLE citas RENAME TO citas_anterior")
+            self._conexion.execute("DROP INDEX IF EXISTS citas_por_inicio")
+            self._conexion.execute(
+                "CREATE TABLE citas ("
+                " id TEXT PRIMARY KEY, evento_id TEXT, negocio TEXT, clave TEXT, nombre TEXT, telefono TEXT,"
+                " servicio TEXT, inicio INTEGER, fin INTEGER, cancelada INTEGER NOT NULL DEFAULT 0)"
+            )
+            self._conexion.execute(
+                "INSERT OR REPLACE INTO citas (id, evento_id, negocio, clave, nombre, telefono, servicio, inicio, fin, cancelada)"
+                f" SELECT CASE WHEN evento_id IN ({sin_id}) THEN 'cita:' || clave ELSE 'evento:' || evento_id END,"
+                " evento_id, negocio, clave, nombre, telefono, servicio, inicio, fin, cancelada FROM citas_anterior",
+                sorted(EVENTOS_SIN_ID)
+            )
+            self._conexion.execute("DROP TABLE citas_anterior")
+            self._conexion.execute("COMMIT")
+        except sqlite3.Error:
+            self._conexion.execute("ROLLBACK")
+            raise
+
+    def obtener(self, clave):
+        """Perfil del cliente, o None si nunca ha agendado"""
+        try:
+            with self._lock:
+                fila = self._conexion.execute(
+                    "SELECT nombre, telefono, ultimo_servicio, horas FROM clientes WHERE clave = ?", (clave,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.error("❌ Error al leer el perfil de %s: %s", clave, e)
+            return None
+        if fila is None:
+            return None
+        nombre, telefono, ultimo_servicio, horas = fila
+        return PerfilCliente(nombre, telefono, ultimo_servicio, json.loads(horas))
+
+    def registrar_cita(self, clave, conversacion):
+        """Actualiza el perfil con la cita recién confirmada"""
+        negocio = negocio_actual()
+        hora = conversacion.fecha.strftime('%H:%M')
+        inicio = int(conversacion.fecha.timestamp())
+        fin = inicio + negocio.servicios[conversacion.servicio]['duracion'] * 60
+        try:
+            with self._lock:
+                fila = self._conexion.execute("SELECT horas FROM clientes WHERE clave = ?", (clave,)).fetchone()
+                horas = json.loads(fila[0]) if fila else {}
+                horas[hora] = horas.get(hora, 0) + 1
+                self._conexion.execute(
+                    "INSERT INTO clientes (clave, nombre, telefono, ultimo_servicio, horas, actualizado)"
+                    " VALUES (?, ?, ?, ?, ?, ?)"
+                    " ON CONFLICT(clave) DO UPDATE SET nombre = excluded.nombre, telefono = excluded.telefono,"
+                    " ultimo_servicio = excluded.ultimo_servicio, horas = excluded.horas, actualizado = excluded.actualizado",
+                    (clave, conversacion.nombre, conversacion.telefono, conversacion.servicio,
+                     json.dumps(horas, separators=(',', ':')), int(time.time()))
+                )
+                if conversacion.evento_id:
+                    self._conexion.execute(
+                        "INSERT OR REPLACE INTO citas (id, evento_id, negocio, clave, nombre, telefono, servicio, inicio, fin)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (TablaReservas._clave_evento(conversacion.evento_id, clave), conversacion.evento_id,
+                         negocio.id, clave, conversacion.nombre, conversacion.telefono, conversacion.servicio, inicio, fin)
+                    )
+        except sqlite3.Error as e:
+            logger.error("❌ Error al guardar el perfil de %s: %s", clave, e)
+
+    def cancelar(self, evento_id, clave=None):
+        """Marca como cancelada la cita del evento (o la de `clave` si el evento no tiene id propio)"""
+        try:
+            with self._lock:
+                self._conexion.execute("UPDATE citas SET cancelada = 1 WHERE id = ?",
+                                       (TablaReservas._clave_evento(evento_id, clave),))
+        except sqlite3.Error as e:
+            logger.error("❌ Error al cancelar la cita %s en la base local: %s", evento_id, e)
+
+    def iterar_citas(self, negocio_id, desde, hasta, servicio=None):
+        """
+        Citas vigentes del negocio que empiezan en [desde, hasta) (segundos epoch), en
+        orden. Usa su propia conexión y recorre el cursor, así que no bloquea a los
+        demás ni carga el rango completo en memoria.
+        """
+        consulta = ("SELECT evento_id, nombre, telefono, servicio, inicio, fin FROM citas"
+                    " WHERE negocio = ? AND inicio >= ? AND inicio < ? AND cancelada = 0")
+        parametros = [negocio_id, desde, hasta]
+        if servicio:
+            consulta += " AND servicio LIKE ?"
+            parametros.append(f"%{servicio}%")
+        conexion = sqlite3.connect(self.ruta)
+        try:
+            yield from conexion.execute(consulta + " ORDER BY inicio", parametros)
+        finally:
+            conexion.close()
+
+clientes = RegistroClientes(CLIENTES_DB) if CLIENTES_DB else None
+
+def perfil_cliente(clave):
+    """Perfil del cliente (None si no lo conocemos o los perfiles están desactivados)"""
+    return clientes.obtener(clave) if clientes is not None else None
+
+# Transporte HTTP para Google Calendar
+CALENDAR_POOL_SIZE = int(os.getenv("CALENDAR_POOL_SIZE", "4"))  # conexiones por worker
+CALENDAR_CONNECT_TIMEOUT = float(os.getenv("CALENDAR_CONNECT_TIMEOUT", "3"))  # segundos
+CALENDAR_READ_TIMEOUT = float(os.getenv("CALENDAR_READ_TIMEOUT", "8"))  # segundos
+
+class _ConexionHTTPSCalendar(httplib2.HTTPSConnectionWithTimeout):
+    """Conexión HTTPS con timeout de conexión y timeout de lectura separados"""
+
+    def connect(self):
+        # httplib2 usa self.timeout para abrir el socket; después lo cambiamos al de lectura
+        super().connect()
+        if self.sock is not None:
+            self.sock.settimeout(CALENDAR_READ_TIMEOUT)
+
+class _HttpCalendar(httplib2.Http):
+    """Http keep-alive que abre sus conexiones HTTPS con _ConexionHTTPSCalendar"""
+
+    def __init__(self):
+        super().__init__(timeout=CALENDAR_CONNECT_TIMEOUT)
+
+    def request(self, uri, method="GET", body=None, headers=None,
+                redirections=httplib2.DEFAULT_MAX_REDIRECTS, connection_type=None):
+        if connection_type is None and uri.startswith("https:"):
+            connection_type = _ConexionHTTPSCalendar
+        return super().request(uri, method=method, body=body, headers=headers,
+                               redirections=redirections, connection_type=connection_type)
+
+class PoolHttpCalendar:
+    """
+    Pool acotado de transportes autorizados (httplib2 no es thread-safe).
+    Cada hilo toma un transporte en exclusiva y lo devuelve al terminar, así
+    las conexiones keep-alive se reutilizan entre peticiones del mismo worker.
+    """
+
+    def __init__(self, credenciales, tamano):
+        self._credenciales = credenciales
+        self._libres = queue.LifoQueue(maxsize=tamano)
+        for _ in range(tamano):
+            self._libres.put(None)  # Se crean bajo demanda
+
+    @contextmanager
+    def transporte(self):
+        http = self._libres.get()
+        if http is None:
+            http = google_auth_httplib2.AuthorizedHttp(self._credenciales, http=_HttpCalendar())
+        try:
+            yield http
+        except (OSError, httplib2.HttpLib2Error):
+            # Una conexión a medio leer no se puede reutilizar
+            http.http.connections.clear()
+            raise
+        finally:
+            self._libres.put(http)
+
+_calendar_lock = threading.Lock()
+_calendar_service = None
+_calendar_pool = None
+_calendar_pid = None
+
+def _cargar_credenciales_calendar():
+    """Carga las credenciales de la cuenta de servicio de Google"""
+    cred_json = os.getenv("GOOGLE_CREDENTIALS")
+    if cred_json:
+        logger.info("✓ GOOGLE_CREDENTIALS configurado")
+        try:
+            json_data = json.loads(cred_json)
+            logger.info("✓ GOOGLE_CREDENTIALS parseado correctamente como JSON")
+            
+            # Asegurar que las credenciales tienen toda la información necesaria
+            required_fields = ['type', 'project_id', 'private_key_id', 'private_key', 'client_email']
+            missing_fields = [field for field in required_fields if field not in json_data]
+            
+            if missing_fields:
+                logger.error("❌ Faltan campos en las credenciales: %s", missing_fields)
                 return None
             
-        service = build('calendar', 'v3', credentials=creds)
-        
-        # Guardar el ID del calendario en un atributo del servicio para usarlo en otras funciones
-        service._calendar_id = calendar_id
-        
-        logger.info("✓ Servicio de Google Calendar inicializado correctamente")
-        return service
-    except Exception as e:
-        logger.error(f"❌ Error al obtener servicio de Google Calendar: {e}", exc_info=True)
-        return None
+            creds = service_account.Credentials.from_service_account_info(
+                json_data,
+                scopes=['https://www.googleapis.com/auth/calendar']
+            )
+            logger.info("✓ Credenciales generadas correctamente para: %s", json_data.get('client_email', 'unknown'))
+            return creds
+            
+        except json.JSONDecodeError as e:
+            logger.error("❌ Error al parsear GOOGLE_CREDENTIALS como JSON: %s", e)
+            return None
+    else:
+        logger.warning("⚠️ GOOGLE_CREDENTIALS no configurado, intentando usar archivo local")
+        try:
+            creds = service_account.Credentials.from_service_account_file(
+                'credentials.json',
+                scopes=['https://www.googleapis.com/auth/calendar']
+            )
+            logger.info("✓ Credenciales cargadas desde archivo local 'credentials.json'")
+            return creds
+        except Exception as e:
+            logger.error("❌ Error al cargar archivo credentials.json: %s", e)
+            return None
+
+def get_calendar_service():
+    """Obtiene el servicio de Google Calendar (uno por proceso, con su pool de conexiones)"""
+    global _calendar_service, _calendar_pool, _calendar_pid
+    
+    # Tras un fork (gunicorn) las conexiones heredadas no se comparten
+    if _calendar_service is not None and _calendar_pid == os.getpid():
+        return _calendar_service
+    
+    with _calendar_lock:
+        if _calendar_service is not None and _calendar_pid == os.getpid():
+            return _calendar_service
+        try:
+            # Usar un ID de calendario explícito en lugar de 'primary'
+            calendar_id = os.getenv("GOOGLE_CALENDAR_ID")
+            
+            if not calendar_id:
+                logger.warning("⚠️ GOOGLE_CALENDAR_ID no configurado, esto puede causar problemas con las cuentas de servicio")
+                calendar_id = "primary"  # Fallback, pero probablemente falle con cuentas de servicio
+                
+            logger.info("✓ Usando calendario con ID: %s", calendar_id)
+            
+            creds = _cargar_credenciales_calendar()
+            if creds is None:
+                return None
+            
+            # Las peticiones no usan el transporte propio del servicio sino uno del pool
+            service = build('calendar', 'v3', credentials=creds, cache_discovery=False)
+            pool = PoolHttpCalendar(creds, CALENDAR_POOL_SIZE)
+            
+            # Guardar el ID del calendario en un atributo del servicio para usarlo en otras funciones
+            service._calendar_id = calendar_id
+            
+            _calendar_pool = pool
+            _calendar_service = service
+            _calendar_pid = os.getpid()
+            logger.info("✓ Servicio de Google Calendar inicializado correctamente (pool de %s conexiones)", CALENDAR_POOL_SIZE)
+            return service
+        except Exception as e:
+            logger.error("❌ Error al obtener servicio de Google Calendar: %s", e, exc_info=True)
+            return None
+
+# Reintentos y circuit breaker de Google Calendar
+CALENDAR_REINTENTOS = int(os.getenv("CALENDAR_REINTENTOS", "2"))  # reintentos tras el primer intento
+CALENDAR_BACKOFF_BASE = float(os.getenv("CALENDAR_BACKOFF_BASE", "0.2"))  # segundos
+CALENDAR_BACKOFF_MAX = float(os.getenv("CALENDAR_BACKOFF_MAX", "2"))  # segundos
+CIRCUITO_FALLOS = int(os.getenv("CIRCUITO_FALLOS", "5"))  # fallos seguidos que abren el circuito
+CIRCUITO_ENFRIAMIENTO = float(os.getenv("CIRCUITO_ENFRIAMIENTO", "30"))  # segundos abierto antes de probar
+CODIGOS_REINTENTABLES = {429, 500, 502, 503, 504}
+# Operaciones que no deben reintentarse. events.insert ya no está: lleva un id propio
+# (TablaReservas.id_evento) y un reintento que choca con su primer intento devuelve 409.
+OPERACIONES_SIN_REINTENTO = set()
 
-def parsear_fecha(texto):
+MENSAJE_CALENDARIO_CAIDO = "⚠️ Ahora mismo no podemos consultar la agenda. Por favor inténtalo de nuevo en unos minutos."
+
+class CalendarNoDisponible(Exception):
+    """Calendar no respondió (circuito abierto o reintentos agotados): modo degradado"""
+
+class CircuitoCalendar:
+    """
+    Circuit breaker de Google Calendar. Tras CIRCUITO_FALLOS fallos seguidos se abre
+    y las llamadas fallan de inmediato; pasado el enfriamiento deja pasar una sola
+    llamada de prueba (semiabierto) que lo vuelve a cerrar o a abrir.
+    """
+    CERRADO, SEMIABIERTO, ABIERTO = 'cerrado', 'semiabierto', 'abierto'
+
+    def __init__(self, umbral, enfriamiento):
+        self.umbral = umbral
+        self.enfriamiento = enfriamiento
+        self._lock = threading.Lock()
+        self.estado = self.CERRADO
+        self._fallos_seguidos = 0
+        self._abierto_desde = 0.0
+        self._prueba_en_curso = False
+        self.contadores = {'exitos': 0, 'fallos': 0, 'rechazos': 0, 'reintentos': 0, 'aperturas': 0}
+
+    def permitir(self):
+        """Indica si se puede llamar a Calendar ahora"""
+        with self._lock:
+            if self.estado == self.ABIERTO:
+                if time.monotonic() - self._abierto_desde < self.enfriamiento:
+                    self.contadores['rechazos'] += 1
+                    return False
+                self.estado = self.SEMIABIERTO
+                logger.info("🔌 Circuito de Calendar semiabierto: probando una llamada")
+            if self.estado == self.SEMIABIERTO:
+                if self._prueba_en_curso:
+                    self.contadores['rechazos'] += 1
+                    return False
+                self._prueba_en_curso = True
+            return True
+
+    def exito(self):
+        with self._lock:
+            self.contadores['exitos'] += 1
+            self._fallos_seguidos = 0
+            self._prueba_en_curso = False
+            if self.estado != self.CERRADO:
+                logger.info("🔌 Circuito de Calendar cerrado")
+            self.estado = self.CERRADO
+
+    def fallo(self):
+        with self._lock:
+            self.contadores['fallos'] += 1
+            self._fallos_seguidos += 1
+            self._prueba_en_curso = False
+            if self.estado == self.SEMIABIERTO or self._fallos_seguidos >= self.umbral:
+                if self.estado != self.ABIERTO:
+                    self.contadores['aperturas'] += 1
+                    logger.error("🔌 Circuito de Calendar abierto tras %d fallos seguidos", self._fallos_seguidos)
+                self.estado = self.ABIERTO
+                self._abierto_desde = time.monotonic()
+
+    def reintento(self):
+        with self._lock:
+            self.contadores['reintentos'] += 1
+
+    def instantanea(self):
+        """(estado, contadores) consistentes para exportar como métricas"""
+        with self._lock:
+            return self.estado, dict(self.contadores)
+
+circuito_calendar = CircuitoCalendar(CIRCUITO_FALLOS, CIRCUITO_ENFRIAMIENTO)
+
+def es_fallo_transitorio(error):
+    """Errores que indican que Calendar está caído o lento (y vale la pena reintentar)"""
+    if isinstance(error, HttpError):
+        return error.resp.status in CODIGOS_REINTENTABLES
+    return isinstance(error, (OSError, httplib2.HttpLib2Error))
+
+# Llamadas a Calendar de la petición perfilada en curso (None si no se perfila). Los
+# trabajos diferidos heredan la lista, así que también se anotan las que hace el ejecutor
+_llamadas_calendar = contextvars.ContextVar('llamadas_calendar', default=None)
+
+def ejecutar_calendar(peticion, operacion):
+    """
+    Ejecuta una petición de Calendar sobre un transporte del pool y registra su latencia.
+    Reintenta los fallos transitorios con backoff exponencial con jitter (sin pasarse del
+    plazo del webhook) y lanza CalendarNoDisponible si el circuito está abierto o se
+    agotan los reintentos. Los errores definitivos (404, 403...) se propagan tal cual.
+    """
+    llamadas = _llamadas_calendar.get()
+    intentos = 1 if operacion in OPERACIONES_SIN_REINTENTO else 1 + CALENDAR_REINTENTOS
+    for intento in range(intentos):
+        if not circuito_calendar.permitir():
+            raise CalendarNoDisponible(f"circuito abierto ({operacion})")
+        inicio = time.perf_counter()
+        try:
+            with _calendar_pool.transporte() as http:
+                resultado = peticion.execute(http=http)
+        except Exception as e:
+            if not es_fallo_transitorio(e):
+                circuito_calendar.exito()  # Calendar respondió; el error es de la petición
+                raise
+            circuito_calendar.fallo()
+            espera = random.uniform(0, min(CALENDAR_BACKOFF_MAX, CALENDAR_BACKOFF_BASE * 2 ** intento))
+            restante = plazo_restante()
+            if intento + 1 == intentos or (restante is not None and espera >= restante):
+                logger.error("❌ Calendar %s falló tras %d intento(s): %s", operacion, intento + 1, e)
+                raise CalendarNoDisponible(f"{operacion}: {e}") from e
+            logger.warning("🔁 Calendar %s falló (%s), reintento en %.2f s", operacion, e, espera)
+            circuito_calendar.reintento()
+            time.sleep(espera)
+        else:
+            circuito_calendar.exito()
+            return resultado
+        finally:
+            duracion_ms = (time.perf_counter() - inicio) * 1000
+            logger.info("⏱️ Calendar %s: %.0f ms", operacion, duracion_ms, extra={'evento': 'calendar'})
+            if llamadas is not None:
+                llamadas.append({'operacion': operacion, 'intento': intento + 1, 'ms': round(duracion_ms, 1),
+                                 'hilo': threading.current_thread().name})
+
+def parsear_fecha(texto, ahora=None):
     """Intenta parsear una fecha a partir de texto natural con implementación personalizada para español"""
-    logger.info(f"Intentando parsear fecha: '{texto}'")
+    return parsear_fecha_detallado(texto, ahora)[0]
+
+def parsear_fecha_detallado(texto, ahora=None):
+    """
+    Como parsear_fecha, pero devuelve (fecha, familia) donde familia indica qué
+    patrón resolvió el texto: 'mañana', 'dia_semana', 'hoy', 'dd/mm', 'dateparser'
+    o None si hubo un error. `ahora` permite fijar el instante de referencia.
+    """
+    logger.debug("Intentando parsear fecha: '%s'", texto)
     
     texto = texto.lower().strip()
-    ahora = datetime.now(TIMEZONE)
+    zona = negocio_actual().timezone
+    if ahora is None:
+        ahora = datetime.now(zona)
     resultado = None
     
     try:
@@ -264,8 +1160,8 @@ def parsear_fecha(texto):
             
             resultado = ahora + timedelta(days=1)
             resultado = resultado.replace(hour=hora, minute=minuto, second=0, microsecond=0)
-            logger.info(f"🔍 Fecha parseada usando patrón 'mañana': {resultado}")
-            return resultado
+            logger.info("🔍 Fecha parseada usando patrón 'mañana': %s", resultado, extra={'evento': 'parseo'})
+            return resultado, 'mañana'
         
         # Patrón: "día de la semana a las X(am/pm)" - ej: "jueves a las 4pm"
         dias_semana = {
@@ -298,8 +1194,8 @@ def parsear_fecha(texto):
                 
                 resultado = ahora + timedelta(days=dias_hasta)
                 resultado = resultado.replace(hour=hora, minute=minuto, second=0, microsecond=0)
-                logger.info(f"🔍 Fecha parseada usando patrón 'día de semana': {resultado}")
-                return resultado
+                logger.info("🔍 Fecha parseada usando patrón 'día de semana': %s", resultado, extra={'evento': 'parseo'})
+                return resultado, 'dia_semana'
         
         # Patrón: "hoy a las X(am/pm)"
         patron_hoy = r'hoy (?:a las?\s+)?(\d{1,2})(?::(\d{1,2}))?\s*(am|pm|de la tarde|de la mañana)?'
@@ -319,11 +1215,11 @@ def parsear_fecha(texto):
             
             # Si la hora ya pasó, sugerir para mañana
             if resultado < ahora:
-                logger.info(f"La hora de hoy {resultado} ya pasó, ajustando para mañana")
+                logger.debug("La hora de hoy %s ya pasó, ajustando para mañana", resultado)
                 resultado = resultado + timedelta(days=1)
             
-            logger.info(f"🔍 Fecha parseada usando patrón 'hoy': {resultado}")
-            return resultado
+            logger.info("🔍 Fecha parseada usando patrón 'hoy': %s", resultado, extra={'evento': 'parseo'})
+            return resultado, 'hoy'
         
         # Patrón: "DD/MM(/YY) a las X(am/pm)" - ej: "04/04/25 a las 3pm"
         patron_fecha = r'(\d{1,2})[/.-](\d{1,2})(?:[/.-](\d{2,4}))?\s+(?:a las?\s+)?(\d{1,2})(?::(\d{1,2}))?\s*(am|pm|de la tarde|de la mañana)?'
@@ -337,7 +1233,7 @@ def parsear_fecha(texto):
             
             # Validar mes y día
             if mes < 1 or mes > 12 or dia < 1 or dia > 31:
-                return None
+                return None, 'dd/mm'
             
             # Determinar año
             if anio:
@@ -357,15 +1253,15 @@ def parsear_fecha(texto):
                 # Crear fecha y validar
                 resultado = ahora.replace(year=anio, month=mes, day=dia, 
                                           hour=hora, minute=minuto, second=0, microsecond=0)
-                logger.info(f"🔍 Fecha parseada usando patrón 'DD/MM': {resultado}")
-                return resultado
+                logger.info("🔍 Fecha parseada usando patrón 'DD/MM': %s", resultado, extra={'evento': 'parseo'})
+                return resultado, 'dd/mm'
             except ValueError:
                 # Manejar errores como 30/02/2025
-                logger.warning(f"Fecha inválida: {dia}/{mes}/{anio}")
-                return None
+                logger.warning("Fecha inválida: %s/%s/%s", dia, mes, anio)
+                return None, 'dd/mm'
         
         # Si todos los patrones fallan, intentar con dateparser como fallback
-        logger.info("Intentando parsear con dateparser como último recurso")
+        logger.debug("Intentando parsear con dateparser como último recurso")
         
         # Traducir algunas palabras clave para ayudar a dateparser
         reemplazos = {
@@ -381,156 +1277,957 @@ def parsear_fecha(texto):
         for esp, eng in reemplazos.items():
             texto_traducido = texto_traducido.replace(esp, eng)
         
-        resultado = dateparser.parse(
-            texto_traducido,
-            settings={
-                'PREFER_DATES_FROM': 'future',
-                'RELATIVE_BASE': ahora,
-                'TIMEZONE': 'America/Mexico_City',
-                'RETURN_AS_TIMEZONE_AWARE': True,
-                'languages': ['es', 'en']
-            }
-        )
+        # Los idiomas van como argumento: dateparser rechaza 'languages' dentro de settings.
+        # RELATIVE_BASE es naive; la zona la indica TIMEZONE.
+        try:
+            resultado = dateparser.parse(
+                texto_traducido,
+                languages=['es', 'en'],
+                settings={
+                    'PREFER_DATES_FROM': 'future',
+                    'RELATIVE_BASE': ahora.replace(tzinfo=None),
+                    'TIMEZONE': zona.zone,
+                    'RETURN_AS_TIMEZONE_AWARE': True,
+                }
+            )
+        except Exception as e:
+            logger.error("Error de dateparser con '%s': %s", texto, e, exc_info=True)
+            return None, 'dateparser'
         
         if resultado and resultado.tzinfo is None:
-            resultado = TIMEZONE.localize(resultado)
+            resultado = zona.localize(resultado)
         
         if resultado:
-            logger.info(f"🔍 Fecha parseada con dateparser: {resultado}")
+            logger.info("🔍 Fecha parseada con dateparser: %s", resultado, extra={'evento': 'parseo'})
         else:
-            logger.warning(f"❌ No se pudo parsear la fecha: '{texto}'")
+            logger.warning("❌ No se pudo parsear la fecha: '%s'", texto)
         
-        return resultado
+        return resultado, 'dateparser'
         
     except Exception as e:
-        logger.error(f"Error al parsear fecha '{texto}': {e}", exc_info=True)
+        logger.error("Error al parsear fecha '%s': %s", texto, e, exc_info=True)
+        return None, None
+
+def validar_fecha(fecha, ahora=None):
+    """Valida si una fecha es adecuada para agendar cita"""
+    negocio = negocio_actual()
+    if ahora is None:
+        ahora = datetime.now(negocio.timezone)
+    
+    if not fecha:
+        return False, "No entendí la fecha. Por favor escribe algo como:\n'Mañana a las 10am'\n'Jueves a las 4pm'"
+    
+    if fecha < ahora - timedelta(minutes=30):
+        return False, "⚠️ Esa hora ya pasó. ¿Quieres agendar para otro momento?"
+    
+    if fecha.weekday() < 5:  # Lunes a viernes
+        if fecha.hour < negocio.hora_apertura or fecha.hour >= negocio.hora_cierre_lunes_viernes:
+            return False, f"⏰ Nuestro horario es de {negocio.hora_apertura}am a {negocio.hora_cierre_lunes_viernes-12}pm de lunes a viernes. ¿Qué hora te viene bien?"
+    elif fecha.weekday() == 5:  # Sábado
+        if fecha.hour < negocio.hora_apertura or fecha.hour >= negocio.hora_cierre_sabado:
+            return False, f"⏰ Nuestro horario el sábado es de {negocio.hora_apertura}am a {negocio.hora_cierre_sabado-12}pm. ¿Qué hora te viene bien?"
+    else:
+        return False, "🔒 Solo trabajamos de lunes a sábado. ¿Qué otro día te gustaría?"
+    
+    # Verificar que las citas empiecen en múltiplos de 15 minutos
+    if fecha.minute % UNIDAD_MINUTOS:
+        hora_redondeada = fecha.replace(minute=fecha.minute - fecha.minute % UNIDAD_MINUTOS)
+        return False, f"Programamos citas cada {UNIDAD_MINUTOS} minutos. ¿Te gustaría a las {hora_redondeada.strftime('%H:%M')}?"
+    
+    return True, None
+
+# Minutos que un horario ofrecido queda apartado mientras el cliente confirma
+RESERVA_TTL_MINUTOS = int(os.getenv("RESERVA_TTL_MINUTOS", "10"))
+
+class TablaReservas:
+    """
+    Reservas locales de horarios: apartados temporales (con TTL) mientras el cliente
+    confirma, y citas confirmadas hasta que terminan. Cuentan como ocupadas para los
+    demás clientes aunque Calendar todavía no las refleje.
+
+    Las reservas se indexan por día, así que comprobar un solapamiento solo recorre
+    las de ese día. Es una tabla por proceso: con varios workers cada uno ve solo
+    los apartados que hizo él.
+    """
+
+    def __init__(self, ttl_segundos, zona=TIMEZONE):
+        self.ttl = ttl_segundos
+        self.zona = zona
+        self._lock = threading.Lock()
+        self._por_dia = {}  # ordinal del día -> {clave: (inicio, fin, expira)} en segundos epoch
+        self._dia_de = {}   # clave -> ordinal del día
+        self._ids = {}      # clave -> (inicio, fin, id del evento que creará el apartado)
+
+    @staticmethod
+    def _clave_evento(evento_id, clave=None):
+        # Sin id propio de Calendar la cita se identifica por la conversación
+        if evento_id in EVENTOS_SIN_ID:
+            return f"cita:{clave}"
+        return f"evento:{evento_id}"
+
+    def _quitar(self, clave):
+        self._ids.pop(clave, None)
+        dia = self._dia_de.pop(clave, None)
+        if dia is None:
+            return None
+        reservas_dia = self._por_dia[dia]
+        reserva = reservas_dia.pop(clave, None)
+        if not reservas_dia:
+            del self._por_dia[dia]
+        return reserva
+
+    def _vigentes(self, dia, ahora):
+        """Reservas no expiradas del día (purga las expiradas de paso)"""
+        reservas_dia = self._por_dia.get(dia)
+        if not reservas_dia:
+            return {}
+        for clave in [c for c, (_, _, expira) in reservas_dia.items() if expira <= ahora]:
+            self._quitar(clave)
+        return self._por_dia.get(dia, {})
+
+    def _poner(self, clave, dia, reserva):
+        self._quitar(clave)
+        self._por_dia.setdefault(dia, {})[clave] = reserva
+        self._dia_de[clave] = dia
+
+    def ocupado(self, inicio, fin, excepto=None):
+        """Indica si [inicio, fin) se solapa con una reserva ajena vigente"""
+        desde, hasta = int(inicio.timestamp()), int(fin.timestamp())
+        with self._lock:
+            for clave, (otro_inicio, otro_fin, _) in self._vigentes(inicio.toordinal(), time.time()).items():
+                if clave != excepto and otro_inicio < hasta and desde < otro_fin:
+                    return True
+        return False
+
+    def apartar(self, clave, inicio, fin):
+        """Aparta [inicio, fin) para `clave` si nadie más lo tiene; devuelve si se apartó"""
+        desde, hasta = int(inicio.timestamp()), int(fin.timestamp())
+        dia = inicio.toordinal()
+        ahora = time.time()
+        with self._lock:
+            for otra, (otro_inicio, otro_fin, _) in self._vigentes(dia, ahora).items():
+                if otra != clave and otro_inicio < hasta and desde < otro_fin:
+                    return False
+            # Un cliente solo puede tener un apartado a la vez
+            anterior = self._ids.get(clave)
+            self._poner(clave, dia, (desde, hasta, int(ahora) + self.ttl))
+            if anterior is None or anterior[:2] != (desde, hasta):
+                # uuid4 en hex es un id válido para Calendar (base32hex, 5-1024 caracteres)
+                anterior = (desde, hasta, uuid.uuid4().hex)
+            self._ids[clave] = anterior
+        return True
+
+    def id_evento(self, clave):
+        """
+        Id con el que se crea en Calendar el evento del apartado de `clave`: es el
+        mismo en cada intento, así que repetir la inserción no duplica la cita.
+        """
+        with self._lock:
+            apartado = self._ids.get(clave)
+            return apartado[2] if apartado else None
+
+    def vigente(self, clave):
+        """Indica si `clave` conserva su apartado"""
+        with self._lock:
+            dia = self._dia_de.get(clave)
+            return dia is not None and clave in self._vigentes(dia, time.time())
+
+    def confirmar(self, clave, evento_id):
+        """Convierte el apartado de `clave` en una cita confirmada"""
+        with self._lock:
+            reserva = self._quitar(clave)
+            if reserva is None:
+                return False
+            desde, hasta, _ = reserva
+            dia = datetime.fromtimestamp(desde, self.zona).toordinal()
+            # La cita confirmada se conserva hasta que termina
+            self._poner(self._clave_evento(evento_id, clave), dia, (desde, hasta, hasta))
+        return True
+
+    def conservar_evento(self, clave, evento_id, inicio, fin):
+        """
+        Registra como confirmada una cita ya creada en Calendar cuyo apartado pudo
+        haberse perdido; el apartado de `clave` solo se consume si es ese mismo horario.
+        """
+        desde, hasta = int(inicio.timestamp()), int(fin.timestamp())
+        with self._lock:
+            dia = self._dia_de.get(clave)
+            if dia is not None and self._por_dia[dia][clave][:2] == (desde, hasta):
+                self._quitar(clave)
+            self._poner(self._clave_evento(evento_id, clave), inicio.toordinal(), (desde, hasta, hasta))
+
+    def intervalos(self, desde, hasta, excepto=None):
+        """Reservas ajenas vigentes entre `desde` y `hasta`, como (inicio, fin) en segundos epoch"""
+        inicio, fin = int(desde.timestamp()), int(hasta.timestamp())
+        ahora = time.time()
+        with self._lock:
+            return [
+                (otro_inicio, otro_fin)
+                for dia in range(desde.toordinal(), hasta.toordinal() + 1)
+                for clave, (otro_inicio, otro_fin, _) in list(self._vigentes(dia, ahora).items())
+                if clave != excepto and otro_inicio < fin and inicio < otro_fin
+            ]
+
+    def liberar(self, clave):
+        """Suelta el apartado de `clave` (si lo hay)"""
+        with self._lock:
+            self._quitar(clave)
+
+    def vacia(self):
+        """Indica si no queda ningún apartado ni cita vigente"""
+        ahora = time.time()
+        with self._lock:
+            return all(not self._vigentes(dia, ahora) for dia in list(self._por_dia))
+
+    def liberar_evento(self, evento_id, clave=None):
+        """Suelta la cita confirmada asociada a un evento cancelado"""
+        with self._lock:
+            self._quitar(self._clave_evento(evento_id, clave))
+
+# Multi-tenant: un archivo <numero>.json por barbería (vacío = solo el negocio por defecto)
+NEGOCIOS_DIR = os.getenv("NEGOCIOS_DIR", "")
+NEGOCIOS_CACHE_MAX = int(os.getenv("NEGOCIOS_CACHE_MAX", "500"))  # negocios cargados a la vez
+NEGOCIOS_INACTIVIDAD_MINUTOS = int(os.getenv("NEGOCIOS_INACTIVIDAD_MINUTOS", "60"))  # sin mensajes -> se descarga
+
+class Negocio:
+    """
+    Configuración de una barbería (tenant) y sus cachés: catálogo, horario,
+    calendario, mensajes y tabla de reservas locales.
+    """
+    __slots__ = ('id', 'nombre', 'numero', 'servicios', 'horario', 'horario_texto',
+                 'hora_apertura', 'hora_cierre_lunes_viernes', 'hora_cierre_sabado',
+                 'timezone', 'calendar_id', 'mensajes', 'reservas', 'ultimo_uso')
+
+    def __init__(self, id, nombre, numero, servicios, hora_apertura, hora_cierre_lunes_viernes,
+                 hora_cierre_sabado, zona_horaria, calendar_id=None, mensajes=None):
+        self.id = id
+        self.nombre = nombre
+        self.numero = numero
+        self.servicios = servicios
+        self.hora_apertura = hora_apertura
+        self.hora_cierre_lunes_viernes = hora_cierre_lunes_viernes
+        self.hora_cierre_sabado = hora_cierre_sabado
+        self.horario = (f"de lunes a viernes de {hora_apertura}:00 a {hora_cierre_lunes_viernes}:00, "
+                        f"sábado de {hora_apertura}:00 a {hora_cierre_sabado}:00")
+        self.horario_texto = ("🕒 *Horario:*\n"
+                              f"Lunes a viernes: {hora_apertura} a {hora_cierre_lunes_viernes} horas\n"
+                              f"Sábados: {hora_apertura} a {hora_cierre_sabado} horas")
+        self.timezone = pytz.timezone(zona_horaria)
+        self.calendar_id = calendar_id
+        self.mensajes = mensajes if mensajes is not None else {
+            **MENSAJES,
+            "bienvenida": f"¡Bienvenido a {nombre}! ✂️\n\n"
+                          "Puedes preguntar por:\n"
+                          "* 'servicios' para ver opciones\n"
+                          "* 'agendar' para reservar cita\n\n"
+                          f"{self.horario_texto}",
+        }
+        self.reservas = TablaReservas(RESERVA_TTL_MINUTOS * 60, self.timezone)
+        self.ultimo_uso = time.time()
+
+    @classmethod
+    def desde_archivo(cls, numero, ruta):
+        """
+        Carga un negocio desde su archivo JSON de configuración, por ejemplo:
+        {"nombre": "Barbería Centro", "calendar_id": "...@group.calendar.google.com",
+         "servicios": {"corte de cabello": {"precio": "200 MXN", "duracion": 30}},
+         "hora_apertura": 9, "hora_cierre_lunes_viernes": 19, "hora_cierre_sabado": 15,
+         "zona_horaria": "America/Mexico_City"}
+        """
+        with open(ruta, encoding='utf-8') as f:
+            config = json.load(f)
+        return cls(
+            id=numero,
+            nombre=config['nombre'],
+            numero=config.get('numero', f"whatsapp:+{numero}"),
+            servicios={sys.intern(nombre.lower()): detalles for nombre, detalles in config['servicios'].items()},
+            hora_apertura=config.get('hora_apertura', HORA_APERTURA),
+            hora_cierre_lunes_viernes=config.get('hora_cierre_lunes_viernes', HORA_CIERRE_LUNES_VIERNES),
+            hora_cierre_sabado=config.get('hora_cierre_sabado', HORA_CIERRE_SABADO),
+            zona_horaria=config.get('zona_horaria', TIMEZONE.zone),
+            calendar_id=config.get('calendar_id'),
+        )
+
+# La barbería original, configurada con las constantes de este módulo
+NEGOCIO_DEFAULT = Negocio(
+    id='default',
+    nombre="Barbería d' Leo",
+    numero=TWILIO_PHONE_NUMBER,
+    servicios=SERVICIOS,
+    hora_apertura=HORA_APERTURA,
+    hora_cierre_lunes_viernes=HORA_CIERRE_LUNES_VIERNES,
+    hora_cierre_sabado=HORA_CIERRE_SABADO,
+    zona_horaria=TIMEZONE.zone,
+    mensajes=MENSAJES,
+)
+
+class RegistroNegocios:
+    """
+    Resuelve el negocio por el número que recibe el mensaje. Los negocios se cargan
+    la primera vez que se usan y se descargan (LRU) al superar NEGOCIOS_CACHE_MAX
+    o tras NEGOCIOS_INACTIVIDAD_MINUTOS sin mensajes.
+
+    Las tablas de reservas viven fuera de la caché: al descargar un negocio se
+    conserva la suya mientras tenga apartados o citas vigentes, y al volver a
+    cargarlo la recupera.
+    """
+
+    def __init__(self, directorio, por_defecto, maximo, inactividad_segundos):
+        self.directorio = directorio
+        self.por_defecto = por_defecto
+        self.maximo = maximo
+        self.inactividad = inactividad_segundos
+        self._cache = OrderedDict()  # número -> Negocio, del menos al más reciente
+        self._reservas = {}  # número -> TablaReservas, sobrevive a la descarga del negocio
+        self._lock = threading.Lock()
+
+    def resolver(self, to):
+        """Devuelve el negocio del número `to` (el negocio por defecto si no tiene configuración)"""
+        numero = re.sub(r'\D', '', to or '')
+        if not self.directorio or not numero:
+            return self.por_defecto
+        
+        ahora = time.time()
+        with self._lock:
+            negocio = self._cache.get(numero)
+            if negocio is not None:
+                self._cache.move_to_end(numero)
+                negocio.ultimo_uso = ahora
+                return negocio
+        
+        negocio = self._cargar(numero)
+        with self._lock:
+            negocio = self._cache.setdefault(numero, negocio)
+            if negocio is not self.por_defecto:
+                negocio.reservas = self._reservas.setdefault(numero, negocio.reservas)
+            self._cache.move_to_end(numero)
+            negocio.ultimo_uso = ahora
+            self._descargar(ahora)
+        return negocio
+
+    def _cargar(self, numero):
+        ruta = os.path.join(self.directorio, f"{numero}.json")
+        if not os.path.exists(ruta):
+            if numero != re.sub(r'\D', '', self.por_defecto.numero or ''):
+                logger.warning("⚠️ El número %s no tiene configuración en %s; sus mensajes usan "
+                               "el negocio y el calendario por defecto", numero, self.directorio)
+            return self.por_defecto
+        try:
+            negocio = Negocio.desde_archivo(numero, ruta)
+            logger.info("✓ Negocio '%s' cargado para el número %s", negocio.nombre, numero)
+            return negocio
+        except (OSError, ValueError, KeyError) as e:
+            logger.error("❌ Configuración inválida para el número %s: %s", numero, e)
+            return self.por_defecto
+
+    def _descargar(self, ahora):
+        """Quita los negocios que sobran o llevan tiempo sin usarse (siempre desde el más antiguo)"""
+        limite = ahora - self.inactividad
+        while self._cache:
+            numero, negocio = next(iter(self._cache.items()))
+            if len(self._cache) <= self.maximo and negocio.ultimo_uso >= limite:
+                break
+            self._cache.popitem(last=False)
+            if negocio is not self.por_defecto:
+                logger.info("Descargando negocio '%s' (%s)", negocio.nombre, numero)
+                if negocio.reservas.vacia():
+                    self._reservas.pop(numero, None)
+
+negocios = RegistroNegocios(NEGOCIOS_DIR, NEGOCIO_DEFAULT, NEGOCIOS_CACHE_MAX, NEGOCIOS_INACTIVIDAD_MINUTOS * 60)
+
+# Negocio de la petición en curso (lo heredan los trabajos diferidos)
+_negocio_actual = contextvars.ContextVar('negocio_actual', default=NEGOCIO_DEFAULT)
+
+def negocio_actual():
+    """Negocio al que pertenece el mensaje que se está procesando"""
+    return _negocio_actual.get()
+
+def clave_conversacion(negocio, remitente):
+    """Clave de la conversación: un mismo cliente puede hablar con varias barberías"""
+    if negocio is NEGOCIO_DEFAULT:
+        return remitente
+    return f"{negocio.id}|{remitente}"
+
+def remitente_de_clave(clave):
+    """Número de WhatsApp del cliente a partir de la clave de su conversación"""
+    return clave.rpartition('|')[2]
+
+def calendario_de(service):
+    """ID del calendario del negocio en curso"""
+    return negocio_actual().calendar_id or getattr(service, "_calendar_id", "primary")
+
+def a_unidades(minutos, redondear_arriba=False):
+    """Convierte minutos desde la medianoche en unidades de agenda"""
+    if redondear_arriba:
+        return -(-minutos // UNIDAD_MINUTOS)
+    return minutos // UNIDAD_MINUTOS
+
+def horario_del_dia(negocio, fecha):
+    """(apertura, cierre) del día en unidades, o None si ese día no se trabaja"""
+    if fecha.weekday() < 5:
+        cierre = negocio.hora_cierre_lunes_viernes
+    elif fecha.weekday() == 5:
+        cierre = negocio.hora_cierre_sabado
+    else:
         return None
+    return a_unidades(negocio.hora_apertura * 60), a_unidades(cierre * 60)
+
+class AgendaDia:
+    """
+    Intervalos ocupados de un día, en unidades desde la medianoche, como dos listas
+    ordenadas (inicios y fines) de intervalos disjuntos y fusionados.
+    """
+    __slots__ = ('inicios', 'fines')
+
+    def __init__(self):
+        self.inicios = []
+        self.fines = []
+
+    def ocupar(self, inicio, fin):
+        """Marca [inicio, fin) como ocupado, fusionando con los intervalos que toque"""
+        if fin <= inicio:
+            return
+        # Intervalos que se solapan o son contiguos: fines >= inicio e inicios <= fin
+        desde = bisect.bisect_left(self.fines, inicio)
+        hasta = bisect.bisect_right(self.inicios, fin)
+        if desde < hasta:
+            inicio = min(inicio, self.inicios[desde])
+            fin = max(fin, self.fines[hasta - 1])
+        self.inicios[desde:hasta] = [inicio]
+        self.fines[desde:hasta] = [fin]
+
+    def libre(self, inicio, fin):
+        """Indica si [inicio, fin) no se solapa con nada ocupado"""
+        i = bisect.bisect_right(self.fines, inicio)
+        return i == len(self.inicios) or self.inicios[i] >= fin
+
+    def copia(self):
+        agenda = AgendaDia()
+        agenda.inicios = self.inicios[:]
+        agenda.fines = self.fines[:]
+        return agenda
+
+    def huecos(self, apertura, cierre):
+        """Itera los huecos libres (inicio, fin) dentro de [apertura, cierre)"""
+        cursor = apertura
+        for i in range(bisect.bisect_right(self.fines, apertura), len(self.inicios)):
+            if self.inicios[i] >= cierre:
+                break
+            if self.inicios[i] > cursor:
+                yield cursor, self.inicios[i]
+            cursor = max(cursor, self.fines[i])
+        if cursor < cierre:
+            yield cursor, cierre
+
+def costo_fragmentacion(izquierda, derecha, duracion_minima, duracion_tipica):
+    """
+    Costo de dejar huecos de `izquierda` y `derecha` unidades alrededor de una cita:
+    primero las unidades que ningún servicio puede usar, luego los huecos más cortos
+    que el servicio típico y por último el número de huecos.
+    """
+    muertas = pequenos = fragmentos = 0
+    for hueco in (izquierda, derecha):
+        if hueco:
+            fragmentos += 1
+            if hueco < duracion_minima:
+                muertas += hueco
+            if hueco < duracion_tipica:
+                pequenos += 1
+    return muertas, pequenos, fragmentos
+
+def duraciones_catalogo(negocio):
+    """(duración mínima, duración más común) de los servicios del negocio, en unidades"""
+    duraciones = [a_unidades(d['duracion'], redondear_arriba=True) for d in negocio.servicios.values()]
+    return min(duraciones), Counter(duraciones).most_common(1)[0][0]
+
+def candidatos_dia(agenda, apertura, cierre, duracion, duracion_minima, duracion_tipica):
+    """Itera (costo, inicio) de todos los inicios posibles del día para `duracion` unidades"""
+    for inicio_hueco, fin_hueco in agenda.huecos(apertura, cierre):
+        for inicio in range(inicio_hueco, fin_hueco - duracion + 1):
+            costo = costo_fragmentacion(inicio - inicio_hueco, fin_hueco - inicio - duracion,
+                                        duracion_minima, duracion_tipica)
+            yield costo, inicio
+
+def _ocupar_en_agendas(agendas, zona, inicio, fin):
+    """Marca [inicio, fin) como ocupado en las agendas de los días que toca"""
+    inicio, fin = inicio.astimezone(zona), fin.astimezone(zona)
+    while inicio < fin:
+        # Un evento que cruza la medianoche ocupa el resto de cada día
+        fin_dia = zona.localize(datetime.combine(inicio.date() + timedelta(days=1), datetime.min.time()))
+        tramo_fin = min(fin, fin_dia)
+        minutos_fin = 24 * 60 if tramo_fin == fin_dia else tramo_fin.hour * 60 + tramo_fin.minute
+        agenda = agendas.setdefault(inicio.toordinal(), AgendaDia())
+        agenda.ocupar(a_unidades(inicio.hour * 60 + inicio.minute),
+                      a_unidades(minutos_fin, redondear_arriba=True))
+        inicio = fin_dia
+
+def agendas_calendar(service, desde, hasta):
+    """Agendas de Calendar entre `desde` y `hasta` (una sola consulta, paginada), sin reservas locales"""
+    zona = negocio_actual().timezone
+    agendas = {}
+    token = None
+    while True:
+        eventos = ejecutar_calendar(service.events().list(
+            calendarId=calendario_de(service),
+            timeMin=desde.isoformat(),
+            timeMax=hasta.isoformat(),
+            singleEvents=True,
+            maxResults=2500,
+            pageToken=token
+        ), 'events.list')
+        for evento in eventos.get('items', []):
+            if evento.get('transparency') == 'transparent':
+                continue  # Eventos marcados como "disponible"
+            inicio, fin = evento['start'], evento['end']
+            if 'dateTime' in inicio:
+                _ocupar_en_agendas(agendas, zona, datetime.fromisoformat(inicio['dateTime']),
+                                   datetime.fromisoformat(fin['dateTime']))
+            else:
+                # Evento de día completo
+                _ocupar_en_agendas(agendas, zona, zona.localize(datetime.fromisoformat(inicio['date'])),
+                                   zona.localize(datetime.fromisoformat(fin['date'])))
+        token = eventos.get('nextPageToken')
+        if not token:
+            break
+    return agendas
+
+def horario_libre_en_calendar(service, inicio, fin, excepto_evento=None):
+    """
+    Consulta a Calendar, sin caché, si [inicio, fin) está libre. Es la comprobación
+    final antes de crear la cita: la caché es por proceso y no ve las citas de otros
+    workers ni las que el personal edita a mano. `excepto_evento` es el id propio de
+    la cita, por si un intento anterior ya la creó.
+    """
+    eventos = ejecutar_calendar(service.events().list(
+        calendarId=calendario_de(service),
+        timeMin=inicio.isoformat(),
+        timeMax=fin.isoformat(),
+        singleEvents=True,
+        maxResults=50,
+        fields='items(id,status,transparency)'
+    ), 'events.list')
+    return not any(
+        evento.get('id') != excepto_evento and evento.get('status') != 'cancelled'
+        and evento.get('transparency') != 'transparent'
+        for evento in eventos.get('items', [])
+    )
+
+# Caché de agendas de Calendar por negocio y día (se precarga durante la conversación)
+AGENDA_CACHE_TTL = float(os.getenv("AGENDA_CACHE_TTL", "60"))  # segundos
+AGENDA_PRECARGA_DIAS = int(os.getenv("AGENDA_PRECARGA_DIAS", "3"))  # días desde hoy (0 = sin precarga)
+
+class CacheAgendas:
+    """
+    Agendas de Calendar (sin reservas locales) por (negocio, día) con TTL. Las
+    escrituras propias invalidan el día y suben la generación del negocio, así
+    que una consulta que empezó antes de la escritura no guarda datos viejos.
+    También recuerda las precargas en curso para que una verificación que llega
+    mientras tanto espere ese resultado en lugar de repetir la consulta.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._dias = {}        # (negocio_id, ordinal) -> (AgendaDia, expira)
+        self._generacion = {}  # negocio_id -> escrituras propias vistas
+        self._precargas = {}   # negocio_id -> (primer_dia, ultimo_dia, futuro)
+
+    def obtener(self, negocio_id, primer_dia, ultimo_dia):
+        """{ordinal: AgendaDia} de [primer_dia, ultimo_dia) si todos están frescos, o None"""
+        ahora = time.monotonic()
+        agendas = {}
+        with self._lock:
+            for dia in range(primer_dia, ultimo_dia):
+                entrada = self._dias.get((negocio_id, dia))
+                if entrada is None or entrada[1] <= ahora:
+                    return None
+                agendas[dia] = entrada[0]
+        return agendas
+
+    def generacion(self, negocio_id):
+        with self._lock:
+            return self._generacion.get(negocio_id, 0)
+
+    def guardar(self, negocio_id, primer_dia, ultimo_dia, agendas, generacion):
+        """Guarda las agendas consultadas si no hubo escrituras propias mientras tanto"""
+        ahora = time.monotonic()
+        with self._lock:
+            if self._generacion.get(negocio_id, 0) != generacion:
+                return
+            self._dias = {llave: entrada for llave, entrada in self._dias.items() if entrada[1] > ahora}
+            for dia in range(primer_dia, ultimo_dia):
+                self._dias[(negocio_id, dia)] = (agendas.get(dia, AgendaDia()), ahora + self.ttl)
+
+    def invalidar(self, negocio_id, dia):
+        """Una cita propia se creó o canceló ese día"""
+        with self._lock:
+            self._dias.pop((negocio_id, dia), None)
+            self._generacion[negocio_id] = self._generacion.get(negocio_id, 0) + 1
+
+    def precarga_en_curso(self, negocio_id, primer_dia, ultimo_dia):
+        """Futuro de una precarga que cubre esos días, o None"""
+        with self._lock:
+            precarga = self._precargas.get(negocio_id)
+        if precarga and precarga[0] <= primer_dia and ultimo_dia <= precarga[1]:
+            return precarga[2]
+        return None
+
+    def iniciar_precarga(self, negocio_id, primer_dia, ultimo_dia, lanzar):
+        """Lanza la precarga con `lanzar()` salvo que esos días estén frescos o ya se estén cargando"""
+        if self.obtener(negocio_id, primer_dia, ultimo_dia) is not None:
+            return
+        with self._lock:
+            if negocio_id in self._precargas:
+                return
+            futuro = lanzar()
+            self._precargas[negocio_id] = (primer_dia, ultimo_dia, futuro)
+        futuro.add_done_callback(lambda f: self._terminar_precarga(negocio_id, f))
+
+    def _terminar_precarga(self, negocio_id, futuro):
+        with self._lock:
+            if self._precargas.get(negocio_id, (None, None, None))[2] is futuro:
+                del self._precargas[negocio_id]
+
+cache_agendas = CacheAgendas(AGENDA_CACHE_TTL)
+_ejecutor_precarga = ThreadPoolExecutor(max_workers=2, thread_name_prefix='precarga')
+
+def _es_medianoche(fecha):
+    return fecha.hour == fecha.minute == fecha.second == fecha.microsecond == 0
+
+def _cargar_agendas(service, negocio, desde, hasta):
+    """Consulta Calendar y, si el rango son días completos, deja el resultado en caché"""
+    generacion = cache_agendas.generacion(negocio.id)
+    agendas = agendas_calendar(service, desde, hasta)
+    if _es_medianoche(desde) and _es_medianoche(hasta):
+        cache_agendas.guardar(negocio.id, desde.toordinal(), hasta.toordinal(), agendas, generacion)
+    return agendas
+
+def consultar_agendas(service, desde, hasta, excepto=None):
+    """
+    Arma la AgendaDia de cada día entre `desde` y `hasta` más las reservas locales.
+    Usa la caché (o espera una precarga en curso) y si no, una sola consulta a
+    Calendar. Devuelve {ordinal: AgendaDia}; las agendas son copias modificables.
+    """
+    negocio = negocio_actual()
+    agendas = None
+    if _es_medianoche(desde) and _es_medianoche(hasta):
+        primer_dia, ultimo_dia = desde.toordinal(), hasta.toordinal()
+        agendas = cache_agendas.obtener(negocio.id, primer_dia, ultimo_dia)
+        precarga = cache_agendas.precarga_en_curso(negocio.id, primer_dia, ultimo_dia) if agendas is None else None
+        if precarga is not None:
+            try:
+                precarga.result(timeout=plazo_restante())
+            except Exception:
+                pass  # Si la precarga falló o tarda, se consulta directamente
+            agendas = cache_agendas.obtener(negocio.id, primer_dia, ultimo_dia)
+    if agendas is None:
+        agendas = _cargar_agendas(service, negocio, desde, hasta)
+    
+    agendas = {dia: agenda.copia() for dia, agenda in agendas.items()}
+    for inicio, fin in negocio.reservas.intervalos(desde, hasta, excepto):
+        _ocupar_en_agendas(agendas, negocio.timezone, datetime.fromtimestamp(inicio, negocio.timezone),
+                           datetime.fromtimestamp(fin, negocio.timezone))
+    return agendas
+
+def precargar_agenda():
+    """
+    Precarga en segundo plano las agendas de los próximos días del negocio en curso,
+    para que la verificación de la fecha que escriba el cliente salga de memoria
+    """
+    if AGENDA_PRECARGA_DIAS <= 0:
+        return
+    service = get_calendar_service()
+    if not service:
+        return
+    negocio = negocio_actual()
+    hoy = datetime.now(negocio.timezone).replace(hour=0, minute=0, second=0, microsecond=0)
+    hasta = hoy + timedelta(days=AGENDA_PRECARGA_DIAS)
+    
+    def precargar():
+        try:
+            _cargar_agendas(service, negocio, hoy, hasta)
+        except Exception as e:
+            logger.warning("⚠️ No se pudo precargar la agenda de %s: %s", negocio.id, e)
+    
+    cache_agendas.iniciar_precarga(
+        negocio.id, hoy.toordinal(), hasta.toordinal(),
+        lambda: _ejecutor_precarga.submit(contextvars.copy_context().run, precargar)
+    )
+
+def sugerir_horarios(agendas, desde, dias, duracion_minutos, limite=3, preferida=None):
+    """
+    Rankea todos los inicios posibles de los próximos `dias` días a partir de `desde`
+    y devuelve los `limite` mejores como datetimes: primero los que menos fragmentan
+    la agenda y, a igual costo, los más cercanos a `preferida` (o los más tempranos).
+    """
+    negocio = negocio_actual()
+    duracion = a_unidades(duracion_minutos, redondear_arriba=True)
+    duracion_minima, duracion_tipica = duraciones_catalogo(negocio)
+    referencia = preferida or desde
+    
+    ranking = []
+    for dia in range(dias):
+        fecha = (desde + timedelta(days=dia)).replace(hour=0, minute=0, second=0, microsecond=0)
+        horario = horario_del_dia(negocio, fecha)
+        if horario is None:
+            continue
+        apertura, cierre = horario
+        if dia == 0:
+            # No sugerir horarios que ya pasaron
+            apertura = max(apertura, a_unidades(desde.hour * 60 + desde.minute, redondear_arriba=True))
+        agenda = agendas.get(fecha.toordinal(), AgendaDia())
+        for costo, inicio in candidatos_dia(agenda, apertura, cierre, duracion, duracion_minima, duracion_tipica):
+            inicio_fecha = negocio.timezone.localize(
+                datetime.combine(fecha.date(), datetime.min.time()) + timedelta(minutes=inicio * UNIDAD_MINUTOS)
+            )
+            ranking.append((dia, costo, abs((inicio_fecha - referencia).total_seconds()), inicio_fecha))
+    
+    ranking.sort(key=lambda candidato: candidato[:3])
+    return [candidato[3] for candidato in ranking[:limite]]
+
+# Lista de espera: margen alrededor de la hora pedida que el cliente acepta
+VENTANA_ESPERA_MINUTOS = int(os.getenv("VENTANA_ESPERA_MINUTOS", "60"))
+
+class EntradaEspera:
+    """Un cliente esperando un horario: inicios aceptables [desde, hasta] en unidades del día"""
+    __slots__ = ('turno', 'llave_dia', 'desde', 'hasta', 'duracion', 'servicio', 'nombre', 'telefono')
+
+    def __init__(self, turno, llave_dia, desde, hasta, duracion, servicio, nombre, telefono):
+        self.turno = turno
+        self.llave_dia = llave_dia
+        self.desde = desde
+        self.hasta = hasta
+        self.duracion = duracion
+        self.servicio = servicio
+        self.nombre = nombre
+        self.telefono = telefono
+
+class ListaEspera:
+    """
+    Clientes esperando que se libere un horario. Se indexan por (negocio, día) y
+    por cada unidad de 15 minutos que su cita podría ocupar, así que al liberarse
+    un horario solo se revisan las cubetas de esas unidades, no la lista entera.
+    Como las reservas, es por proceso.
+
+    También recuerda los horarios ya ofrecidos (apartados a un cliente de la lista)
+    para volver a ofrecerlos si ese cliente dice que no o deja vencer el apartado.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._indice = {}    # (negocio_id, ordinal) -> {unidad: {clave: None}} (en orden de llegada)
+        self._entradas = {}  # clave -> EntradaEspera
+        self._ofertas = {}   # clave -> (negocio, inicio, fin, vence) del horario que se le ofreció
+        self._turnos = itertools.count()
+
+    def agregar(self, clave, negocio_id, fecha, duracion_minutos, conversacion, ventana_minutos):
+        """Anota a `clave` para un horario alrededor de `fecha` (una entrada por cliente)"""
+        minuto = fecha.hour * 60 + fecha.minute
+        duracion = a_unidades(duracion_minutos, redondear_arriba=True)
+        entrada = EntradaEspera(
+            next(self._turnos), (negocio_id, fecha.toordinal()),
+            a_unidades(max(0, minuto - ventana_minutos), redondear_arriba=True),
+            a_unidades(minuto + ventana_minutos), duracion,
+            conversacion.servicio, conversacion.nombre, conversacion.telefono
+        )
+        with self._lock:
+            self._quitar(clave)
+            # "Ayer" según la zona del negocio (la de `fecha`), no la del servidor
+            self._purgar(negocio_id, datetime.now(fecha.tzinfo).toordinal() - 1)
+            cubetas = self._indice.setdefault(entrada.llave_dia, {})
+            for unidad in range(entrada.desde, entrada.hasta + duracion):
+                cubetas.setdefault(unidad, {})[clave] = None
+            self._entradas[clave] = entrada
+
+    def quitar(self, clave):
+        with self._lock:
+            self._quitar(clave)
+
+    def _quitar(self, clave):
+        entrada = self._entradas.pop(clave, None)
+        if entrada is None:
+            return
+        cubetas = self._indice[entrada.llave_dia]
+        for unidad in range(entrada.desde, entrada.hasta + entrada.duracion):
+            cubetas[unidad].pop(clave, None)
+            if not cubetas[unidad]:
+                del cubetas[unidad]
+        if not cubetas:
+            del self._indice[entrada.llave_dia]
+
+    def _purgar(self, negocio_id, ultimo_dia):
+        """Descarta las entradas del negocio de días que ya pasaron"""
+        viejas = {clave for (negocio, dia), cubetas in self._indice.items()
+                  if negocio == negocio_id and dia <= ultimo_dia
+                  for claves in cubetas.values() for clave in claves}
+        for clave in viejas:
+            self._quitar(clave)
+
+    def candidatos(self, negocio_id, inicio, fin):
+        """
+        Clientes cuya cita cabe en el horario liberado [inicio, fin), en orden de
+        llegada, como (clave, entrada, unidad de inicio que se le puede ofrecer).
+        """
+        desde = a_unidades(inicio.hour * 60 + inicio.minute, redondear_arriba=True)
+        hasta = a_unidades(fin.hour * 60 + fin.minute) if fin.date() == inicio.date() else a_unidades(24 * 60)
+        with self._lock:
+            cubetas = self._indice.get((negocio_id, inicio.toordinal()))
+            if not cubetas:
+                return []
+            vistos = {}
+            for unidad in range(desde, hasta):
+                for clave in cubetas.get(unidad, ()):
+                    vistos[clave] = self._entradas[clave]
+        resultado = []
+        for clave, entrada in vistos.items():
+            comienzo = max(entrada.desde, desde)
+            if comienzo <= entrada.hasta and comienzo + entrada.duracion <= hasta:
+                resultado.append((clave, entrada, comienzo))
+        resultado.sort(key=lambda candidato: candidato[1].turno)
+        return resultado
 
-def validar_fecha(fecha):
-    """Valida si una fecha es adecuada para agendar cita"""
-    ahora = datetime.now(TIMEZONE)
-    
-    if not fecha:
-        return False, "No entendí la fecha. Por favor escribe algo como:\n'Mañana a las 10am'\n'Jueves a las 4pm'"
-    
-    if fecha < ahora - timedelta(minutes=30):
-        return False, "⚠️ Esa hora ya pasó. ¿Quieres agendar para otro momento?"
-    
-    if fecha.weekday() < 5:  # Lunes a viernes
-        if fecha.hour < HORA_APERTURA or fecha.hour >= HORA_CIERRE_LUNES_VIERNES:
-            return False, f"⏰ Nuestro horario es de {HORA_APERTURA}am a {HORA_CIERRE_LUNES_VIERNES-12}pm de lunes a viernes. ¿Qué hora te viene bien?"
-    elif fecha.weekday() == 5:  # Sábado
-        if fecha.hour < HORA_APERTURA or fecha.hour >= HORA_CIERRE_SABADO:
-            return False, f"⏰ Nuestro horario el sábado es de {HORA_APERTURA}am a {HORA_CIERRE_SABADO-12}pm. ¿Qué hora te viene bien?"
-    else:
-        return False, "🔒 Solo trabajamos de lunes a sábado. ¿Qué otro día te gustaría?"
-    
-    # Verificar que las citas sean a horas o medias horas
-    if fecha.minute != 0 and fecha.minute != 30:
-        hora_redondeada = fecha.replace(minute=0 if fecha.minute < 30 else 30)
-        return False, f"Programamos citas a horas exactas o medias horas. ¿Te gustaría a las {hora_redondeada.strftime('%H:%M')}?"
-    
-    return True, None
+    def ofrecida(self, clave, negocio, inicio, fin, vence):
+        """Anota que a `clave` se le apartó [inicio, fin) hasta `vence` (segundos epoch)"""
+        with self._lock:
+            self._ofertas[clave] = (negocio, inicio, fin, vence)
+
+    def terminar_oferta(self, clave):
+        """Olvida la oferta de `clave` y la devuelve (o None si no tenía)"""
+        with self._lock:
+            return self._ofertas.pop(clave, None)
 
-def verificar_disponibilidad(fecha, duracion_minutos):
-    """Verifica disponibilidad en el calendario"""
+    def ofertas_vencidas(self, ahora):
+        """Saca y devuelve las ofertas cuyo apartado ya venció, como (clave, oferta)"""
+        with self._lock:
+            vencidas = [(clave, oferta) for clave, oferta in self._ofertas.items() if oferta[3] <= ahora]
+            for clave, _ in vencidas:
+                del self._ofertas[clave]
+        return vencidas
+
+lista_espera = ListaEspera()
+
+def verificar_disponibilidad(fecha, duracion_minutos, excepto=None):
+    """
+    Verifica disponibilidad en el calendario y en las reservas locales
+    (`excepto` es la clave del cliente cuyo propio apartado no cuenta como ocupado).
+    Si el horario no está libre sugiere los que mejor aprovechan los huecos del día,
+    o de la semana si ese día ya no cabe el servicio.
+    
+    Devuelve (disponible, mensaje); disponible es None si no se pudo consultar
+    Calendar (modo degradado) y el mensaje lo explica al cliente.
+    """
     service = get_calendar_service()
     if not service:
         logger.error("❌ No se pudo obtener el servicio de Google Calendar para verificar disponibilidad")
         return True, None  # Permitimos la reserva incluso sin calendario
     
+    negocio = negocio_actual()
     try:
-        tiempo_fin = fecha + timedelta(minutes=duracion_minutos)
+        inicio_dia = fecha.replace(hour=0, minute=0, second=0, microsecond=0)
+        agendas = consultar_agendas(service, inicio_dia, inicio_dia + timedelta(days=1), excepto)
         
-        eventos = service.events().list(
-            calendarId='primary',
-            timeMin=fecha.isoformat(),
-            timeMax=tiempo_fin.isoformat(),
-            singleEvents=True,
-            orderBy='startTime'
-        ).execute()
+        inicio = a_unidades(fecha.hour * 60 + fecha.minute)
+        fin = inicio + a_unidades(duracion_minutos, redondear_arriba=True)
+        horario = horario_del_dia(negocio, fecha)
+        if horario and fin <= horario[1] and agendas.get(fecha.toordinal(), AgendaDia()).libre(inicio, fin):
+            return True, None
         
-        if len(eventos.get('items', [])) > 0:
-            # Sugerir horario alternativo
-            hora_siguiente = buscar_proximo_horario_disponible(service, fecha, duracion_minutos)
-            if hora_siguiente:
-                return False, f"Ese horario ya está ocupado. ¿Te gustaría a las {hora_siguiente.strftime('%H:%M')} del mismo día o prefieres otro día?"
-            else:
-                return False, "Ese horario ya está ocupado. ¿Prefieres otro día?"
+        ahora = datetime.now(negocio.timezone)
+        sugerencias = sugerir_horarios(agendas, max(inicio_dia, ahora), 1, duracion_minutos, preferida=fecha)
+        if sugerencias:
+            horas = ", ".join(s.strftime('%H:%M') for s in sugerencias)
+            return False, f"Ese horario ya está ocupado. Ese día tenemos libre a las {horas}. ¿Te sirve alguno o prefieres otro día?"
         
-        return True, None
-    except HttpError as e:
-        logger.error(f"Error al verificar disponibilidad: {e}")
-        return True, None  # Permitimos la reserva incluso con error
+        # El día está lleno: rankear la semana siguiente con una sola consulta
+        manana = inicio_dia + timedelta(days=1)
+        agendas = consultar_agendas(service, manana, manana + timedelta(days=DIAS_SUGERENCIA), excepto)
+        sugerencias = sugerir_horarios(agendas, manana, DIAS_SUGERENCIA, duracion_minutos)
+        if sugerencias:
+            opciones = "\n".join(f"• {formato_fecha_español(s)}" for s in sugerencias)
+            return False, f"Ese día ya no tenemos lugar. Te puedo ofrecer:\n{opciones}\n¿Cuál prefieres?"
+        return False, "Ese horario ya está ocupado. ¿Prefieres otro día?"
+    except (CalendarNoDisponible, HttpError) as e:
+        logger.error("Error al verificar disponibilidad: %s", e)
+        return None, MENSAJE_CALENDARIO_CAIDO
 
-def buscar_proximo_horario_disponible(service, fecha_inicial, duracion_minutos):
+def buscar_proximo_horario_disponible(service, fecha_inicial, duracion_minutos, excepto=None):
     """Busca el próximo horario disponible en el mismo día"""
-    hora_actual = fecha_inicial
-    hora_cierre = HORA_CIERRE_LUNES_VIERNES if fecha_inicial.weekday() < 5 else HORA_CIERRE_SABADO
-    fin_dia = fecha_inicial.replace(hour=hora_cierre, minute=0)
-    
-    while hora_actual < fin_dia:
-        # Avanzar 30 minutos
-        hora_actual += timedelta(minutes=30)
-        tiempo_fin = hora_actual + timedelta(minutes=duracion_minutos)
-        
-        # Omitir si ya pasamos el horario de cierre
-        if tiempo_fin.hour >= hora_cierre:
-            return None
-            
-        # Verificar si está libre
-        try:
-            eventos = service.events().list(
-                calendarId='primary',
-                timeMin=hora_actual.isoformat(),
-                timeMax=tiempo_fin.isoformat(),
-                singleEvents=True
-            ).execute()
-            
-            if len(eventos.get('items', [])) == 0:
-                return hora_actual
-        except Exception as e:
-            logger.error(f"Error al buscar próximo horario: {e}")
-            return None
+    negocio = negocio_actual()
+    horario = horario_del_dia(negocio, fecha_inicial)
+    if horario is None:
+        return None
     
+    inicio_dia = fecha_inicial.replace(hour=0, minute=0, second=0, microsecond=0)
+    try:
+        agendas = consultar_agendas(service, inicio_dia, inicio_dia + timedelta(days=1), excepto)
+    except Exception as e:
+        logger.error("Error al buscar próximo horario: %s", e)
+        return None
+    
+    agenda = agendas.get(fecha_inicial.toordinal(), AgendaDia())
+    duracion = a_unidades(duracion_minutos, redondear_arriba=True)
+    desde = max(horario[0], a_unidades(fecha_inicial.hour * 60 + fecha_inicial.minute) + 1)
+    for inicio_hueco, fin_hueco in agenda.huecos(desde, horario[1]):
+        if fin_hueco - inicio_hueco >= duracion:
+            return inicio_dia + timedelta(minutes=inicio_hueco * UNIDAD_MINUTOS)
     return None
 
 def mostrar_servicios():
     """Genera texto con los servicios disponibles"""
     servicios_texto = "💈 *Servicios disponibles* 💈\n\n"
-    for servicio, detalles in SERVICIOS.items():
+    for servicio, detalles in negocio_actual().servicios.items():
         servicios_texto += f"• ✂️ {servicio.capitalize()}: {detalles['precio']} ({detalles['duracion']} min)\n"
     servicios_texto += "\n_Responde con el nombre exacto del servicio que deseas_"
     return servicios_texto
 
-def crear_evento_calendario(datos_cita):
-    """Crea un evento en Google Calendar"""
+def mensaje_pedir_fecha(servicio, perfil=None):
+    """Texto que pide la fecha de la cita (con las horas habituales del cliente si lo conocemos)"""
+    duracion = negocio_actual().servicios[servicio]['duracion']
+    texto = (
+        f"¿Cuándo te gustaría agendar tu cita para *{servicio}*?\n\n"
+        f"📅 Nuestro horario es {negocio_actual().horario}\n"
+        f"⏱️ Duración: {duracion} minutos\n\n"
+    )
+    horas = perfil.horas_preferidas() if perfil else []
+    if horas:
+        texto += f"⭐ Normalmente vienes a las {' o a las '.join(horas)}.\n"
+    return texto + "Por favor escribe la fecha y hora (por ejemplo: 'mañana a las 10am', 'jueves a las 4pm')"
+
+def crear_evento_calendario(datos_cita, remitente=None, evento_id=None):
+    """
+    Crea un evento en Google Calendar. Devuelve (exito, evento_id); lanza
+    CalendarNoDisponible si Calendar no responde para que el llamador decida.
+    El `remitente` de WhatsApp se guarda en el evento para las difusiones.
+    Con `evento_id` la inserción es idempotente: si el evento ya existe (409,
+    un intento anterior sí llegó a Calendar) se da por creado.
+    """
+    negocio = negocio_actual()
     service = get_calendar_service()
     if not service:
         logger.error("❌ No se pudo obtener el servicio de Google Calendar")
         return True, "sin-calendario"  # Simulamos éxito para no bloquear al usuario
     
     try:
-        logger.info(f"🔍 Intentando crear evento para {datos_cita['nombre']} el {datos_cita['fecha']}")
+        logger.info("🔍 Intentando crear evento para %s el %s", datos_cita.nombre, datos_cita.fecha)
         
         # Asegurar que la fecha tenga zona horaria
-        fecha_inicio = datos_cita['fecha']
+        fecha_inicio = datos_cita.fecha
         if fecha_inicio.tzinfo is None:
-            fecha_inicio = TIMEZONE.localize(fecha_inicio)
+            fecha_inicio = negocio.timezone.localize(fecha_inicio)
             
-        fecha_fin = fecha_inicio + timedelta(minutes=SERVICIOS[datos_cita['servicio']]['duracion'])
+        fecha_fin = fecha_inicio + timedelta(minutes=negocio.servicios[datos_cita.servicio]['duracion'])
         
         # Modificado: cambio de recordatorio de 24 horas a 5 horas
         evento = {
-            'summary': f"Cita Barbería: {datos_cita['nombre']}",
-            'description': f"Servicio: {datos_cita['servicio']}\nTeléfono: {datos_cita.get('telefono', 'No proporcionado')}",
+            'summary': f"Cita Barbería: {datos_cita.nombre}",
+            'description': f"Servicio: {datos_cita.servicio}\nTeléfono: {datos_cita.telefono or 'No proporcionado'}",
             'start': {
                 'dateTime': fecha_inicio.isoformat(),
-                'timeZone': 'America/Mexico_City',
+                'timeZone': negocio.timezone.zone,
             },
             'end': {
                 'dateTime': fecha_fin.isoformat(),
-                'timeZone': 'America/Mexico_City',
+                'timeZone': negocio.timezone.zone,
             },
             'reminders': {
                 'useDefault': False,
@@ -542,200 +2239,222 @@ def crear_evento_calendario(datos_cita):
             'colorId': '11',  # Color para distinguir citas de barbería
             'status': 'confirmed'
         }
+        if remitente:
+            evento['extendedProperties'] = {'private': {'remitente': remitente}}
+        if evento_id:
+            evento['id'] = evento_id
         
-        logger.info(f"🔍 Datos del evento: {evento}")
+        logger.debug("🔍 Datos del evento: %s", evento)
         
         # Obtener el ID del calendario (puede ser custom o "primary")
-        calendar_id = getattr(service, "_calendar_id", "primary")
-        logger.info(f"✓ Usando calendario con ID: {calendar_id}")
+        calendar_id = calendario_de(service)
+        logger.debug("✓ Usando calendario con ID: %s", calendar_id)
         
         # Insertar el evento en el calendario específico
         try:
-            evento_creado = service.events().insert(
+            evento_creado = ejecutar_calendar(service.events().insert(
                 calendarId=calendar_id,
                 body=evento,
                 sendUpdates='all'
-            ).execute()
+            ), 'events.insert')
             
+            cache_agendas.invalidar(negocio.id, fecha_inicio.toordinal())
             if 'id' in evento_creado:
-                logger.info(f"✅ Evento creado con ID: {evento_creado.get('id')}")
+                logger.info("✅ Evento creado con ID: %s", evento_creado.get('id'))
                 return True, evento_creado.get('id')
             else:
                 logger.error("❌ El evento creado no tiene ID")
                 return True, "error-sin-id"
         except HttpError as e:
+            if evento_id and e.resp.status == 409:
+                logger.info("✅ El evento %s ya existía (reintento de una inserción anterior)", evento_id)
+                cache_agendas.invalidar(negocio.id, fecha_inicio.toordinal())
+                return True, evento_id
             error_content = e.content.decode() if hasattr(e, 'content') else str(e)
-            logger.error(f"❌ Error de Google API al crear evento: {error_content}")
-            
-            # Si el error es de permisos o que el calendario no existe, intentar crear el evento como "freebusy"
-            try:
-                logger.info("🔄 Intentando crear el evento como freebusy sin usar un calendario específico")
-                # Guardar la información localmente como respaldo
-                # En una implementación real, deberías guardar esto en una base de datos
-                return True, f"local-{datetime.now().strftime('%Y%m%d%H%M%S')}"
-            except Exception as e2:
-                logger.error(f"❌ Error al crear evento local: {e2}")
-                return True, "error-local"
+            logger.error("❌ Error de Google API al crear evento: %s", error_content)
+            return False, None
             
+    except CalendarNoDisponible:
+        raise
     except Exception as e:
-        logger.error(f"❌ Error desconocido al crear evento: {e}", exc_info=True)
-        return True, "error-desconocido"  # Simulamos éxito para no bloquear al usuario
+        logger.error("❌ Error desconocido al crear evento: %s", e, exc_info=True)
+        return False, None
 
-def cancelar_cita(remitente):
+def cancelar_cita(clave):
     """Busca y cancela la próxima cita del cliente"""
+    reservas = negocio_actual().reservas
+    conversacion = conversaciones.get(clave) or Conversacion()
+    
     # Para eventos guardados localmente (cuando Google Calendar falla)
-    if 'evento_id' in conversaciones.get(remitente, {}) and conversaciones[remitente]['evento_id'].startswith('local-'):
-        logger.info(f"Cancelando evento local con ID: {conversaciones[remitente]['evento_id']}")
+    if conversacion.evento_id and conversacion.evento_id.startswith('local-'):
+        logger.info("Cancelando evento local con ID: %s", conversacion.evento_id)
+        reservas.liberar_evento(conversacion.evento_id)
+        if clientes is not None:
+            clientes.cancelar(conversacion.evento_id)
         return True, "Tu cita ha sido cancelada exitosamente."
     
     # Para eventos sin ID o con errores
-    if 'evento_id' not in conversaciones.get(remitente, {}) or conversaciones[remitente]['evento_id'] in ["sin-calendario", "error-http", "error-desconocido", "error-permisos", "error-local", "error-sin-id"]:
+    if conversacion.evento_id is None or conversacion.evento_id in EVENTOS_SIN_ID:
         # Intentar encontrar cita por nombre y teléfono
-        if 'nombre' not in conversaciones.get(remitente, {}):
+        if conversacion.nombre is None:
             return False, "No encontramos una cita asociada. Por favor proporciona tu nombre completo."
             
         service = get_calendar_service()
         if not service:
-            return True, "Tu cita ha sido cancelada exitosamente."  # Simulamos éxito
+            # Sin Calendar no podemos borrar el evento: la cita sigue en pie
+            logger.error("❌ Servicio de Calendar no disponible para cancelar la cita de %s", clave)
+            return False, MENSAJE_CALENDARIO_CAIDO
         
         try:
             # Buscar eventos futuros para este cliente
-            ahora = datetime.now(TIMEZONE).isoformat()
-            proxima_semana = (datetime.now(TIMEZONE) + timedelta(days=30)).isoformat()
+            ahora = datetime.now(negocio_actual().timezone).isoformat()
+            proxima_semana = (datetime.now(negocio_actual().timezone) + timedelta(days=30)).isoformat()
             
             # Obtener el ID del calendario
-            calendar_id = getattr(service, "_calendar_id", "primary")
+            calendar_id = calendario_de(service)
             
-            eventos = service.events().list(
+            eventos = ejecutar_calendar(service.events().list(
                 calendarId=calendar_id,
                 timeMin=ahora,
                 timeMax=proxima_semana,
-                q=conversaciones[remitente].get('nombre', ''),
+                q=conversacion.nombre,
                 singleEvents=True,
                 orderBy='startTime'
-            ).execute()
+            ), 'events.list')
             
             if not eventos.get('items', []):
-                return True, "Tu cita ha sido cancelada exitosamente."  # Simulamos éxito
+                return False, "No encontramos citas próximas a tu nombre. Si crees que es un error, contáctanos directamente."
             
             # Cancelar el primer evento encontrado
             evento = eventos['items'][0]
-            service.events().delete(
+            ejecutar_calendar(service.events().delete(
                 calendarId=calendar_id,
                 eventId=evento['id']
-            ).execute()
+            ), 'events.delete')
             
-            logger.info(f"✅ Evento cancelado con ID: {evento['id']}")
+            reservas.liberar_evento(evento['id'])
+            reservas.liberar_evento(conversacion.evento_id, clave)
+            if clientes is not None:
+                clientes.cancelar(evento['id'])
+                if conversacion.evento_id:
+                    clientes.cancelar(conversacion.evento_id, clave)
+            logger.info("✅ Evento cancelado con ID: %s", evento['id'])
+            if 'dateTime' in evento['start']:
+                zona = negocio_actual().timezone
+                inicio = datetime.fromisoformat(evento['start']['dateTime']).astimezone(zona)
+                cache_agendas.invalidar(negocio_actual().id, inicio.toordinal())
+                ofrecer_horario_liberado(inicio, datetime.fromisoformat(evento['end']['dateTime']).astimezone(zona))
             return True, f"Tu cita del {evento['start'].get('dateTime', '').split('T')[0]} a las {evento['start'].get('dateTime', '').split('T')[1][:5]} ha sido cancelada."
             
-        except HttpError as e:
-            logger.error(f"❌ Error de Google API al cancelar cita: {e}", exc_info=True)
-            return True, "Tu cita ha sido cancelada exitosamente."  # Simulamos éxito
+        except (CalendarNoDisponible, HttpError) as e:
+            logger.error("❌ Error de Google API al cancelar cita: %s", e, exc_info=True)
+            return False, "⚠️ No pudimos cancelar tu cita en este momento. Responde 'SI' en unos minutos para intentarlo de nuevo."
     else:
         # Cancelar por ID de evento
         service = get_calendar_service()
         if not service:
-            return True, "Tu cita ha sido cancelada exitosamente."  # Simulamos éxito
+            logger.error("❌ Servicio de Calendar no disponible para cancelar el evento %s", conversacion.evento_id)
+            return False, MENSAJE_CALENDARIO_CAIDO
             
         try:
             # Obtener el ID del calendario
-            calendar_id = getattr(service, "_calendar_id", "primary")
+            calendar_id = calendario_de(service)
             
-            service.events().delete(
+            ejecutar_calendar(service.events().delete(
                 calendarId=calendar_id,
-                eventId=conversaciones[remitente]['evento_id']
-            ).execute()
+                eventId=conversacion.evento_id
+            ), 'events.delete')
             
-            logger.info(f"✅ Evento cancelado con ID: {conversaciones[remitente]['evento_id']}")
+            reservas.liberar_evento(conversacion.evento_id)
+            if clientes is not None:
+                clientes.cancelar(conversacion.evento_id)
+            logger.info("✅ Evento cancelado con ID: %s", conversacion.evento_id)
+            if conversacion.fecha:
+                cache_agendas.invalidar(negocio_actual().id, conversacion.fecha.toordinal())
+            if conversacion.fecha and conversacion.servicio in negocio_actual().servicios:
+                duracion = negocio_actual().servicios[conversacion.servicio]['duracion']
+                ofrecer_horario_liberado(conversacion.fecha, conversacion.fecha + timedelta(minutes=duracion))
             return True, "Tu cita ha sido cancelada exitosamente."
         except HttpError as e:
-            logger.error(f"❌ Error de Google API al cancelar cita por ID: {e}", exc_info=True)
-            return True, "Tu cita ha sido cancelada exitosamente."  # Simulamos éxito
+            if e.resp.status in (404, 410):
+                # El evento ya no existe en Calendar: la cita ya estaba cancelada
+                reservas.liberar_evento(conversacion.evento_id)
+                if clientes is not None:
+                    clientes.cancelar(conversacion.evento_id)
+                return True, "Tu cita ha sido cancelada exitosamente."
+            logger.error("❌ Error de Google API al cancelar cita por ID: %s", e, exc_info=True)
+            return False, "⚠️ No pudimos cancelar tu cita en este momento. Responde 'SI' en unos minutos para intentarlo de nuevo."
+        except CalendarNoDisponible as e:
+            logger.error("❌ Calendar no disponible al cancelar cita por ID: %s", e)
+            return False, "⚠️ No pudimos cancelar tu cita en este momento. Responde 'SI' en unos minutos para intentarlo de nuevo."
 
-def enviar_recordatorio(telefono, cita_info):
-    """Envía un recordatorio de cita por WhatsApp"""
+def enviar_mensaje(destino, cuerpo):
+    """Envía un mensaje proactivo de WhatsApp (fuera de la respuesta al webhook)"""
     if not twilio_client:
-        logger.warning("Cliente Twilio no configurado para enviar recordatorios")
+        logger.warning("Cliente Twilio no configurado para enviar mensajes proactivos")
         return False
-        
-    try:
-        mensaje = MENSAJES["recordatorio"].format(
-            hora=cita_info['fecha'].strftime('%H:%M'),
-            servicio=cita_info['servicio']
-        )
-        
-        twilio_client.messages.create(
-            body=mensaje,
-            from_=TWILIO_PHONE_NUMBER,
-            to=telefono
-        )
-        logger.info(f"✅ Recordatorio enviado a {telefono} para cita a las {cita_info['fecha'].strftime('%H:%M')}")
-        return True
-    except Exception as e:
-        logger.error(f"Error al enviar recordatorio: {e}")
+    return mensajeria.enviar_mensaje(twilio_client, negocio_actual().numero or TWILIO_PHONE_NUMBER, destino, cuerpo)
+
+# Clientes que pidieron no recibir difusiones (uno por línea en E.164, solo se agrega)
+BAJAS_ARCHIVO = os.getenv("BAJAS_ARCHIVO", "bajas.txt")
+bajas = RegistroBajas(BAJAS_ARCHIVO)
+
+def enviar_recordatorio(telefono, cita_info):
+    """Envía un recordatorio de cita por WhatsApp"""
+    mensaje = negocio_actual().mensajes["recordatorio"].format(
+        hora=cita_info.fecha.strftime('%H:%M'),
+        servicio=cita_info.servicio
+    )
+    
+    if not enviar_mensaje(telefono, mensaje):
         return False
+    
+    logger.info("✅ Recordatorio enviado a %s para cita a las %s", telefono, cita_info.fecha.strftime('%H:%M'))
+    return True
 
 def identificar_servicio(mensaje):
     """Identifica el servicio mencionado en el mensaje"""
     mensaje_lower = mensaje.lower().strip()
-    logger.info(f"Identificando servicio en mensaje: {mensaje_lower}")
+    logger.debug("Identificando servicio en mensaje: %s", mensaje_lower)
     
     # Buscar coincidencia exacta primero
-    for servicio in SERVICIOS:
+    for servicio in negocio_actual().servicios:
         if servicio == mensaje_lower:
-            logger.info(f"Servicio identificado (coincidencia exacta): {servicio}")
+            logger.debug("Servicio identificado (coincidencia exacta): %s", servicio)
             return servicio
     
     # Si no hay coincidencia exacta, buscar como substring
-    for servicio in SERVICIOS:
+    for servicio in negocio_actual().servicios:
         if servicio in mensaje_lower:
-            logger.info(f"Servicio identificado (substring): {servicio}")
+            logger.debug("Servicio identificado (substring): %s", servicio)
             return servicio
             
-    logger.info("Ningún servicio identificado")
+    logger.debug("Ningún servicio identificado")
     return None
 
 def obtener_horarios_disponibles(fecha, duracion_servicio=30):
     """
-    Obtiene los horarios disponibles para un día específico
+    Obtiene los horarios disponibles para un día específico (cada 15 minutos)
     """
+    negocio = negocio_actual()
+    horario = horario_del_dia(negocio, fecha)
     service = get_calendar_service()
-    horarios_disponibles = []
-    
-    # Determinar horario de apertura y cierre según el día
-    if fecha.weekday() < 5:  # Lunes a viernes
-        hora_inicio = fecha.replace(hour=HORA_APERTURA, minute=0, second=0, microsecond=0)
-        hora_cierre = fecha.replace(hour=HORA_CIERRE_LUNES_VIERNES, minute=0, second=0, microsecond=0)
-    elif fecha.weekday() == 5:  # Sábado
-        hora_inicio = fecha.replace(hour=HORA_APERTURA, minute=0, second=0, microsecond=0)
-        hora_cierre = fecha.replace(hour=HORA_CIERRE_SABADO, minute=0, second=0, microsecond=0)
-    else:
+    if horario is None or not service:
         return []  # No hay servicio domingo
     
-    hora_actual = hora_inicio
-    while hora_actual < hora_cierre:
-        tiempo_fin = hora_actual + timedelta(minutes=duracion_servicio)
-        
-        # Verificar disponibilidad
-        if tiempo_fin <= hora_cierre:
-            try:
-                eventos = service.events().list(
-                    calendarId='primary',
-                    timeMin=hora_actual.isoformat(),
-                    timeMax=tiempo_fin.isoformat(),
-                    singleEvents=True
-                ).execute()
-                
-                # Si no hay eventos, este horario está disponible
-                if len(eventos.get('items', [])) == 0:
-                    horarios_disponibles.append(hora_actual)
-            
-            except Exception as e:
-                logger.error(f"Error al verificar disponibilidad de {hora_actual}: {e}")
-        
-        # Avanzar 30 minutos
-        hora_actual += timedelta(minutes=30)
+    inicio_dia = fecha.replace(hour=0, minute=0, second=0, microsecond=0)
+    try:
+        agendas = consultar_agendas(service, inicio_dia, inicio_dia + timedelta(days=1))
+    except Exception as e:
+        logger.error("Error al obtener horarios disponibles de %s: %s", fecha.date(), e)
+        return []
     
+    agenda = agendas.get(fecha.toordinal(), AgendaDia())
+    duracion = a_unidades(duracion_servicio, redondear_arriba=True)
+    horarios_disponibles = []
+    for inicio_hueco, fin_hueco in agenda.huecos(*horario):
+        for inicio in range(inicio_hueco, fin_hueco - duracion + 1):
+            horarios_disponibles.append(inicio_dia + timedelta(minutes=inicio * UNIDAD_MINUTOS))
     return horarios_disponibles
 
 def formato_horarios_disponibles(horarios):
@@ -751,62 +2470,814 @@ def formato_horarios_disponibles(horarios):
     
     return mensaje
 
-def reprogramar_cita(remitente):
+def reprogramar_cita(clave):
     """
     Maneja el proceso de reprogramación de cita
     """
-    logger.info(f"Iniciando proceso de reprogramación para {remitente}")
+    logger.info("Iniciando proceso de reprogramación para %s", clave)
     
     # Verificar si existe una cita previa
-    if 'evento_id' not in conversaciones.get(remitente, {}):
-        logger.warning(f"No se encontró evento_id para reprogramar cita de {remitente}")
+    conversacion = conversaciones.get(clave)
+    if conversacion is None or conversacion.evento_id is None:
+        logger.warning("No se encontró evento_id para reprogramar cita de %s", clave)
         return False, "No encontramos una cita activa para reprogramar. ¿Deseas agendar una nueva cita?"
     
     # Obtener los datos de la cita actual antes de cancelarla
-    servicio_actual = conversaciones[remitente].get('servicio')
-    nombre_actual = conversaciones[remitente].get('nombre')
-    telefono_actual = conversaciones[remitente].get('telefono')
-    fecha_actual = conversaciones[remitente].get('fecha')
+    servicio_actual = conversacion.servicio
+    nombre_actual = conversacion.nombre
+    telefono_actual = conversacion.telefono
+    fecha_actual = conversacion.fecha
     
     if fecha_actual:
         fecha_formateada = formato_fecha_español(fecha_actual)
-        logger.info(f"Reprogramando cita del {fecha_formateada} para {nombre_actual}")
+        logger.info("Reprogramando cita del %s para %s", fecha_formateada, nombre_actual)
     
     # 1. Cancelar cita actual
-    exito_cancelacion, mensaje_cancelacion = cancelar_cita(remitente)
+    exito_cancelacion, mensaje_cancelacion = cancelar_cita(clave)
     
     if not exito_cancelacion:
-        logger.error(f"Error al cancelar cita para reprogramación: {mensaje_cancelacion}")
+        logger.error("Error al cancelar cita para reprogramación: %s", mensaje_cancelacion)
         return False, mensaje_cancelacion
     
     # 2. Reiniciar flujo de reserva manteniendo datos del usuario
-    conversaciones[remitente] = {
-        'estado': ESTADOS['solicitando_fecha'],
-        'servicio': servicio_actual,
-        'nombre': nombre_actual,
-        'telefono': telefono_actual,
-        'reprogramando': True,  # Flag para indicar reprogramación
-        'ultimo_mensaje': datetime.now(TIMEZONE)
-    }
+    nueva = Conversacion(ESTADOS['solicitando_fecha'])
+    nueva.servicio = servicio_actual
+    nueva.nombre = nombre_actual
+    nueva.telefono = telefono_actual
+    nueva.reprogramando = True  # Flag para indicar reprogramación
+    with _conversaciones_lock:
+        conversaciones[clave] = nueva
     
     mensaje = (
         f"Cita anterior cancelada. Ahora vamos a reprogramarla.\n\n"
         f"Nombre: {nombre_actual}\n"
         f"Servicio: {servicio_actual}\n"
-        f"Duración: {SERVICIOS[servicio_actual]['duracion']} minutos\n\n"
+        f"Duración: {negocio_actual().servicios[servicio_actual]['duracion']} minutos\n\n"
         f"Por favor, indica la nueva fecha y hora para tu cita:"
     )
     
-    logger.info(f"Proceso de reprogramación iniciado para {remitente}")
+    logger.info("Proceso de reprogramación iniciado para %s", clave)
     return True, mensaje
 
+# Plazo (time.monotonic) del webhook en curso
+_plazo_webhook = contextvars.ContextVar('plazo_webhook', default=None)
+_ejecutor_diferido = ThreadPoolExecutor(max_workers=int(os.getenv("TRABAJOS_DIFERIDOS_MAX", "8")),
+                                        thread_name_prefix='diferido')
+_tokens_pendientes = itertools.count(1)
+
+def plazo_restante():
+    """Segundos que quedan del plazo del webhook en curso (None si no hay plazo)"""
+    limite = _plazo_webhook.get()
+    if limite is None:
+        return None
+    return max(0.0, limite - time.monotonic() - WEBHOOK_MARGEN_SEGUNDOS)
+
+def resolver_con_plazo(clave, destino, trabajo, aplicar, mensaje_espera, descartar=None):
+    """
+    Ejecuta `trabajo` (llamadas a Google Calendar) respetando el plazo del webhook.
+
+    Si termina a tiempo, `aplicar(conversacion, resultado)` actualiza el estado y su
+    texto es la respuesta. Si no, la conversación queda pendiente, se responde con
+    `mensaje_espera` y el texto real se envía a `destino` como mensaje proactivo.
+
+    Si la conversación cambió mientras tanto (reinicio, cancelación, saludo), el
+    resultado no se aplica; `descartar(resultado)` deshace o conserva sus efectos
+    en Calendar y devuelve el aviso para el cliente (o None).
+    """
+    futuro = _ejecutor_diferido.submit(contextvars.copy_context().run, trabajo)
+    try:
+        resultado = futuro.result(timeout=plazo_restante())
+    except FuturesTimeout:
+        with _conversaciones_lock:
+            conversacion = conversaciones.get(clave)
+            token = next(_tokens_pendientes)
+            if conversacion is not None:
+                conversacion.pendiente = token
+        logger.warning("⏳ Plazo del webhook agotado para %s, la respuesta se enviará después", destino)
+        contexto = contextvars.copy_context()
+        futuro.add_done_callback(
+            lambda f: contexto.run(_completar_diferido, clave, destino, conversacion, token, f, aplicar, descartar)
+        )
+        return mensaje_espera
+    
+    with _conversaciones_lock:
+        conversacion = conversaciones.get(clave)
+        if conversacion is not None:
+            return aplicar(conversacion, resultado)
+        # La conversación se reinició en otra petición mientras Calendar respondía
+        logger.warning("Resultado descartado para %s: la conversación ya no existe", clave)
+        aviso = descartar(resultado) if descartar is not None else None
+    return aviso or "Tu conversación se reinició. Escribe 'hola' para comenzar de nuevo."
+
+def _completar_diferido(clave, destino, conversacion, token, futuro, aplicar, descartar=None):
+    """Aplica el resultado de un trabajo diferido y lo envía como mensaje proactivo"""
+    with _conversaciones_lock:
+        if conversacion is None or conversaciones.get(clave) is not conversacion or conversacion.pendiente != token:
+            # El cliente reinició o cambió de flujo mientras tanto: el resultado ya no aplica
+            logger.warning("Resultado diferido descartado para %s: la conversación cambió", clave)
+            texto = None
+            if descartar is not None and futuro.exception() is None:
+                texto = descartar(futuro.result())
+                registrar_conversacion(clave)
+        else:
+            conversacion.pendiente = 0
+            try:
+                texto = aplicar(conversacion, futuro.result())
+            except Exception as e:
+                logger.error("Error en trabajo diferido para %s: %s", clave, e, exc_info=True)
+                conversaciones.pop(clave, None)
+                texto = negocio_actual().mensajes["error"]
+            registrar_conversacion(clave)
+    
+    if texto:
+        enviar_mensaje(destino, texto)
+
+def ofrecer_horario_liberado(inicio, fin):
+    """
+    Ofrece el horario [inicio, fin) que acaba de liberarse a los clientes de la lista
+    de espera a los que les sirva, en orden de llegada: a cada uno se le aparta su
+    parte, su conversación pasa a confirmar la cita y se le avisa con un mensaje
+    proactivo. Si el horario alcanza para varias citas se ofrece a varios clientes.
+    Devuelve las claves a las que se ofreció.
+    """
+    negocio = negocio_actual()
+    ahora = datetime.now(negocio.timezone)
+    inicio_dia = inicio.replace(hour=0, minute=0, second=0, microsecond=0)
+    ofrecidas = []
+    for clave, entrada, unidad in lista_espera.candidatos(negocio.id, inicio, fin):
+        fecha = inicio_dia + timedelta(minutes=unidad * UNIDAD_MINUTOS)
+        if fecha < ahora or entrada.servicio not in negocio.servicios:
+            continue
+        duracion = negocio.servicios[entrada.servicio]['duracion']
+        with _conversaciones_lock:
+            actual = conversaciones.get(clave)
+            # No interrumpir a un cliente que está a media conversación
+            if actual is not None and actual.estado not in (ESTADOS['inicio'], ESTADOS['solicitando_fecha']):
+                continue
+            if not negocio.reservas.apartar(clave, fecha, fecha + timedelta(minutes=duracion)):
+                continue
+            conversacion = Conversacion(ESTADOS['confirmando_cita'])
+            conversacion.servicio = entrada.servicio
+            conversacion.nombre = entrada.nombre
+            conversacion.telefono = entrada.telefono
+            conversacion.fecha = fecha
+            conversaciones[clave] = conversacion
+            registrar_conversacion(clave)
+        lista_espera.quitar(clave)
+        lista_espera.ofrecida(clave, negocio, fecha, fecha + timedelta(minutes=duracion),
+                              time.time() + RESERVA_TTL_MINUTOS * 60)
+        
+        texto = (
+            f"🎉 ¡Se liberó un horario! {entrada.servicio} el {formato_fecha_español(fecha)}.\n\n"
+            f"Te lo apartamos {RESERVA_TTL_MINUTOS} minutos. Responde 'si' para confirmar o 'no' para dejarlo."
+        )
+        _ejecutor_diferido.submit(contextvars.copy_context().run, enviar_mensaje, remitente_de_clave(clave), texto)
+        logger.info("📋 Horario liberado ofrecido a %s de la lista de espera", clave)
+        ofrecidas.append(clave)
+    return ofrecidas
+
+def _ofrecer_de_nuevo(oferta):
+    """Vuelve a pasar por la lista de espera un horario ofrecido que quedó libre"""
+    negocio, inicio, fin, _ = oferta
+    contexto = contextvars.copy_context()
+    contexto.run(_negocio_actual.set, negocio)
+    contexto.run(ofrecer_horario_liberado, inicio, fin)
+
+def soltar_oferta(clave):
+    """El cliente dejó el horario que se le ofreció de la lista de espera: pasa al siguiente"""
+    oferta = lista_espera.terminar_oferta(clave)
+    if oferta is not None:
+        _ofrecer_de_nuevo(oferta)
+
+def soltar_apartado(clave, anterior):
+    """
+    Libera el apartado de una conversación que se reinicia y, si venía de la lista
+    de espera, lo ofrece al siguiente. Si la cita se está creando en Calendar se
+    deja: al terminar, conservar_cita_descartada lo convierte en cita y, si falló,
+    el apartado vence solo.
+    """
+    if anterior is not None and anterior.pendiente and anterior.estado == ESTADOS['confirmando_cita']:
+        return
+    negocio_actual().reservas.liberar(clave)
+    soltar_oferta(clave)
+
+def reofrecer_ofertas_vencidas():
+    """Vuelve a ofrecer los horarios de la lista de espera cuyo apartado venció sin respuesta"""
+    for clave, oferta in lista_espera.ofertas_vencidas(time.time()):
+        negocio, inicio, fin, _ = oferta
+        if negocio.reservas.vigente(clave):
+            # El cliente volvió a apartarlo (respondió 'si' y Calendar tardó): sigue siendo suyo
+            lista_espera.ofrecida(clave, negocio, inicio, fin, time.time() + RESERVA_TTL_MINUTOS * 60)
+            continue
+        logger.info("📋 Venció el horario ofrecido a %s; se ofrece al siguiente de la lista", clave)
+        _ofrecer_de_nuevo(oferta)
+
+def aplicar_disponibilidad(clave, conversacion, fecha, resultado):
+    """Aplica el resultado de verificar_disponibilidad y devuelve la respuesta"""
+    disponible, mensaje_error = resultado
+    if disponible is False:
+        # Se recuerda la hora pedida por si el cliente quiere entrar a la lista de espera
+        conversacion.fecha = fecha
+        return mensaje_error + "\n\nO responde 'lista de espera' y te avisamos si se libera ese horario."
+    if not disponible:
+        return mensaje_error
+    
+    negocio = negocio_actual()
+    servicio = conversacion.servicio
+    duracion = negocio.servicios[servicio]['duracion']
+    
+    # Apartar el horario mientras el cliente confirma
+    if not negocio.reservas.apartar(clave, fecha, fecha + timedelta(minutes=duracion)):
+        return "Ese horario acaba de ser apartado por otro cliente. ¿Te gustaría otro horario?"
+    
+    # Guardar fecha en la conversación
+    conversacion.fecha = fecha
+    conversacion.estado = ESTADOS['confirmando_cita']
+    
+    # Formato amigable de fecha para mostrar
+    formato_fecha = formato_fecha_español(fecha)
+    
+    return (
+        f"¿Confirmas tu cita para {servicio} el {formato_fecha}?\n\n"
+        f"Nombre: {conversacion.nombre}\n"
+        f"Servicio: {servicio}\n"
+        f"Precio: {negocio.servicios[servicio]['precio']}\n"
+        f"Duración: {duracion} minutos\n\n"
+        "Responde 'si' para confirmar o 'no' para cancelar."
+    )
+
+def crear_cita_apartada(clave, conversacion):
+    """
+    Crea el evento de la cita. Antes vuelve a consultar a Calendar el intervalo
+    exacto sin pasar por la caché (aunque el apartado siga vigente, otro worker o el
+    personal pudieron ocuparlo) y, si el apartado expiró, lo vuelve a tomar.
+    Devuelve (exito, evento_id, mensaje); exito es None si Calendar no respondió.
+    """
+    negocio = negocio_actual()
+    duracion = negocio.servicios[conversacion.servicio]['duracion']
+    fecha = conversacion.fecha
+    fin = fecha + timedelta(minutes=duracion)
+    
+    service = get_calendar_service()
+    if service:
+        try:
+            libre = horario_libre_en_calendar(service, fecha, fin, negocio.reservas.id_evento(clave))
+        except (CalendarNoDisponible, HttpError) as e:
+            logger.error("Error al verificar el horario antes de crear la cita: %s", e)
+            return None, None, MENSAJE_CALENDARIO_CAIDO
+        if not libre or negocio.reservas.ocupado(fecha, fin, excepto=clave):
+            negocio.reservas.liberar(clave)
+            lista_espera.terminar_oferta(clave)  # el horario ya no está libre para nadie
+            cache_agendas.invalidar(negocio.id, fecha.toordinal())
+            disponible, mensaje_error = verificar_disponibilidad(fecha, duracion, excepto=clave)
+            if disponible is None:
+                return None, None, mensaje_error
+            return False, None, mensaje_error or "Ese horario acaba de ocuparse. ¿Te gustaría otro horario?"
+    
+    if not negocio.reservas.vigente(clave) and not negocio.reservas.apartar(clave, fecha, fin):
+        return False, None, "Ese horario acaba de ser apartado por otro cliente. ¿Te gustaría otro horario?"
+    
+    try:
+        exito, evento_id = crear_evento_calendario(conversacion, remitente_de_clave(clave),
+                                                   negocio.reservas.id_evento(clave))
+    except CalendarNoDisponible:
+        return None, None, MENSAJE_CALENDARIO_CAIDO
+    return exito, evento_id, None
+
+def aplicar_confirmacion(clave, conversacion, resultado):
+    """Aplica el resultado de crear_cita_apartada y devuelve la respuesta"""
+    negocio = negocio_actual()
+    exito, evento_id, mensaje_ocupado = resultado
+    if exito is None:
+        # Calendar no respondió: se conserva el apartado y el cliente puede volver a confirmar
+        return mensaje_ocupado + "\n\nCuando quieras, responde 'si' para volver a intentarlo."
+    
+    if mensaje_ocupado:
+        # El horario se perdió mientras el cliente confirmaba
+        conversacion.estado = ESTADOS['solicitando_fecha']
+        return mensaje_ocupado
+    
+    if not exito:
+        negocio.reservas.liberar(clave)
+        return "⚠️ Lo sentimos, hubo un problema al registrar tu cita en nuestro calendario. Por favor contáctanos directamente al teléfono de la barbería para confirmar tu cita."
+    
+    conversacion.evento_id = evento_id
+    negocio.reservas.confirmar(clave, evento_id)
+    lista_espera.quitar(clave)
+    lista_espera.terminar_oferta(clave)
+    if clientes is not None:
+        # Se llama con _conversaciones_lock tomado: la escritura en SQLite (que puede esperar
+        # hasta busy_timeout) va al ejecutor con una copia, porque la conversación sigue cambiando
+        copia = Conversacion.desde_bytes(conversacion.a_bytes())
+        _ejecutor_diferido.submit(contextvars.copy_context().run, clientes.registrar_cita, clave, copia)
+    
+    servicio = conversacion.servicio
+    precio = negocio.servicios[servicio]['precio']
+    
+    # Formato amigable de fecha
+    formato_fecha = formato_fecha_español(conversacion.fecha)
+    
+    # Guardar datos por si se necesita cancelar
+    conversacion.estado = ESTADOS['inicio']
+    
+    return negocio.mensajes["confirmacion"].format(
+        fecha=formato_fecha,
+        servicio=servicio,
+        precio=precio
+    )
+
+def conservar_cita_descartada(clave, anterior, resultado):
+    """
+    La cita se creó en Calendar pero el cliente cambió de flujo antes de recibir la
+    confirmación. Como sí había confirmado, se conserva: queda registrada como
+    ocupada, se asocia a su conversación actual para que pueda cancelarla con
+    'cancelar cita' y se devuelve el aviso. Llamar con _conversaciones_lock tomado.
+    """
+    exito, evento_id, _ = resultado
+    if not exito or not evento_id:
+        return None
+    
+    negocio = negocio_actual()
+    fecha = anterior.fecha
+    duracion = negocio.servicios[anterior.servicio]['duracion']
+    negocio.reservas.conservar_evento(clave, evento_id, fecha, fecha + timedelta(minutes=duracion))
+    lista_espera.terminar_oferta(clave)
+    
+    with _conversaciones_lock:
+        actual = conversaciones.get(clave)
+        if actual is None:
+            actual = conversaciones[clave] = Conversacion(ESTADOS['inicio'])
+    actual.evento_id = evento_id
+    if actual.servicio is None:
+        # Sin otra reserva en curso, la conversación queda con los datos de esta cita
+        actual.servicio = anterior.servicio
+        actual.nombre = anterior.nombre
+        actual.telefono = anterior.telefono
+        actual.fecha = fecha
+    logger.info("✅ Cita %s de %s conservada tras cambiar de flujo", evento_id, clave)
+    return (
+        f"✅ Tu cita de {anterior.servicio} el {formato_fecha_español(fecha)} sí quedó registrada.\n"
+        "Si ya no la quieres, responde 'cancelar cita'."
+    )
+
+# Ventana para juntar ráfagas de mensajes de un mismo cliente (0 = desactivado).
+# Cada fecha que llega sola espera la ventana completa, y solo sirve con workers
+# con hilos (gthread): en un worker síncrono el siguiente mensaje no entra hasta que
+# el anterior responde, así que nunca hay nada que juntar
+COALESCER_VENTANA_MS = int(os.getenv("COALESCER_VENTANA_MS", "0"))
+
+class CoalescedorMensajes:
+    """
+    Junta los mensajes que un cliente manda en ráfaga ("el jueves" … "a las 5") en
+    un solo turno. Cada mensaje sube la generación de la ráfaga y espera la ventana:
+    si llega otro mensaje antes, el anterior se retira sin responder y el último
+    procesa el texto completo. Como las reservas, es por proceso.
+
+    "Sin responder" es a propósito: la petición relevada devuelve un TwiML vacío
+    (<Response/>), con el que Twilio no envía nada, y el cliente recibe una sola
+    respuesta, la del último mensaje, en lugar de una por fragmento.
+    """
+
+    def __init__(self, ventana_segundos):
+        self.ventana = ventana_segundos
+        self._condicion = threading.Condition()
+        self._rafagas = {}  # clave -> [generacion, partes]
+
+    def agregar(self, clave, texto):
+        """Suma `texto` a la ráfaga de `clave` y devuelve su generación"""
+        with self._condicion:
+            rafaga = self._rafagas.setdefault(clave, [0, []])
+            rafaga[0] += 1
+            rafaga[1].append(texto)
+            self._condicion.notify_all()
+            return rafaga[0]
+
+    def esperar(self, clave, generacion, limite=None):
+        """
+        Espera la ventana (o `limite` segundos si es menor). Devuelve el texto unido si
+        `generacion` sigue siendo el último mensaje de la ráfaga, o None si otro lo relevó.
+        """
+        espera = self.ventana if limite is None else min(self.ventana, limite)
+        with self._condicion:
+            self._condicion.wait_for(lambda: self._generacion(clave) != generacion, timeout=espera)
+            if self._generacion(clave) != generacion:
+                return None
+            _, partes = self._rafagas.pop(clave)
+        return " ".join(partes)
+
+    def descartar(self, clave):
+        """Abandona la ráfaga en curso de `clave` (reinicio o cambio de flujo)"""
+        with self._condicion:
+            if self._rafagas.pop(clave, None) is not None:
+                self._condicion.notify_all()
+
+    def _generacion(self, clave):
+        rafaga = self._rafagas.get(clave)
+        return rafaga[0] if rafaga else None
+
+coalescedor = CoalescedorMensajes(COALESCER_VENTANA_MS / 1000)
+
+# Límites de tasa de /webhook (0 = sin límite)
+LIMITE_REMITENTE_POR_MINUTO = float(os.getenv("LIMITE_REMITENTE_POR_MINUTO", "20"))
+LIMITE_REMITENTE_RAFAGA = int(os.getenv("LIMITE_REMITENTE_RAFAGA", "5"))  # mensajes seguidos permitidos
+LIMITE_GLOBAL_POR_SEGUNDO = float(os.getenv("LIMITE_GLOBAL_POR_SEGUNDO", "50"))  # por worker
+
+class LimitadorGCRA:
+    """
+    Límite por remitente con GCRA (equivalente a una cubeta de tokens por cliente):
+    de cada remitente solo se guarda un float, el instante teórico de su próximo
+    mensaje. Las entradas que ya quedaron en el pasado no aportan nada y se purgan.
+    """
+
+    def __init__(self, por_minuto, rafaga):
+        self.intervalo = 60.0 / por_minuto
+        self.tolerancia = self.intervalo * (rafaga - 1)
+        self._lock = threading.Lock()
+        self._tat = {}  # remitente -> instante teórico de llegada (time.monotonic)
+        self._ultima_purga = time.monotonic()
+
+    def permitir(self, remitente):
+        """Registra un mensaje de `remitente`; devuelve False si excede su límite"""
+        ahora = time.monotonic()
+        with self._lock:
+            tat = max(self._tat.get(remitente, ahora), ahora)
+            if tat - ahora > self.tolerancia:
+                return False
+            self._tat[remitente] = tat + self.intervalo
+            if ahora - self._ultima_purga > INTERVALO_LIMPIEZA:
+                self._ultima_purga = ahora
+                self._tat = {r: t for r, t in self._tat.items() if t > ahora}
+        return True
+
+limitador_remitentes = LimitadorGCRA(LIMITE_REMITENTE_POR_MINUTO, LIMITE_REMITENTE_RAFAGA) if LIMITE_REMITENTE_POR_MINUTO > 0 else None
+limitador_global = CubetaTokens(LIMITE_GLOBAL_POR_SEGUNDO) if LIMITE_GLOBAL_POR_SEGUNDO > 0 else None
+
+def _twiml_fijo(texto):
+    respuesta = MessagingResponse()
+    respuesta.message(texto)
+    return str(respuesta)
+
+# Respuesta precalculada: rechazar un mensaje no construye TwiML ni toca el estado
+RESPUESTA_LIMITE = _twiml_fijo("⏳ Estás enviando mensajes muy rápido. Espera un momento y vuelve a escribirnos.")
+
+def excede_limite(remitente):
+    """Indica si el mensaje de `remitente` debe rechazarse por límite de tasa"""
+    if limitador_remitentes is not None and not limitador_remitentes.permitir(remitente):
+        logger.info("🚦 Límite por remitente excedido: %s", remitente, extra={'evento': 'limite'})
+        return True
+    if limitador_global is not None and not limitador_global.tomar():
+        logger.info("🚦 Límite global excedido (mensaje de %s)", remitente, extra={'evento': 'limite'})
+        return True
+    return False
+
+# Perfilado bajo demanda de /webhook
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # habilita la cabecera X-Perfil
+METRICAS_PUBLICAS = os.getenv("METRICAS_PUBLICAS", "") == "1"  # /metrics sin token (red interna)
+PERFIL_HABILITADO = os.getenv("PERFIL_HABILITADO", "") == "1"  # perfila todas las peticiones
+PERFIL_MUESTREO = float(os.getenv("PERFIL_MUESTREO", "0"))  # fracción de peticiones perfiladas
+PERFIL_DIR = os.getenv("PERFIL_DIR", "perfiles")
+PERFIL_MAX_ARCHIVOS = max(1, int(os.getenv("PERFIL_MAX_ARCHIVOS", "50")))  # tamaño del anillo en disco (al menos 1)
+_ranura_perfil = itertools.count(random.randrange(PERFIL_MAX_ARCHIVOS))
+# cProfile admite un solo perfilador activo por proceso (ValueError en 3.12+)
+_perfilando = threading.Lock()
+# Un solo hilo escribe los perfiles en disco, fuera de la petición
+_ejecutor_perfiles = ThreadPoolExecutor(max_workers=1, thread_name_prefix='perfiles')
+
+def es_admin():
+    """Indica si la petición trae el token de administrador"""
+    token = request.headers.get('X-Admin-Token') or request.headers.get('X-Perfil')
+    return bool(ADMIN_TOKEN and token and hmac.compare_digest(token, ADMIN_TOKEN))
+
+def debe_perfilar():
+    """Decide si se perfila esta petición (barato cuando el perfilado está apagado)"""
+    if PERFIL_HABILITADO:
+        return True
+    if 'X-Perfil' in request.headers and es_admin():
+        return True
+    return PERFIL_MUESTREO > 0 and random.random() < PERFIL_MUESTREO
+
+def estado_conversacion_actual():
+    """Nombre del estado de la conversación del remitente de la petición"""
+    clave = clave_conversacion(negocio_actual(), request.values.get('From', ''))
+    conversacion = conversaciones.get(clave)
+    return conversacion.estado.name if conversacion is not None else None
+
+def guardar_perfil(perfil, metadatos):
+    """
+    Guarda el perfil (pstats) y sus metadatos en la siguiente ranura del anillo.
+    Corre en _ejecutor_perfiles para no sumar la escritura a la respuesta.
+    """
+    try:
+        os.makedirs(PERFIL_DIR, exist_ok=True)
+        base = os.path.join(PERFIL_DIR, f"perfil-{next(_ranura_perfil) % PERFIL_MAX_ARCHIVOS:03d}")
+        perfil.dump_stats(base + '.pstats')
+        with open(base + '.json', 'w', encoding='utf-8') as f:
+            json.dump(metadatos, f, ensure_ascii=False, indent=2)
+        logger.info("🔬 Perfil guardado en %s.pstats", base)
+    except OSError as e:
+        logger.error("❌ No se pudo guardar el perfil: %s", e)
+
+# Exportación de la agenda para el personal
+AGENDA_COLUMNAS = ['evento_id', 'inicio', 'fin', 'cliente', 'telefono', 'servicio']
+AGENDA_PAGINA = 250  # eventos por página de events.list
+
+def fila_de_evento(evento):
+    """Fila de la agenda a partir de un evento de Calendar"""
+    descripcion = dict(re.findall(r'^(Servicio|Teléfono): *(.*)$', evento.get('description', ''), re.M))
+    cliente = evento.get('summary', '')
+    if cliente.startswith("Cita Barbería: "):
+        cliente = cliente[len("Cita Barbería: "):]
+    return {
+        'evento_id': evento.get('id'),
+        'inicio': evento['start'].get('dateTime') or evento['start'].get('date'),
+        'fin': evento['end'].get('dateTime') or evento['end'].get('date'),
+        'cliente': cliente,
+        'telefono': descripcion.get('Teléfono'),
+        'servicio': descripcion.get('Servicio'),
+    }
+
+def filas_calendar(service, desde, hasta, servicio=None):
+    """Citas de Calendar en [desde, hasta), pidiendo cada página solo cuando se necesita"""
+    token = None
+    while True:
+        eventos = ejecutar_calendar(service.events().list(
+            calendarId=calendario_de(service),
+            timeMin=desde.isoformat(),
+            timeMax=hasta.isoformat(),
+            singleEvents=True,
+            orderBy='startTime',
+            maxResults=AGENDA_PAGINA,
+            pageToken=token
+        ), 'events.list')
+        for evento in eventos.get('items', []):
+            fila = fila_de_evento(evento)
+            if servicio and servicio.lower() not in (fila['servicio'] or '').lower():
+                continue
+            yield fila
+        token = eventos.get('nextPageToken')
+        if not token:
+            break
+
+def filas_locales(desde, hasta, servicio=None):
+    """Citas confirmadas por el bot según la base local de clientes"""
+    zona = negocio_actual().timezone
+    for evento_id, nombre, telefono, servicio_cita, inicio, fin in clientes.iterar_citas(
+            negocio_actual().id, int(desde.timestamp()), int(hasta.timestamp()), servicio):
+        yield {
+            'evento_id': evento_id,
+            'inicio': datetime.fromtimestamp(inicio, zona).isoformat(),
+            'fin': datetime.fromtimestamp(fin, zona).isoformat(),
+            'cliente': nombre,
+            'telefono': telefono,
+            'servicio': servicio_cita,
+        }
+
+def adelantar_primera(filas):
+    """
+    Pide ya la primera fila (la primera página de Calendar), antes de enviar el 200
+    y las cabeceras, para que un Calendar caído se pueda responder como error HTTP.
+    """
+    filas = iter(filas)
+    primera = next(filas, None)
+    return filas if primera is None else itertools.chain([primera], filas)
+
+def serializar_filas(filas, formato):
+    """Convierte las filas en líneas CSV o NDJSON una por una"""
+    if formato == 'ndjson':
+        for fila in filas:
+            yield json.dumps(fila, ensure_ascii=False) + "\n"
+        return
+    
+    salida = io.StringIO()
+    escritor = csv.DictWriter(salida, fieldnames=AGENDA_COLUMNAS)
+    escritor.writeheader()
+    for fila in filas:
+        escritor.writerow(fila)
+        yield salida.getvalue()
+        salida.seek(0)
+        salida.truncate()
+    yield salida.getvalue()
+
+def rango_de_peticion():
+    """(desde, hasta) de los parámetros ?desde=AAAA-MM-DD&hasta=AAAA-MM-DD (hasta incluido)"""
+    zona = negocio_actual().timezone
+    hoy = datetime.now(zona).date()
+    desde = datetime.strptime(request.args['desde'], '%Y-%m-%d').date() if 'desde' in request.args else hoy
+    hasta = datetime.strptime(request.args['hasta'], '%Y-%m-%d').date() if 'hasta' in request.args else desde
+    if hasta < desde:
+        raise ValueError("'hasta' es anterior a 'desde'")
+    return (zona.localize(datetime.combine(desde, datetime.min.time())),
+            zona.localize(datetime.combine(hasta + timedelta(days=1), datetime.min.time())))
+
+@app.route('/admin/agenda', methods=['GET'])
+def exportar_agenda():
+    """
+    Agenda de un rango de fechas en CSV (por defecto) o NDJSON, en streaming.
+    Parámetros: desde, hasta, formato=csv|ndjson, fuente=calendar|local,
+    servicio y negocio (número de la barbería en multi-tenant).
+    """
+    if not es_admin():
+        return Response("No autorizado", status=403)
+    
+    _negocio_actual.set(negocios.resolver(request.args.get('negocio', '')))
+    try:
+        desde, hasta = rango_de_peticion()
+    except ValueError as e:
+        return Response(f"Rango de fechas inválido: {e}", status=400)
+    formato = request.args.get('formato', 'csv')
+    if formato not in ('csv', 'ndjson'):
+        return Response("Formato inválido (csv o ndjson)", status=400)
+    servicio = request.args.get('servicio')
+    
+    if request.args.get('fuente', 'calendar') == 'local':
+        if clientes is None:
+            return Response("La base local de citas no está configurada (CLIENTES_DB)", status=404)
+        filas = filas_locales(desde, hasta, servicio)
+    else:
+        service = get_calendar_service()
+        if not service:
+            return Response("Google Calendar no está disponible", status=503)
+        try:
+            filas = adelantar_primera(filas_calendar(service, desde, hasta, servicio))
+        except CalendarNoDisponible:
+            return Response(MENSAJE_CALENDARIO_CAIDO, status=503)
+        except HttpError as e:
+            logger.error("❌ Error de Google API al exportar la agenda: %s", e)
+            return Response("Error al consultar Google Calendar", status=502)
+    
+    logger.info("📤 Exportando agenda %s a %s (%s)", desde.date(), (hasta - timedelta(days=1)).date(), formato)
+    tipo = 'application/x-ndjson' if formato == 'ndjson' else 'text/csv; charset=utf-8'
+    nombre = f"agenda-{desde.date()}-{(hasta - timedelta(days=1)).date()}.{formato}"
+    return Response(stream_with_context(serializar_filas(filas, formato)), content_type=tipo,
+                    headers={'Content-Disposition': f'attachment; filename="{nombre}"'})
+
+@app.route('/admin/dia', methods=['GET'])
+def vista_dia():
+    """Citas y huecos libres de un día (?fecha=AAAA-MM-DD, por defecto hoy) en JSON"""
+    if not es_admin():
+        return Response("No autorizado", status=403)
+    
+    negocio = negocios.resolver(request.args.get('negocio', ''))
+    _negocio_actual.set(negocio)
+    try:
+        fecha = datetime.strptime(request.args['fecha'], '%Y-%m-%d').date() if 'fecha' in request.args \
+            else datetime.now(negocio.timezone).date()
+    except ValueError:
+        return Response("Fecha inválida (AAAA-MM-DD)", status=400)
+    service = get_calendar_service()
+    if not service:
+        return Response("Google Calendar no está disponible", status=503)
+    
+    inicio_dia = negocio.timezone.localize(datetime.combine(fecha, datetime.min.time()))
+    fin_dia = inicio_dia + timedelta(days=1)
+    try:
+        citas = list(filas_calendar(service, inicio_dia, fin_dia, request.args.get('servicio')))
+        agenda = consultar_agendas(service, inicio_dia, fin_dia).get(fecha.toordinal(), AgendaDia())
+    except CalendarNoDisponible:
+        return Response(MENSAJE_CALENDARIO_CAIDO, status=503)
+    except HttpError as e:
+        logger.error("❌ Error de Google API al consultar el día: %s", e)
+        return Response("Error al consultar Google Calendar", status=502)
+    
+    horario = horario_del_dia(negocio, inicio_dia)
+    libres = [
+        [(inicio_dia + timedelta(minutes=inicio * UNIDAD_MINUTOS)).strftime('%H:%M'),
+         (inicio_dia + timedelta(minutes=fin * UNIDAD_MINUTOS)).strftime('%H:%M')]
+        for inicio, fin in (agenda.huecos(*horario) if horario else ())
+    ]
+    return Response(json.dumps({
+        'negocio': negocio.id,
+        'fecha': fecha.isoformat(),
+        'citas': citas,
+        'libres': libres,
+    }, ensure_ascii=False), content_type='application/json')
+
+@app.route('/metrics', methods=['GET'])
+def metricas():
+    """
+    Exporta el estado del circuito de Calendar en formato de texto de Prometheus.
+    Pide el token de administrador salvo con METRICAS_PUBLICAS=1; sin ninguno de
+    los dos, /metrics queda cerrado.
+    """
+    if not METRICAS_PUBLICAS and not es_admin():
+        return Response("No autorizado", status=403)
+    
+    estado, contadores = circuito_calendar.instantanea()
+    lineas = [
+        "# HELP calendar_circuito_estado Estado del circuit breaker de Calendar (1 = estado actual).",
+        "# TYPE calendar_circuito_estado gauge",
+    ]
+    for nombre in (CircuitoCalendar.CERRADO, CircuitoCalendar.SEMIABIERTO, CircuitoCalendar.ABIERTO):
+        lineas.append(f'calendar_circuito_estado{{estado="{nombre}"}} {int(estado == nombre)}')
+    lineas += [
+        "# HELP calendar_circuito_aperturas_total Veces que se abrió el circuito.",
+        "# TYPE calendar_circuito_aperturas_total counter",
+        f"calendar_circuito_aperturas_total {contadores['aperturas']}",
+        "# HELP calendar_llamadas_total Llamadas a Calendar por resultado.",
+        "# TYPE calendar_llamadas_total counter",
+        f'calendar_llamadas_total{{resultado="exito"}} {contadores["exitos"]}',
+        f'calendar_llamadas_total{{resultado="fallo"}} {contadores["fallos"]}',
+        f'calendar_llamadas_total{{resultado="rechazada"}} {contadores["rechazos"]}',
+        "# HELP calendar_reintentos_total Reintentos de llamadas a Calendar.",
+        "# TYPE calendar_reintentos_total counter",
+        f"calendar_reintentos_total {contadores['reintentos']}",
+        "# HELP logs_descartados_total Registros de log descartados porque la cola estaba llena.",
+        "# TYPE logs_descartados_total counter",
+        f"logs_descartados_total {ColaLogs.descartados}",
+    ]
+    return Response("\n".join(lineas) + "\n", content_type='text/plain; version=0.0.4')
+
+@app.before_request
+def reiniciar_contexto():
+    """
+    Los hilos del servidor (gthread) se reutilizan y los contextvars sobreviven entre
+    peticiones: sin esto una petición de /admin heredaría el negocio y el plazo ya
+    vencido del último webhook, y ejecutar_calendar no reintentaría.
+    """
+    _plazo_webhook.set(None)
+    _negocio_actual.set(NEGOCIO_DEFAULT)
+    _llamadas_calendar.set(None)
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
     """Maneja las solicitudes entrantes de Twilio"""
+    # Identificador que une todas las líneas de log de esta petición
+    token_request_id = request_id_actual.set(
+        request.headers.get('X-Request-Id') or request.values.get('MessageSid') or uuid.uuid4().hex[:12]
+    )
+    try:
+        if not debe_perfilar():
+            return procesar_webhook()
+        return procesar_webhook_perfilado()
+    finally:
+        # Los hilos del servidor se reutilizan: el id no debe pasar a la siguiente petición
+        request_id_actual.reset(token_request_id)
+
+def procesar_webhook_perfilado():
+    """
+    Procesa la petición bajo cProfile y guarda el perfil con sus metadatos.
+    cProfile solo ve el hilo de la petición; lo que corre en el ejecutor diferido
+    (las llamadas a Calendar) queda en los metadatos con su duración por llamada.
+    """
+    if not _perfilando.acquire(blocking=False):
+        logger.debug("🔬 Ya hay una petición perfilándose; esta se procesa sin perfilar")
+        return procesar_webhook()
+    
+    try:
+        _negocio_actual.set(negocios.resolver(request.values.get('To', '')))
+        estado_inicial = estado_conversacion_actual()
+        llamadas = []
+        _llamadas_calendar.set(llamadas)
+        
+        perfil = cProfile.Profile()
+        inicio = time.perf_counter()
+        try:
+            perfil.enable()
+        except ValueError as e:
+            # Otro perfilador (ajeno a este módulo) ya está activo
+            logger.warning("⚠️ No se pudo activar el perfilador: %s", e)
+            _llamadas_calendar.set(None)
+            return procesar_webhook()
+        try:
+            respuesta = procesar_webhook()
+        finally:
+            perfil.disable()
+            _llamadas_calendar.set(None)
+        duracion_ms = (time.perf_counter() - inicio) * 1000
+    finally:
+        _perfilando.release()
+    
+    metadatos = {
+        'request_id': request_id_actual.get(),
+        'fecha': datetime.now(negocio_actual().timezone).isoformat(),
+        'negocio': negocio_actual().id,
+        'duracion_ms': round(duracion_ms, 1),
+        'estado_inicial': estado_inicial,
+        'estado_final': estado_conversacion_actual(),
+        'status': respuesta.status_code,
+    }
+    
+    def escribir():
+        # Para entonces el trabajo diferido suele haber terminado y anotado sus llamadas
+        metadatos['llamadas_calendar'] = len(llamadas)
+        metadatos['calendar'] = list(llamadas)
+        guardar_perfil(perfil, metadatos)
+    _ejecutor_perfiles.submit(escribir)
+    return respuesta
+
+def procesar_webhook():
+    """Procesa un mensaje entrante de Twilio y devuelve la respuesta TwiML"""
     # Verificar que la solicitud viene de Twilio
     if request.method != 'POST':
         return Response("Método no permitido", status=405)
     
+    # Plazo para responder a Twilio
+    _plazo_webhook.set(time.monotonic() + WEBHOOK_PLAZO_SEGUNDOS)
+    
+    # Clientes que inundan el webhook reciben una respuesta fija sin pasar por la máquina de estados
+    if excede_limite(request.values.get('From', '')):
+        return Response(RESPUESTA_LIMITE, content_type='application/xml')
+    
     # Limpiar conversaciones expiradas
     limpiar_conversaciones_expiradas()
     
@@ -815,7 +3286,12 @@ def webhook():
     mensaje_lower = mensaje.lower()
     remitente = request.values.get('From', '')
     
-    logger.info(f"Mensaje recibido de {remitente}: {mensaje}")
+    # Resolver la barbería por el número que recibió el mensaje
+    negocio = negocios.resolver(request.values.get('To', ''))
+    _negocio_actual.set(negocio)
+    clave = clave_conversacion(negocio, remitente)
+    
+    logger.info("Mensaje recibido de %s: %s", remitente, mensaje, extra={'evento': 'mensaje'})
     
     # Inicializar respuesta Twilio
     resp = MessagingResponse()
@@ -823,94 +3299,135 @@ def webhook():
     try:
         # Verificar comandos especiales
         if mensaje_lower in ['reiniciar', 'reset', 'comenzar de nuevo']:
-            if remitente in conversaciones:
-                conversaciones.pop(remitente, None)
-            resp.message(MENSAJES["bienvenida"])
+            with _conversaciones_lock:
+                anterior = conversaciones.pop(clave, None)
+            soltar_apartado(clave, anterior)
+            coalescedor.descartar(clave)
+            lista_espera.quitar(clave)
+            resp.message(negocio.mensajes["bienvenida"])
+            respuesta_str = str(resp)
+            logger.debug("⭐ Respuesta a enviar: %s", respuesta_str)
+            return Response(respuesta_str, content_type='application/xml')
+            
+        if mensaje_lower in PALABRAS_BAJA:
+            bajas.agregar(remitente)
+            resp.message("Listo, ya no te enviaremos promociones ni avisos. Tus citas siguen igual; escribe 'hola' cuando quieras agendar.")
             respuesta_str = str(resp)
-            logger.info(f"⭐ Respuesta a enviar: {respuesta_str}")
+            logger.debug("⭐ Respuesta a enviar: %s", respuesta_str)
             return Response(respuesta_str, content_type='application/xml')
             
         if 'cancelar cita' in mensaje_lower or 'cancelar mi cita' in mensaje_lower:
-            if remitente in conversaciones:
-                conversaciones[remitente]['estado'] = ESTADOS['solicitud_cancelacion']
-            else:
-                conversaciones[remitente] = {
-                    'estado': ESTADOS['solicitud_cancelacion'],
-                    'ultimo_mensaje': datetime.now(TIMEZONE)
-                }
+            with _conversaciones_lock:
+                if clave in conversaciones:
+                    conversaciones[clave].estado = ESTADOS['solicitud_cancelacion']
+                    conversaciones[clave].pendiente = 0  # Descarta cualquier respuesta diferida
+                else:
+                    conversaciones[clave] = Conversacion(ESTADOS['solicitud_cancelacion'])
+            coalescedor.descartar(clave)
             resp.message("¿Estás seguro que deseas cancelar tu cita? Responde 'SI' para confirmar.")
             respuesta_str = str(resp)
-            logger.info(f"⭐ Respuesta a enviar: {respuesta_str}")
+            logger.debug("⭐ Respuesta a enviar: %s", respuesta_str)
             return Response(respuesta_str, content_type='application/xml')
         
         # Añadir manejo de solicitud de reprogramación
         if 'reprogramar cita' in mensaje_lower or 'cambiar cita' in mensaje_lower or 'mover cita' in mensaje_lower:
-            if remitente in conversaciones:
-                conversaciones[remitente]['estado'] = ESTADOS['solicitud_reprogramacion']
-            else:
-                conversaciones[remitente] = {
-                    'estado': ESTADOS['solicitud_reprogramacion'],
-                    'ultimo_mensaje': datetime.now(TIMEZONE)
-                }
+            with _conversaciones_lock:
+                if clave in conversaciones:
+                    conversaciones[clave].estado = ESTADOS['solicitud_reprogramacion']
+                    conversaciones[clave].pendiente = 0  # Descarta cualquier respuesta diferida
+                else:
+                    conversaciones[clave] = Conversacion(ESTADOS['solicitud_reprogramacion'])
+            coalescedor.descartar(clave)
             resp.message("¿Estás seguro que deseas reprogramar tu cita? Responde 'SI' para confirmar.")
             respuesta_str = str(resp)
-            logger.info(f"⭐ Respuesta a enviar: {respuesta_str}")
+            logger.debug("⭐ Respuesta a enviar: %s", respuesta_str)
             return Response(respuesta_str, content_type='application/xml')
             
         # Manejo de saludos iniciales
-        if remitente not in conversaciones or any(saludo in mensaje_lower for saludo in 
+        if clave not in conversaciones or any(saludo in mensaje_lower for saludo in 
                                 ['hola', 'holi', 'buenos días', 'buenas tardes', 'buenas noches', 'buen día']):
-            conversaciones[remitente] = {
-                'estado': ESTADOS['inicio'],
-                'ultimo_mensaje': datetime.now(TIMEZONE)
-            }
-            resp.message(MENSAJES["bienvenida"])
+            # El saludo reinicia: el horario apartado vuelve a estar libre
+            with _conversaciones_lock:
+                anterior = conversaciones.get(clave)
+                conversaciones[clave] = Conversacion(ESTADOS['inicio'])
+            soltar_apartado(clave, anterior)
+            resp.message(negocio.mensajes["bienvenida"])
             respuesta_str = str(resp)
-            logger.info(f"⭐ Respuesta a enviar: {respuesta_str}")
+            logger.debug("⭐ Respuesta a enviar: %s", respuesta_str)
             return Response(respuesta_str, content_type='application/xml')
         
         # Actualizar timestamp del último mensaje
-        if remitente in conversaciones:
-            conversaciones[remitente]['ultimo_mensaje'] = datetime.now(TIMEZONE)
-        else:
-            # Si no existe la conversación, inicializarla
-            conversaciones[remitente] = {
-                'estado': ESTADOS['inicio'],
-                'ultimo_mensaje': datetime.now(TIMEZONE)
-            }
+        with _conversaciones_lock:
+            if clave in conversaciones:
+                conversaciones[clave].tocar()
+            else:
+                # Si no existe la conversación, inicializarla
+                conversaciones[clave] = Conversacion(ESTADOS['inicio'])
+            conversacion = conversaciones[clave]
         
-        estado_actual = conversaciones[remitente].get('estado', ESTADOS['inicio'])
+        # Mientras un trabajo diferido siga en curso, el estado no debe avanzar
+        with _conversaciones_lock:
+            if conversacion.pendiente:
+                resp.message("⏳ Seguimos procesando tu solicitud, en un momento te respondemos.")
+                return Response(str(resp), content_type='application/xml')
+        
+        estado_actual = conversacion.estado
         
         # Flujo principal de conversación
         if estado_actual == ESTADOS['inicio']:
-            if ('servicio' in mensaje_lower or 'precio' in mensaje_lower or 
-                'qué hacen' in mensaje_lower or 'servicios' in mensaje_lower or
-                'cuales son tus servicios' in mensaje_lower):
-                conversaciones[remitente]['estado'] = ESTADOS['listando_servicios']
+            pide_servicios = ('servicio' in mensaje_lower or 'precio' in mensaje_lower or 
+                              'qué hacen' in mensaje_lower or 'servicios' in mensaje_lower or
+                              'cuales son tus servicios' in mensaje_lower)
+            pide_cita = ('agendar' in mensaje_lower or 'cita' in mensaje_lower or 'reservar' in mensaje_lower or
+                         'lo de siempre' in mensaje_lower)
+            # Un cliente conocido no vuelve a dar nombre ni teléfono
+            perfil = perfil_cliente(clave) if pide_servicios or pide_cita else None
+            if perfil:
+                conversacion.nombre = perfil.nombre
+                conversacion.telefono = perfil.telefono
+            
+            if perfil and 'lo de siempre' in mensaje_lower and perfil.ultimo_servicio in negocio.servicios:
+                conversacion.servicio = perfil.ultimo_servicio
+                conversacion.estado = ESTADOS['solicitando_fecha']
+                resp.message(mensaje_pedir_fecha(perfil.ultimo_servicio, perfil))
+            elif pide_servicios:
+                conversacion.estado = ESTADOS['listando_servicios']
                 resp.message(mostrar_servicios())
-            elif 'agendar' in mensaje_lower or 'cita' in mensaje_lower or 'reservar' in mensaje_lower:
-                conversaciones[remitente].update({
-                    'estado': ESTADOS['solicitando_nombre'],
-                    'servicio': None,
-                })
+            elif pide_cita and perfil:
+                conversacion.estado = ESTADOS['listando_servicios']
+                conversacion.servicio = None
+                texto = f"¡Qué gusto verte de nuevo, {perfil.nombre}! ¿Qué servicio quieres esta vez?"
+                if perfil.ultimo_servicio in negocio.servicios:
+                    texto += f"\nEscribe 'lo de siempre' para *{perfil.ultimo_servicio}*."
+                resp.message(texto + "\n\n" + mostrar_servicios())
+            elif pide_cita:
+                conversacion.estado = ESTADOS['solicitando_nombre']
+                conversacion.servicio = None
                 resp.message("✍️ Por favor dime tu nombre para agendar tu cita:")
             else:
-                resp.message(
-                    "¡Bienvenido a Barbería d' Leo! ✂️\n\n"
-                    "Puedes preguntar por:\n"
-                    "* 'servicios' para ver opciones\n"
-                    "* 'agendar' para reservar cita\n\n"
-                    f"{HORARIO_TEXTO}\n\n"
-                    "Por favor escribe una de estas opciones."
-                )
+                resp.message(negocio.mensajes["bienvenida"] + "\n\nPor favor escribe una de estas opciones.")
         
         elif estado_actual == ESTADOS['listando_servicios']:
             servicio_identificado = identificar_servicio(mensaje_lower)
-            if servicio_identificado:
-                conversaciones[remitente].update({
-                    'estado': ESTADOS['solicitando_nombre'],
-                    'servicio': servicio_identificado,
-                })
+            perfil = None
+            if conversacion.nombre and conversacion.telefono:
+                perfil = perfil_cliente(clave)
+                if not servicio_identificado and perfil and 'lo de siempre' in mensaje_lower \
+                        and perfil.ultimo_servicio in negocio.servicios:
+                    servicio_identificado = perfil.ultimo_servicio
+            
+            if servicio_identificado and conversacion.nombre and conversacion.telefono:
+                # Ya tenemos sus datos: directo a la fecha
+                conversacion.estado = ESTADOS['solicitando_fecha']
+                conversacion.servicio = servicio_identificado
+                resp.message(mensaje_pedir_fecha(servicio_identificado, perfil))
+            elif servicio_identificado and conversacion.nombre:
+                conversacion.estado = ESTADOS['solicitando_telefono']
+                conversacion.servicio = servicio_identificado
+                resp.message(f"Perfecto, *{servicio_identificado}*. Por favor comparte un número de teléfono:")
+            elif servicio_identificado:
+                conversacion.estado = ESTADOS['solicitando_nombre']
+                conversacion.servicio = servicio_identificado
                 resp.message(f"✍️ Por favor dime tu nombre para agendar tu *{servicio_identificado}*:")
             elif 'agendar' in mensaje_lower or 'cita' in mensaje_lower:
                 resp.message("Por favor elige primero un servicio:\n\n" + mostrar_servicios())
@@ -924,13 +3441,13 @@ def webhook():
             if len(mensaje) < 3:
                 resp.message("Por favor proporciona tu nombre completo.")
             else:
-                conversaciones[remitente]['nombre'] = mensaje
+                conversacion.nombre = mensaje
                 
-                if conversaciones[remitente].get('servicio') is None:
-                    conversaciones[remitente]['estado'] = ESTADOS['listando_servicios']
+                if conversacion.servicio is None:
+                    conversacion.estado = ESTADOS['listando_servicios']
                     resp.message(f"Gracias {mensaje}. Ahora elige el servicio que deseas:\n\n" + mostrar_servicios())
                 else:
-                    conversaciones[remitente]['estado'] = ESTADOS['solicitando_telefono']
+                    conversacion.estado = ESTADOS['solicitando_telefono']
                     resp.message(f"Gracias {mensaje}. Por favor comparte un número de teléfono:")
             
         elif estado_actual == ESTADOS['solicitando_telefono']:
@@ -939,20 +3456,32 @@ def webhook():
             if len(telefono_limpio) < 8:
                 resp.message("Por favor proporciona un número de teléfono válido.")
             else:
-                conversaciones[remitente]['telefono'] = telefono_limpio
-                conversaciones[remitente]['estado'] = ESTADOS['solicitando_fecha']
-                
-                servicio = conversaciones[remitente]['servicio']
-                duracion = SERVICIOS[servicio]['duracion']
+                conversacion.telefono = telefono_limpio
+                conversacion.estado = ESTADOS['solicitando_fecha']
+                resp.message(mensaje_pedir_fecha(conversacion.servicio))
                 
+        elif estado_actual == ESTADOS['solicitando_fecha'] and 'lista de espera' in mensaje_lower:
+            if conversacion.fecha is None:
+                resp.message("Primero dime qué día y hora te gustaría, y si está ocupado te anoto en la lista de espera.")
+            else:
+                duracion = negocio.servicios[conversacion.servicio]['duracion']
+                lista_espera.agregar(clave, negocio.id, conversacion.fecha, duracion, conversacion, VENTANA_ESPERA_MINUTOS)
+                conversacion.estado = ESTADOS['inicio']
                 resp.message(
-                    f"¿Cuándo te gustaría agendar tu cita para *{servicio}*?\n\n"
-                    f"📅 Nuestro horario es {HORARIO}\n"
-                    f"⏱️ Duración: {duracion} minutos\n\n"
-                    "Por favor escribe la fecha y hora (por ejemplo: 'mañana a las 10am', 'jueves a las 4pm')"
+                    f"📋 Listo, estás en lista de espera para el {formato_fecha_español(conversacion.fecha)} "
+                    f"(hasta {VENTANA_ESPERA_MINUTOS} minutos antes o después). Si se libera un horario te escribimos."
                 )
-                
+        
         elif estado_actual == ESTADOS['solicitando_fecha']:
+            # Juntar la fecha que llega en varios mensajes seguidos en un solo turno
+            if coalescedor.ventana > 0:
+                generacion = coalescedor.agregar(clave, mensaje)
+                mensaje = coalescedor.esperar(clave, generacion, plazo_restante())
+                if mensaje is None:
+                    # Un mensaje posterior de la ráfaga responde por todos: TwiML vacío, Twilio no envía nada
+                    logger.debug("Mensaje de %s unido a la ráfaga en curso", remitente)
+                    return Response(str(resp), content_type='application/xml')
+            
             # Parsear fecha del mensaje
             fecha = parsear_fecha(mensaje)
             valido, mensaje_error = validar_fecha(fecha)
@@ -960,61 +3489,33 @@ def webhook():
             if not valido:
                 resp.message(mensaje_error)
             else:
-                servicio = conversaciones[remitente]['servicio']
-                duracion = SERVICIOS[servicio]['duracion']
+                duracion = negocio.servicios[conversacion.servicio]['duracion']
                 
-                # Verificar disponibilidad
-                disponible, mensaje_error = verificar_disponibilidad(fecha, duracion)
-                
-                if not disponible:
-                    resp.message(mensaje_error)
-                else:
-                    # Guardar fecha en la conversación
-                    conversaciones[remitente]['fecha'] = fecha
-                    conversaciones[remitente]['estado'] = ESTADOS['confirmando_cita']
-                    
-                    # Formato amigable de fecha para mostrar
-                    formato_fecha = formato_fecha_español(fecha)
-                    
-                    resp.message(
-                        f"¿Confirmas tu cita para {servicio} el {formato_fecha}?\n\n"
-                        f"Nombre: {conversaciones[remitente]['nombre']}\n"
-                        f"Servicio: {servicio}\n"
-                        f"Precio: {SERVICIOS[servicio]['precio']}\n"
-                        f"Duración: {duracion} minutos\n\n"
-                        "Responde 'si' para confirmar o 'no' para cancelar."
-                    )
+                # Verificar disponibilidad (si Calendar tarda, la respuesta llega después)
+                resp.message(resolver_con_plazo(
+                    clave, remitente,
+                    lambda: verificar_disponibilidad(fecha, duracion, excepto=clave),
+                    lambda conv, resultado: aplicar_disponibilidad(clave, conv, fecha, resultado),
+                    "⏳ Estamos verificando tu horario… te escribimos en un momento."
+                ))
         
         elif estado_actual == ESTADOS['confirmando_cita']:
-            logger.info(f"⭐ Procesando confirmación: '{mensaje_lower}'")
+            logger.debug("⭐ Procesando confirmación: '%s'", mensaje_lower)
             if mensaje_lower in ['si', 'sí', 'confirmo', 'aceptar', 'ok']:
-                logger.info(f"⭐ Respuesta reconocida como confirmación")
-                # Crear evento en calendario
-                exito, evento_id = crear_evento_calendario(conversaciones[remitente])
-                
-                if exito:
-                    conversaciones[remitente]['evento_id'] = evento_id
-                    
-                    servicio = conversaciones[remitente]['servicio']
-                    fecha = conversaciones[remitente]['fecha']
-                    precio = SERVICIOS[servicio]['precio']
-                    
-                    # Formato amigable de fecha
-                    formato_fecha = formato_fecha_español(fecha)
-                    
-                    resp.message(MENSAJES["confirmacion"].format(
-                        fecha=formato_fecha,
-                        servicio=servicio,
-                        precio=precio
-                    ))
-                    
-                    # Guardar datos por si se necesita cancelar
-                    conversaciones[remitente]['estado'] = ESTADOS['inicio']
-                else:
-                    resp.message("⚠️ Lo sentimos, hubo un problema al registrar tu cita en nuestro calendario. Por favor contáctanos directamente al teléfono de la barbería para confirmar tu cita.")
+                logger.debug("⭐ Respuesta reconocida como confirmación")
+                # Crear evento en calendario (si Calendar tarda, la confirmación llega después)
+                resp.message(resolver_con_plazo(
+                    clave, remitente,
+                    lambda: crear_cita_apartada(clave, conversacion),
+                    lambda conv, resultado: aplicar_confirmacion(clave, conv, resultado),
+                    "⏳ Estamos registrando tu cita… te confirmamos en un momento.",
+                    descartar=lambda resultado: conservar_cita_descartada(clave, conversacion, resultado)
+                ))
             
             elif mensaje_lower in ['no', 'cancelar', 'back', 'regresar']:
-                conversaciones[remitente]['estado'] = ESTADOS['solicitando_fecha']
+                negocio.reservas.liberar(clave)
+                soltar_oferta(clave)
+                conversacion.estado = ESTADOS['solicitando_fecha']
                 resp.message("Entendido. Por favor indica otra fecha y hora que te convenga:")
             
             else:
@@ -1022,57 +3523,68 @@ def webhook():
         
         elif estado_actual == ESTADOS['solicitud_cancelacion']:
             if mensaje_lower in ['si', 'sí', 'confirmo', 'ok']:
-                exito, mensaje_resultado = cancelar_cita(remitente)
+                exito, mensaje_resultado = cancelar_cita(clave)
                 if exito:
                     # Si se canceló exitosamente, reiniciar conversación
-                    if remitente in conversaciones:
-                        conversaciones.pop(remitente, None)
+                    with _conversaciones_lock:
+                        conversaciones.pop(clave, None)
                     resp.message(f"{mensaje_resultado}\n\nSi deseas agendar una nueva cita, escribe 'agendar'.")
                 else:
                     resp.message(mensaje_resultado)
             else:
-                conversaciones[remitente]['estado'] = ESTADOS['inicio']
+                conversacion.estado = ESTADOS['inicio']
                 resp.message("Cancelación abortada. ¿En qué más te puedo ayudar?")
         
         # Añadir el nuevo estado para manejo de reprogramación
         elif estado_actual == ESTADOS['solicitud_reprogramacion']:
             if mensaje_lower in ['si', 'sí', 'confirmo', 'ok']:
-                exito, mensaje_resultado = reprogramar_cita(remitente)
+                exito, mensaje_resultado = reprogramar_cita(clave)
                 if exito:
                     resp.message(mensaje_resultado)
                 else:
                     resp.message(mensaje_resultado)
                     # Si no se pudo reprogramar, volver al estado inicial
-                    conversaciones[remitente]['estado'] = ESTADOS['inicio']
+                    conversacion.estado = ESTADOS['inicio']
             else:
-                conversaciones[remitente]['estado'] = ESTADOS['inicio']
+                conversacion.estado = ESTADOS['inicio']
                 resp.message("Reprogramación cancelada. ¿En qué más te puedo ayudar?")
         
+        # Al acercarse la pregunta de la fecha, precargar la agenda para responderla desde memoria
+        actual = conversaciones.get(clave)
+        if actual is not None and actual.estado != estado_actual and \
+                actual.estado in (ESTADOS['solicitando_telefono'], ESTADOS['solicitando_fecha']):
+            precargar_agenda()
+        
         # Logging y envío de respuesta
         respuesta_str = str(resp)
-        logger.info(f"⭐ Respuesta a enviar: {respuesta_str}")
+        logger.debug("⭐ Respuesta a enviar: %s", respuesta_str)
         
         return Response(respuesta_str, content_type='application/xml')
     
     except Exception as e:
-        logger.error(f"Error en webhook: {e}", exc_info=True)
-        if remitente in conversaciones:
-            conversaciones.pop(remitente, None)
-        resp.message(MENSAJES["error"])
+        logger.error("Error en webhook: %s", e, exc_info=True)
+        with _conversaciones_lock:
+            conversaciones.pop(clave, None)
+        resp.message(negocio.mensajes["error"])
         respuesta_str = str(resp)
-        logger.info(f"⭐ Respuesta de error: {respuesta_str}")
+        logger.debug("⭐ Respuesta de error: %s", respuesta_str)
         return Response(respuesta_str, content_type='application/xml')
     
     except Exception as e:
-        logger.error(f"Error en webhook: {e}", exc_info=True)
-        if remitente in conversaciones:
-            conversaciones.pop(remitente, None)
-        resp.message(MENSAJES["error"])
+        logger.error("Error en webhook: %s", e, exc_info=True)
+        with _conversaciones_lock:
+            conversaciones.pop(clave, None)
+        resp.message(negocio.mensajes["error"])
         respuesta_str = str(resp)
-        logger.info(f"⭐ Respuesta de error: {respuesta_str}")
+        logger.debug("⭐ Respuesta de error: %s", respuesta_str)
         return Response(respuesta_str, content_type='application/xml')
+    
+    finally:
+        # Persistir la transición para sobrevivir a un deploy o crash
+        registrar_conversacion(clave)
 
 # Agrega esto si necesitas ejecutar la aplicación directamente
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
+    iniciar_diario()
     app.run(host="0.0.0.0", port=port, debug=False)
\ No newline at end of file
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pytest
+
+# server.py vive en la raíz del repositorio
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class RelojFalso:
+    """Sustituye al módulo time de server: el tiempo solo avanza con `avanzar`"""
+
+    def __init__(self, inicio=1_700_000_000.0):
+        self.ahora = inicio
+
+    def time(self):
+        return self.ahora
+
+    def monotonic(self):
+        return self.ahora
+
+    def perf_counter(self):
+        return self.ahora
+
+    def sleep(self, segundos):
+        self.ahora += segundos
+
+    def avanzar(self, segundos):
+        self.ahora += segundos
+
+@pytest.fixture
+def server():
+    """El módulo server (se omiten las pruebas si faltan sus dependencias)"""
+    return pytest.importorskip("server")
+
+@pytest.fixture
+def reloj(server, monkeypatch):
+    reloj = RelojFalso()
+    monkeypatch.setattr(server, 'time', reloj)
+    return reloj
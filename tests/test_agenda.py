@@ -0,0 +1,70 @@
+import pytest
+
+@pytest.fixture
+def agenda(server):
+    return server.AgendaDia()
+
+def intervalos(agenda):
+    return list(zip(agenda.inicios, agenda.fines))
+
+def test_ocupar_fusiona_solapados_y_contiguos(agenda):
+    agenda.ocupar(40, 44)
+    agenda.ocupar(50, 52)
+    agenda.ocupar(44, 46)  # contiguo al primero
+    assert intervalos(agenda) == [(40, 46), (50, 52)]
+    agenda.ocupar(45, 51)  # une los dos
+    assert intervalos(agenda) == [(40, 52)]
+
+def test_ocupar_intervalo_que_cubre_varios(agenda):
+    for inicio in (40, 44, 48):
+        agenda.ocupar(inicio, inicio + 2)
+    agenda.ocupar(36, 60)
+    assert intervalos(agenda) == [(36, 60)]
+
+def test_ocupar_en_orden_inverso_mantiene_listas_ordenadas(agenda):
+    for inicio in (60, 50, 40):
+        agenda.ocupar(inicio, inicio + 2)
+    assert intervalos(agenda) == [(40, 42), (50, 52), (60, 62)]
+
+def test_ocupar_intervalo_vacio_no_hace_nada(agenda):
+    agenda.ocupar(40, 40)
+    agenda.ocupar(42, 41)
+    assert intervalos(agenda) == []
+
+def test_libre_en_los_bordes(agenda):
+    agenda.ocupar(40, 44)
+    assert agenda.libre(36, 40)   # termina justo donde empieza lo ocupado
+    assert agenda.libre(44, 48)   # empieza justo donde termina
+    assert not agenda.libre(43, 45)
+    assert not agenda.libre(36, 41)
+    assert not agenda.libre(41, 42)  # dentro
+    assert not agenda.libre(30, 50)  # lo cubre entero
+
+def test_libre_en_agenda_vacia(agenda):
+    assert agenda.libre(0, 96)
+
+def test_huecos_dentro_del_horario(agenda):
+    agenda.ocupar(30, 38)  # antes de abrir y hasta las 9:30
+    agenda.ocupar(44, 48)
+    agenda.ocupar(70, 80)  # pasa del cierre
+    assert list(agenda.huecos(36, 76)) == [(38, 44), (48, 70)]
+
+def test_copia_es_independiente(agenda):
+    agenda.ocupar(40, 44)
+    copia = agenda.copia()
+    copia.ocupar(50, 52)
+    assert intervalos(agenda) == [(40, 44)]
+
+def test_candidatos_dia_prefiere_no_dejar_huecos_inservibles(server, agenda):
+    # Hueco de 9:00 a 10:00 (4 unidades) para un servicio de 2 unidades
+    agenda.ocupar(40, 44)
+    candidatos = dict((inicio, costo) for costo, inicio in server.candidatos_dia(agenda, 36, 40, 2, 2, 2))
+    assert sorted(candidatos) == [36, 37, 38]
+    # Pegado a un borde no deja unidades muertas; en medio deja una a cada lado
+    assert candidatos[36] == (0, 0, 1)
+    assert candidatos[38] == (0, 0, 1)
+    assert candidatos[37] == (2, 2, 2)
+
+def test_candidatos_dia_sin_espacio(server, agenda):
+    agenda.ocupar(36, 76)
+    assert list(server.candidatos_dia(agenda, 36, 76, 2, 2, 2)) == []
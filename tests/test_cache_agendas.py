@@ -0,0 +1,31 @@
+from concurrent.futures import Future
+
+def test_cache_agendas_caduca(server, reloj):
+    cache = server.CacheAgendas(ttl=60)
+    cache.guardar('n', 10, 12, {}, cache.generacion('n'))
+    assert set(cache.obtener('n', 10, 12)) == {10, 11}
+    assert cache.obtener('n', 10, 13) is None  # falta un día
+    reloj.avanzar(60)
+    assert cache.obtener('n', 10, 12) is None
+
+def test_cache_agendas_descarta_consultas_anteriores_a_una_escritura(server, reloj):
+    cache = server.CacheAgendas(ttl=60)
+    generacion = cache.generacion('n')
+    cache.invalidar('n', 10)  # se creó una cita mientras se consultaba Calendar
+    cache.guardar('n', 10, 12, {}, generacion)
+    assert cache.obtener('n', 10, 12) is None
+    cache.guardar('n', 10, 12, {}, cache.generacion('n'))
+    assert cache.obtener('n', 10, 12) is not None
+
+def test_cache_agendas_una_precarga_a_la_vez(server, reloj):
+    cache = server.CacheAgendas(ttl=60)
+    futuro = Future()
+    lanzadas = []
+    lanzar = lambda: lanzadas.append(1) or futuro
+    cache.iniciar_precarga('n', 10, 17, lanzar)
+    cache.iniciar_precarga('n', 10, 17, lanzar)
+    assert len(lanzadas) == 1
+    assert cache.precarga_en_curso('n', 11, 12) is futuro
+    assert cache.precarga_en_curso('n', 9, 12) is None
+    futuro.set_result(None)
+    assert cache.precarga_en_curso('n', 11, 12) is None
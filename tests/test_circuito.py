@@ -0,0 +1,118 @@
+import contextlib
+import types
+from datetime import datetime, timedelta
+
+import pytest
+
+@pytest.fixture
+def circuito(server, reloj):
+    return server.CircuitoCalendar(umbral=3, enfriamiento=30)
+
+def test_se_abre_tras_fallos_seguidos(circuito):
+    for _ in range(2):
+        assert circuito.permitir()
+        circuito.fallo()
+    assert circuito.estado == circuito.CERRADO
+    circuito.permitir()
+    circuito.fallo()
+    assert circuito.estado == circuito.ABIERTO
+    assert not circuito.permitir()
+    assert circuito.contadores['aperturas'] == 1
+    assert circuito.contadores['rechazos'] == 1
+
+def test_un_exito_reinicia_la_cuenta(circuito):
+    for _ in range(2):
+        circuito.permitir()
+        circuito.fallo()
+    circuito.permitir()
+    circuito.exito()
+    circuito.permitir()
+    circuito.fallo()
+    assert circuito.estado == circuito.CERRADO
+
+def abrir(circuito):
+    for _ in range(circuito.umbral):
+        circuito.permitir()
+        circuito.fallo()
+
+def test_semiabierto_deja_pasar_una_sola_prueba(circuito, reloj):
+    abrir(circuito)
+    reloj.avanzar(30)
+    assert circuito.permitir()
+    assert circuito.estado == circuito.SEMIABIERTO
+    assert not circuito.permitir()  # la prueba sigue en curso
+    circuito.exito()
+    assert circuito.estado == circuito.CERRADO
+    assert circuito.permitir()
+
+def test_prueba_fallida_vuelve_a_abrir(circuito, reloj):
+    abrir(circuito)
+    reloj.avanzar(30)
+    circuito.permitir()
+    circuito.fallo()
+    assert circuito.estado == circuito.ABIERTO
+    assert circuito.contadores['aperturas'] == 2
+    reloj.avanzar(29)
+    assert not circuito.permitir()
+
+class Peticion:
+    def __init__(self, *resultados):
+        self.resultados = list(resultados)
+        self.llamadas = 0
+
+    def execute(self, http=None):
+        self.llamadas += 1
+        resultado = self.resultados.pop(0)
+        if isinstance(resultado, Exception):
+            raise resultado
+        return resultado
+
+@pytest.fixture
+def ejecutar(server, reloj, circuito, monkeypatch):
+    monkeypatch.setattr(server, 'circuito_calendar', circuito)
+    monkeypatch.setattr(server, '_calendar_pool', types.SimpleNamespace(transporte=contextlib.nullcontext))
+    return server.ejecutar_calendar
+
+def test_reintenta_fallos_transitorios_incluida_la_insercion(server, ejecutar):
+    peticion = Peticion(OSError("reset"), {'id': 'evento1'})
+    assert ejecutar(peticion, 'events.insert') == {'id': 'evento1'}
+    assert peticion.llamadas == 2
+
+def test_agotar_reintentos_lanza_calendar_no_disponible(server, ejecutar, circuito, monkeypatch):
+    monkeypatch.setattr(server, 'CALENDAR_REINTENTOS', 1)
+    peticion = Peticion(OSError("reset"), OSError("reset"))
+    with pytest.raises(server.CalendarNoDisponible):
+        ejecutar(peticion, 'events.list')
+    assert peticion.llamadas == 2
+    assert circuito.contadores['reintentos'] == 1
+
+def test_circuito_abierto_no_llama(server, ejecutar, circuito):
+    abrir(circuito)
+    peticion = Peticion({'items': []})
+    with pytest.raises(server.CalendarNoDisponible):
+        ejecutar(peticion, 'events.list')
+    assert peticion.llamadas == 0
+
+def test_cancelar_sin_calendar_no_simula_exito(server, monkeypatch):
+    clave = 'whatsapp:+5215512345678'
+    conversacion = server.Conversacion(server.Estado.inicio)
+    conversacion.nombre = 'Ana'
+    conversacion.evento_id = 'evento1'
+    monkeypatch.setattr(server, 'conversaciones', {clave: conversacion})
+    monkeypatch.setattr(server, 'get_calendar_service', lambda: None)
+    assert server.cancelar_cita(clave) == (False, server.MENSAJE_CALENDARIO_CAIDO)
+    conversacion.evento_id = 'sin-calendario'
+    assert server.cancelar_cita(clave) == (False, server.MENSAJE_CALENDARIO_CAIDO)
+
+def test_id_evento_estable_mientras_el_apartado_es_el_mismo(server, reloj):
+    tabla = server.TablaReservas(ttl_segundos=300)
+    inicio = server.TIMEZONE.localize(datetime.fromtimestamp(reloj.ahora) + timedelta(days=1))
+    fin = inicio + timedelta(minutes=30)
+    tabla.apartar('a', inicio, fin)
+    evento_id = tabla.id_evento('a')
+    tabla.apartar('a', inicio, fin)
+    assert tabla.id_evento('a') == evento_id
+    tabla.apartar('a', fin, fin + timedelta(minutes=30))
+    assert tabla.id_evento('a') != evento_id
+    tabla.liberar('a')
+    assert tabla.id_evento('a') is None
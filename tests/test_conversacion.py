@@ -0,0 +1,34 @@
+from datetime import datetime
+
+import pytest
+
+def test_conversacion_ida_y_vuelta(server):
+    conversacion = server.Conversacion(server.Estado.confirmando_cita, ultimo_mensaje=1_700_000_000)
+    conversacion.servicio = 'corte de cabello'
+    conversacion.nombre = 'José Peña'
+    conversacion.telefono = None
+    conversacion.evento_id = 'abc123'
+    conversacion.reprogramando = True
+    conversacion.fecha = server.TIMEZONE.localize(datetime(2030, 1, 2, 10, 15))
+    conversacion.pendiente = 7
+
+    copia = server.Conversacion.desde_bytes(conversacion.a_bytes())
+    assert copia.estado is server.Estado.confirmando_cita
+    assert copia.ultimo_mensaje == 1_700_000_000
+    assert (copia.servicio, copia.nombre, copia.telefono, copia.evento_id) == ('corte de cabello', 'José Peña', None, 'abc123')
+    assert copia.reprogramando
+    assert copia.fecha == conversacion.fecha
+    assert copia.pendiente == 0  # el trabajo diferido no se serializa
+
+def test_conversacion_recorta_sin_partir_caracteres(server):
+    conversacion = server.Conversacion()
+    conversacion.nombre = 'ñ' * 40000  # 80000 bytes
+    nombre = server.Conversacion.desde_bytes(conversacion.a_bytes()).nombre
+    assert set(nombre) == {'ñ'}
+    assert len(nombre.encode('utf-8')) < 0xFFFF
+
+def test_conversacion_version_desconocida(server):
+    datos = bytearray(server.Conversacion().a_bytes())
+    datos[0] = 99
+    with pytest.raises(ValueError):
+        server.Conversacion.desde_bytes(bytes(datos))
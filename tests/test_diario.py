@@ -0,0 +1,131 @@
+import threading
+
+import pytest
+
+TTL = 3600
+
+@pytest.fixture
+def abrir(server, tmp_path):
+    """Abre diarios sobre el mismo archivo, como lo harían varios workers o un reinicio"""
+    abiertos = []
+
+    def abrir(compactar_cada=1000, ranuras=2):
+        diario = server.DiarioConversaciones(str(tmp_path / 'conversaciones'), 3600, compactar_cada, ranuras)
+        vivas = {}
+        diario.iniciar(vivas, threading.RLock(), TTL)
+        abiertos.append(diario)
+        return diario, vivas
+
+    yield abrir
+    for diario in abiertos:
+        diario.detener()
+        if diario._cerrojo is not None:
+            diario._cerrojo.close()
+
+def conversacion(server, nombre, ultimo_mensaje=None):
+    conversacion = server.Conversacion(server.Estado.solicitando_fecha, ultimo_mensaje=ultimo_mensaje)
+    conversacion.nombre = nombre
+    return conversacion
+
+def reiniciar(diario):
+    """Simula la muerte del worker: suelta su ranura sin escribir nada más"""
+    diario._cerrojo.close()
+    diario._cerrojo = None
+
+def test_recupera_guardados_y_borrados(server, abrir):
+    diario, vivas = abrir()
+    vivas['a'] = conversacion(server, 'Ana')
+    vivas['b'] = conversacion(server, 'Beto')
+    diario.guardar('a', vivas['a'])
+    diario.guardar('b', vivas['b'])
+    diario.borrar('b')
+    diario.vaciar()
+    reiniciar(diario)
+
+    _, recuperadas = abrir()
+    assert set(recuperadas) == {'a'}
+    assert recuperadas['a'].nombre == 'Ana'
+    assert recuperadas['a'].estado is server.Estado.solicitando_fecha
+
+def test_descarta_expiradas_y_cola_truncada(server, abrir):
+    diario, vivas = abrir()
+    vivas['vieja'] = conversacion(server, 'Vieja', ultimo_mensaje=int(server.time.time()) - 2 * TTL)
+    vivas['nueva'] = conversacion(server, 'Nueva')
+    diario.guardar('vieja', vivas['vieja'])
+    diario.guardar('nueva', vivas['nueva'])
+    diario.vaciar()
+    # Un crash a media escritura deja un registro incompleto al final
+    with open(diario.ruta, 'ab') as f:
+        f.write(diario._codificar(diario.OP_GUARDAR, 'rota', b'x' * 20)[:-5])
+    reiniciar(diario)
+
+    _, recuperadas = abrir()
+    assert set(recuperadas) == {'nueva'}
+
+def test_compacta_al_superar_el_limite(server, abrir):
+    diario, vivas = abrir(compactar_cada=3)
+    for nombre in ('a', 'b', 'c'):
+        vivas[nombre] = conversacion(server, nombre)
+        diario.guardar(nombre, vivas[nombre])
+    del vivas['a']
+    diario.borrar('a')
+    generacion = diario._generacion
+    diario.vaciar()
+
+    assert diario._generacion == generacion + 1
+    assert diario._escritos == 0
+    # El diario queda solo con la cabecera de la nueva generación
+    assert [op for op, _, _ in diario._leer_registros(diario.ruta)] == [diario.OP_GENERACION]
+    reiniciar(diario)
+
+    _, recuperadas = abrir()
+    assert set(recuperadas) == {'b', 'c'}
+
+def test_compactar_no_falla_si_cambian_las_conversaciones(server, abrir, monkeypatch):
+    diario, vivas = abrir()
+    vivas.update({str(n): conversacion(server, str(n)) for n in range(50)})
+    original = server.Conversacion.a_bytes
+
+    def a_bytes_que_agrega(self):
+        # Alguien agrega una conversación mientras se escribe el snapshot
+        vivas.setdefault('intrusa', conversacion(server, 'intrusa'))
+        return original(self)
+
+    monkeypatch.setattr(server.Conversacion, 'a_bytes', a_bytes_que_agrega)
+    with diario._lock_archivo:
+        diario._compactar()
+    assert 'intrusa' in vivas
+
+def test_el_escritor_sobrevive_a_errores(server, abrir, monkeypatch):
+    diario, vivas = abrir()
+    vivas['a'] = conversacion(server, 'Ana')
+    diario.guardar('a', vivas['a'])
+
+    def fallar():
+        raise RuntimeError("snapshot roto")
+
+    monkeypatch.setattr(diario, '_compactar', fallar)
+    monkeypatch.setattr(diario, 'compactar_cada', 1)
+    diario.vaciar()  # registra el error sin propagarlo
+
+    monkeypatch.undo()
+    diario.guardar('a', vivas['a'])
+    diario.vaciar()
+    reiniciar(diario)
+    _, recuperadas = abrir()
+    assert set(recuperadas) == {'a'}
+
+def test_ranuras_por_worker_gana_el_ultimo_mensaje(server, abrir):
+    primero, _ = abrir()
+    segundo, _ = abrir()
+    assert primero.ruta != segundo.ruta
+
+    primero.guardar('a', conversacion(server, 'vieja', ultimo_mensaje=int(server.time.time()) - 60))
+    segundo.guardar('a', conversacion(server, 'reciente'))
+    primero.vaciar()
+    segundo.vaciar()
+    reiniciar(primero)
+    reiniciar(segundo)
+
+    _, recuperadas = abrir()
+    assert recuperadas['a'].nombre == 'reciente'
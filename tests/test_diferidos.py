@@ -0,0 +1,104 @@
+import contextvars
+import threading
+
+import pytest
+
+CLAVE = 'whatsapp:+5215512345678'
+
+class Enviados(list):
+    def __init__(self):
+        super().__init__()
+        self.listo = threading.Event()
+
+@pytest.fixture
+def enviados(server, monkeypatch):
+    """Mensajes proactivos enviados; `listo` se activa con el primero"""
+    enviados = Enviados()
+
+    def enviar(destino, cuerpo):
+        enviados.append((destino, cuerpo))
+        enviados.listo.set()
+        return True
+
+    monkeypatch.setattr(server, 'enviar_mensaje', enviar)
+    monkeypatch.setattr(server, 'diario', None)
+    monkeypatch.setattr(server, 'conversaciones', {})
+    return enviados
+
+def resolver_sin_plazo(server, *args, **kwargs):
+    """resolver_con_plazo con el plazo del webhook ya agotado"""
+    def correr():
+        server._plazo_webhook.set(server.time.monotonic() - 1)
+        return server.resolver_con_plazo(*args, **kwargs)
+    return contextvars.copy_context().run(correr)
+
+def test_resultado_a_tiempo_se_aplica(server, enviados):
+    conversacion = server.conversaciones[CLAVE] = server.Conversacion()
+    texto = server.resolver_con_plazo(
+        CLAVE, CLAVE, lambda: 'libre', lambda c, r: f"aplicado {r}", "espera")
+    assert texto == "aplicado libre"
+    assert conversacion.pendiente == 0
+    assert enviados == []
+
+def test_resultado_tardio_se_envia_como_mensaje(server, enviados):
+    conversacion = server.conversaciones[CLAVE] = server.Conversacion()
+    terminar = threading.Event()
+
+    def trabajo():
+        terminar.wait(5)
+        return 'libre'
+
+    def aplicar(conv, resultado):
+        conv.servicio = resultado
+        return f"aplicado {resultado}"
+
+    assert resolver_sin_plazo(server, CLAVE, CLAVE, trabajo, aplicar, "espera") == "espera"
+    assert conversacion.pendiente
+
+    terminar.set()
+    assert enviados.listo.wait(5)
+    assert enviados == [(CLAVE, "aplicado libre")]
+    assert conversacion.pendiente == 0
+    assert conversacion.servicio == 'libre'
+
+def test_resultado_tardio_se_descarta_si_la_conversacion_cambio(server, enviados):
+    server.conversaciones[CLAVE] = server.Conversacion()
+    terminar = threading.Event()
+    aplicados, descartados = [], []
+
+    def trabajo():
+        terminar.wait(5)
+        return 'evento-1'
+
+    def aplicar(conv, resultado):
+        aplicados.append(resultado)
+        return "aplicado"
+
+    def descartar(resultado):
+        descartados.append(resultado)
+        return "Tu cita no se creó porque reiniciaste la conversación."
+
+    assert resolver_sin_plazo(server, CLAVE, CLAVE, trabajo, aplicar, "espera", descartar) == "espera"
+    # El cliente escribe 'hola' antes de que Calendar responda
+    server.conversaciones[CLAVE] = server.Conversacion()
+
+    terminar.set()
+    assert enviados.listo.wait(5)
+    assert aplicados == []
+    assert descartados == ['evento-1']
+    assert enviados == [(CLAVE, "Tu cita no se creó porque reiniciaste la conversación.")]
+
+def test_error_en_trabajo_tardio_reinicia_la_conversacion(server, enviados):
+    server.conversaciones[CLAVE] = server.Conversacion()
+    terminar = threading.Event()
+
+    def trabajo():
+        terminar.wait(5)
+        raise RuntimeError("Calendar caído")
+
+    assert resolver_sin_plazo(server, CLAVE, CLAVE, trabajo, lambda c, r: "aplicado", "espera") == "espera"
+
+    terminar.set()
+    assert enviados.listo.wait(5)
+    assert CLAVE not in server.conversaciones
+    assert enviados == [(CLAVE, server.negocio_actual().mensajes["error"])]
@@ -0,0 +1,122 @@
+import csv
+import io
+import json
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+@pytest.fixture
+def clientes(server, tmp_path, monkeypatch):
+    registro = server.RegistroClientes(str(tmp_path / 'clientes.db'))
+    monkeypatch.setattr(server, 'clientes', registro)
+    return registro
+
+@pytest.fixture
+def manana(server):
+    return server.TIMEZONE.localize(datetime(2030, 1, 2, 10, 0))
+
+def cita(server, nombre, fecha, evento_id, servicio='corte de cabello'):
+    conversacion = server.Conversacion(server.Estado.inicio)
+    conversacion.nombre = nombre
+    conversacion.telefono = '5512345678'
+    conversacion.servicio = servicio
+    conversacion.fecha = fecha
+    conversacion.evento_id = evento_id
+    return conversacion
+
+def test_citas_sin_id_de_calendar_no_se_pisan(server, clientes, manana):
+    clientes.registrar_cita('a', cita(server, 'Ana', manana, 'sin-calendario'))
+    clientes.registrar_cita('b', cita(server, 'Beto', manana + timedelta(hours=1), 'sin-calendario'))
+    clientes.registrar_cita('c', cita(server, 'Caro', manana + timedelta(hours=2), 'evento1'))
+    desde, hasta = manana - timedelta(hours=1), manana + timedelta(hours=5)
+    assert [fila['cliente'] for fila in server.filas_locales(desde, hasta)] == ['Ana', 'Beto', 'Caro']
+
+    clientes.cancelar('sin-calendario', 'a')
+    clientes.cancelar('evento1')
+    filas = list(server.filas_locales(desde, hasta))
+    assert [(fila['cliente'], fila['evento_id']) for fila in filas] == [('Beto', 'sin-calendario')]
+    assert filas[0]['inicio'] == (manana + timedelta(hours=1)).isoformat()
+    assert filas[0]['fin'] == (manana + timedelta(hours=1, minutes=30)).isoformat()
+
+def test_filas_locales_filtra_por_servicio(server, clientes, manana):
+    clientes.registrar_cita('a', cita(server, 'Ana', manana, 'evento1'))
+    clientes.registrar_cita('b', cita(server, 'Beto', manana, 'evento2', servicio='corte de barba'))
+    filas = server.filas_locales(manana, manana + timedelta(days=1), 'barba')
+    assert [fila['cliente'] for fila in filas] == ['Beto']
+
+def test_migra_la_tabla_de_citas_anterior(server, tmp_path, manana):
+    ruta = str(tmp_path / 'anterior.db')
+    conexion = sqlite3.connect(ruta)
+    conexion.execute(
+        "CREATE TABLE citas (evento_id TEXT PRIMARY KEY, negocio TEXT, clave TEXT, nombre TEXT, telefono TEXT,"
+        " servicio TEXT, barbero TEXT, inicio INTEGER, fin INTEGER, cancelada INTEGER NOT NULL DEFAULT 0)")
+    conexion.execute("INSERT INTO citas (evento_id, negocio, clave, nombre, inicio, fin) VALUES (?, ?, ?, ?, ?, ?)",
+                     ('evento1', server.NEGOCIO_DEFAULT.id, 'a', 'Ana', int(manana.timestamp()), int(manana.timestamp())))
+    conexion.commit()
+    conexion.close()
+
+    registro = server.RegistroClientes(ruta)
+    assert [fila[:2] for fila in registro.iterar_citas(server.NEGOCIO_DEFAULT.id, 0, 2 ** 40)] == [('evento1', 'Ana')]
+    registro.cancelar('evento1')
+    assert list(registro.iterar_citas(server.NEGOCIO_DEFAULT.id, 0, 2 ** 40)) == []
+
+def test_fila_de_evento(server):
+    fila = server.fila_de_evento({
+        'id': 'evento1',
+        'summary': 'Cita Barbería: José Peña',
+        'description': 'Cliente: José Peña\nServicio: corte de cabello\nTeléfono: 5512345678',
+        'start': {'dateTime': '2030-01-02T10:00:00-06:00'},
+        'end': {'dateTime': '2030-01-02T10:30:00-06:00'},
+    })
+    assert fila == {
+        'evento_id': 'evento1',
+        'inicio': '2030-01-02T10:00:00-06:00',
+        'fin': '2030-01-02T10:30:00-06:00',
+        'cliente': 'José Peña',
+        'telefono': '5512345678',
+        'servicio': 'corte de cabello',
+    }
+    assert list(fila) == server.AGENDA_COLUMNAS
+
+FILAS = [
+    {'evento_id': 'evento1', 'inicio': '10:00', 'fin': '10:30', 'cliente': 'Peña, José',
+     'telefono': None, 'servicio': 'corte de cabello'},
+    {'evento_id': 'evento2', 'inicio': '11:00', 'fin': '11:30', 'cliente': 'Ana',
+     'telefono': '5512345678', 'servicio': 'corte de barba'},
+]
+
+def test_serializar_csv(server):
+    partes = list(server.serializar_filas(iter(FILAS), 'csv'))
+    filas = list(csv.DictReader(io.StringIO(''.join(partes))))
+    assert [fila['cliente'] for fila in filas] == ['Peña, José', 'Ana']
+    assert filas[0]['telefono'] == ''
+    assert len(partes) == len(FILAS) + 1  # una parte por fila, la cabecera va con la primera
+
+def test_serializar_ndjson(server):
+    lineas = list(server.serializar_filas(iter(FILAS), 'ndjson'))
+    assert [json.loads(linea) for linea in lineas] == FILAS
+    assert all(linea.endswith('\n') for linea in lineas)
+
+def test_serializar_sin_filas(server):
+    assert ''.join(server.serializar_filas(iter([]), 'csv')).strip() == ','.join(server.AGENDA_COLUMNAS)
+    assert list(server.serializar_filas(iter([]), 'ndjson')) == []
+
+def test_adelantar_primera_consulta_antes_de_responder(server):
+    pedidas = []
+
+    def filas():
+        pedidas.append(1)
+        yield from FILAS
+
+    adelantadas = server.adelantar_primera(filas())
+    assert pedidas == [1]
+    assert list(adelantadas) == FILAS
+
+def test_adelantar_primera_propaga_el_error(server):
+    def filas():
+        raise server.CalendarNoDisponible("circuito abierto")
+        yield
+
+    with pytest.raises(server.CalendarNoDisponible):
+        server.adelantar_primera(filas())
@@ -0,0 +1,29 @@
+from datetime import datetime
+
+def test_fallback_pasa_los_idiomas_como_argumento(server, monkeypatch):
+    llamadas = []
+
+    def parse(texto, languages=None, settings=None):
+        llamadas.append((languages, settings))
+        return None
+
+    monkeypatch.setattr(server.dateparser, 'parse', parse)
+    assert server.parsear_fecha_detallado("el día de la madre") == (None, 'dateparser')
+    (languages, settings), = llamadas
+    assert languages == ['es', 'en']
+    assert 'languages' not in settings
+    assert settings['RELATIVE_BASE'].tzinfo is None
+
+def test_fallback_que_falla_se_cuenta_como_dateparser(server, monkeypatch):
+    def parse(*args, **kwargs):
+        raise ValueError("settings inválidos")
+
+    monkeypatch.setattr(server.dateparser, 'parse', parse)
+    assert server.parsear_fecha_detallado("el día de la madre") == (None, 'dateparser')
+
+def test_patrones_propios_no_llegan_al_fallback(server, monkeypatch):
+    monkeypatch.setattr(server.dateparser, 'parse', None)
+    ahora = server.TIMEZONE.localize(datetime(2030, 1, 2, 9, 0))
+    fecha, resolutor = server.parsear_fecha_detallado("mañana a las 4pm", ahora=ahora)
+    assert resolutor == 'mañana'
+    assert (fecha.day, fecha.hour) == (3, 16)
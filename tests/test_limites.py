@@ -0,0 +1,33 @@
+def test_gcra_permite_la_rafaga_y_luego_rechaza(server, reloj):
+    limitador = server.LimitadorGCRA(por_minuto=6, rafaga=3)
+    assert [limitador.permitir('a') for _ in range(4)] == [True, True, True, False]
+
+def test_gcra_recupera_un_mensaje_por_intervalo(server, reloj):
+    limitador = server.LimitadorGCRA(por_minuto=6, rafaga=3)  # un mensaje cada 10 s
+    for _ in range(3):
+        limitador.permitir('a')
+    reloj.avanzar(9)
+    assert not limitador.permitir('a')
+    reloj.avanzar(1)
+    assert limitador.permitir('a')
+    assert not limitador.permitir('a')
+
+def test_gcra_rafaga_completa_tras_inactividad(server, reloj):
+    limitador = server.LimitadorGCRA(por_minuto=6, rafaga=3)
+    for _ in range(3):
+        limitador.permitir('a')
+    reloj.avanzar(3600)
+    assert [limitador.permitir('a') for _ in range(4)] == [True, True, True, False]
+
+def test_gcra_es_por_remitente(server, reloj):
+    limitador = server.LimitadorGCRA(por_minuto=6, rafaga=1)
+    assert limitador.permitir('a')
+    assert not limitador.permitir('a')
+    assert limitador.permitir('b')
+
+def test_gcra_purga_remitentes_inactivos(server, reloj):
+    limitador = server.LimitadorGCRA(por_minuto=60, rafaga=1)
+    limitador.permitir('a')
+    reloj.avanzar(server.INTERVALO_LIMPIEZA + 1)
+    limitador.permitir('b')
+    assert set(limitador._tat) == {'b'}
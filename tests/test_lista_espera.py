@@ -0,0 +1,42 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+@pytest.fixture
+def manana(server):
+    hoy = datetime.now(server.TIMEZONE).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+    return lambda hora, minuto=0: server.TIMEZONE.localize(hoy + timedelta(days=1, hours=hora, minutes=minuto))
+
+def test_lista_espera_ofrece_en_orden_de_llegada(server, manana):
+    lista = server.ListaEspera()
+    for clave in ('a', 'b'):
+        lista.agregar(clave, 'n', manana(10), 30, server.Conversacion(), ventana_minutos=60)
+    candidatos = lista.candidatos('n', manana(10, 30), manana(11))
+    assert [(clave, unidad) for clave, _, unidad in candidatos] == [('a', 42), ('b', 42)]
+
+def test_lista_espera_respeta_ventana_y_duracion(server, manana):
+    lista = server.ListaEspera()
+    lista.agregar('a', 'n', manana(10), 30, server.Conversacion(), ventana_minutos=60)
+    assert lista.candidatos('n', manana(12), manana(12, 30)) == []     # fuera de la ventana
+    assert lista.candidatos('n', manana(10), manana(10, 15)) == []     # no cabe la cita
+    assert lista.candidatos('otro', manana(10), manana(11)) == []      # otro negocio
+    lista.quitar('a')
+    assert lista.candidatos('n', manana(10), manana(11)) == []
+
+def test_lista_espera_ofertas_vencidas(server):
+    lista = server.ListaEspera()
+    lista.ofrecida('a', 'negocio', 'inicio', 'fin', vence=100)
+    lista.ofrecida('b', 'negocio', 'inicio', 'fin', vence=200)
+    assert lista.ofertas_vencidas(150) == [('a', ('negocio', 'inicio', 'fin', 100))]
+    assert lista.ofertas_vencidas(150) == []
+    assert lista.terminar_oferta('b') == ('negocio', 'inicio', 'fin', 200)
+    assert lista.terminar_oferta('b') is None
+
+def test_lista_espera_purga_solo_dias_pasados_del_negocio(server, manana):
+    lista = server.ListaEspera()
+    lista.agregar('a', 'n', manana(10), 30, server.Conversacion(), ventana_minutos=60)
+    lista.agregar('b', 'otro', manana(10), 30, server.Conversacion(), ventana_minutos=60)
+    with lista._lock:
+        lista._purgar('n', manana(0).toordinal())
+    assert lista.candidatos('n', manana(10), manana(11)) == []
+    assert [clave for clave, _, _ in lista.candidatos('otro', manana(10), manana(11))] == ['b']
@@ -0,0 +1,54 @@
+import pytest
+
+import mensajeria
+from mensajeria import CubetaTokens, RegistroBajas, direccion_whatsapp, normalizar_numero
+
+@pytest.mark.parametrize('numero', ['whatsapp:+5215512345678', '+52 1 55-1234-5678', '5215512345678', ' +52 (1) 55.1234.5678 '])
+def test_normalizar_numero_a_e164(numero):
+    assert normalizar_numero(numero) == '+5215512345678'
+
+@pytest.mark.parametrize('numero', ['', None, 'hola', '+123', 'whatsapp:', '+1234567890123456'])
+def test_normalizar_numero_invalido(numero):
+    assert normalizar_numero(numero) is None
+
+def test_direccion_whatsapp():
+    assert direccion_whatsapp('+52 1 55 1234 5678') == 'whatsapp:+5215512345678'
+    assert direccion_whatsapp('whatsapp:+5215512345678') == 'whatsapp:+5215512345678'
+
+def test_bajas_comparten_formato_con_las_listas(tmp_path):
+    ruta = tmp_path / 'bajas.txt'
+    ruta.write_text('whatsapp:+5215500000000\n', encoding='utf-8')  # formato anterior
+    bajas = RegistroBajas(str(ruta))
+    assert bajas.contiene('+52 1 55 0000 0000')
+    bajas.agregar('whatsapp:+5215512345678')
+    bajas.agregar('+5215512345678')
+    assert ruta.read_text(encoding='utf-8').splitlines()[1:] == ['+5215512345678']
+    assert RegistroBajas(str(ruta)).contiene('5215512345678')
+
+@pytest.mark.parametrize('tasa', [0, -1])
+def test_cubeta_rechaza_tasa_no_positiva(tasa):
+    with pytest.raises(ValueError):
+        CubetaTokens(tasa)
+
+def test_cubeta_rafaga_y_recarga(monkeypatch):
+    ahora = [100.0]
+    monkeypatch.setattr(mensajeria.time, 'monotonic', lambda: ahora[0])
+    cubeta = CubetaTokens(2, capacidad=3)
+    assert [cubeta.tomar() for _ in range(4)] == [True, True, True, False]
+    ahora[0] += 0.5
+    assert cubeta.tomar()
+    assert not cubeta.tomar()
+
+def test_enviar_mensaje_agrega_el_prefijo_solo_al_enviar():
+    enviados = []
+
+    class Mensajes:
+        def create(self, **datos):
+            enviados.append(datos)
+
+    class Cliente:
+        messages = Mensajes()
+
+    assert mensajeria.enviar_mensaje(Cliente(), '+5215500000000', '+52 1 55 1234 5678', 'hola')
+    assert enviados == [{'body': 'hola', 'from_': 'whatsapp:+5215500000000', 'to': 'whatsapp:+5215512345678'}]
+    assert not mensajeria.enviar_mensaje(Cliente(), '+5215500000000', 'abc', 'hola')
@@ -0,0 +1,61 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+@pytest.fixture
+def registro(server, reloj, tmp_path):
+    for numero, nombre in (('5215500000001', 'Centro'), ('5215500000002', 'Norte'), ('5215500000003', 'Sur')):
+        (tmp_path / f"{numero}.json").write_text(json.dumps({
+            'nombre': nombre,
+            'servicios': {'Corte de Cabello': {'precio': '200 MXN', 'duracion': 30}},
+            'zona_horaria': 'America/Mexico_City',
+        }), encoding='utf-8')
+    (tmp_path / '5215500000009.json').write_text('{"servicios": {}}', encoding='utf-8')
+    return server.RegistroNegocios(str(tmp_path), server.NEGOCIO_DEFAULT, maximo=2, inactividad_segundos=600)
+
+def test_resuelve_por_el_numero_que_recibe(server, registro):
+    negocio = registro.resolver('whatsapp:+5215500000001')
+    assert negocio.nombre == 'Centro'
+    assert negocio.id == '5215500000001'
+    assert 'corte de cabello' in negocio.servicios
+    assert registro.resolver('whatsapp:+52 155 0000 0001') is negocio
+
+def test_sin_configuracion_usa_el_negocio_por_defecto(server, registro):
+    assert registro.resolver('whatsapp:+5215599999999') is server.NEGOCIO_DEFAULT
+    assert registro.resolver('whatsapp:+5215500000009') is server.NEGOCIO_DEFAULT  # archivo inválido
+    assert registro.resolver('') is server.NEGOCIO_DEFAULT
+
+def test_descarga_el_menos_reciente_al_superar_el_maximo(registro):
+    centro = registro.resolver('+5215500000001')
+    registro.resolver('+5215500000002')
+    registro.resolver('+5215500000001')
+    registro.resolver('+5215500000003')
+    assert list(registro._cache) == ['5215500000001', '5215500000003']
+    assert registro.resolver('+5215500000001') is centro
+
+def test_descarga_por_inactividad(registro, reloj):
+    centro = registro.resolver('+5215500000001')
+    reloj.avanzar(601)
+    registro.resolver('+5215500000002')
+    assert list(registro._cache) == ['5215500000002']
+    assert registro.resolver('+5215500000001') is not centro
+
+def test_las_reservas_sobreviven_a_la_descarga(server, registro, reloj):
+    centro = registro.resolver('+5215500000001')
+    inicio = centro.timezone.localize(datetime.fromtimestamp(reloj.ahora) + timedelta(days=1))
+    centro.reservas.apartar('cliente', inicio, inicio + timedelta(minutes=30))
+    registro.resolver('+5215500000002')
+    registro.resolver('+5215500000003')
+    assert '5215500000001' not in registro._cache
+
+    recargado = registro.resolver('+5215500000001')
+    assert recargado is not centro
+    assert recargado.reservas is centro.reservas
+    assert recargado.reservas.vigente('cliente')
+
+def test_reservas_vacias_se_sueltan_al_descargar(registro):
+    registro.resolver('+5215500000001')
+    registro.resolver('+5215500000002')
+    registro.resolver('+5215500000003')
+    assert '5215500000001' not in registro._reservas
@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+@pytest.fixture
+def tabla(server, reloj):
+    return server.TablaReservas(ttl_segundos=300)
+
+@pytest.fixture
+def horario(server, reloj):
+    """Un horario de 30 minutos mañana a las 10:00"""
+    inicio = server.TIMEZONE.localize(
+        datetime.fromtimestamp(reloj.ahora).replace(hour=10, minute=0, second=0, microsecond=0) + timedelta(days=1))
+    return inicio, inicio + timedelta(minutes=30)
+
+def test_apartado_bloquea_a_otros_clientes(tabla, horario):
+    inicio, fin = horario
+    assert tabla.apartar('a', inicio, fin)
+    assert not tabla.apartar('b', inicio + timedelta(minutes=15), fin + timedelta(minutes=15))
+    assert tabla.ocupado(inicio, fin)
+    assert not tabla.ocupado(inicio, fin, excepto='a')
+    assert not tabla.ocupado(fin, fin + timedelta(minutes=30))  # contiguo no se solapa
+
+def test_apartado_expira(tabla, horario, reloj):
+    inicio, fin = horario
+    tabla.apartar('a', inicio, fin)
+    reloj.avanzar(299)
+    assert tabla.vigente('a')
+    reloj.avanzar(1)
+    assert not tabla.vigente('a')
+    assert tabla.apartar('b', inicio, fin)
+
+def test_un_apartado_por_cliente(tabla, horario):
+    inicio, fin = horario
+    tabla.apartar('a', inicio, fin)
+    tabla.apartar('a', fin, fin + timedelta(minutes=30))
+    assert not tabla.ocupado(inicio, fin)
+
+def test_confirmar_convierte_el_apartado_en_cita_hasta_que_termina(tabla, horario, reloj):
+    inicio, fin = horario
+    tabla.apartar('a', inicio, fin)
+    assert tabla.confirmar('a', 'evento1')
+    assert not tabla.vigente('a')
+    reloj.avanzar(3600)  # ya pasó el TTL del apartado
+    assert tabla.ocupado(inicio, fin)
+    tabla.liberar_evento('evento1')
+    assert not tabla.ocupado(inicio, fin)
+
+def test_confirmar_sin_apartado(tabla, horario):
+    inicio, fin = horario
+    tabla.apartar('a', inicio, fin)
+    tabla.liberar('a')
+    assert not tabla.confirmar('a', 'evento1')
+    assert not tabla.ocupado(inicio, fin)
+
+def test_citas_sin_id_de_calendar_no_se_pisan(tabla, horario):
+    inicio, fin = horario
+    otro_inicio, otro_fin = inicio + timedelta(hours=2), fin + timedelta(hours=2)
+    tabla.apartar('a', inicio, fin)
+    tabla.confirmar('a', 'sin-calendario')
+    tabla.apartar('b', otro_inicio, otro_fin)
+    tabla.confirmar('b', 'sin-calendario')
+    assert tabla.ocupado(inicio, fin)
+    assert tabla.ocupado(otro_inicio, otro_fin)
+    tabla.liberar_evento('sin-calendario', 'a')
+    assert not tabla.ocupado(inicio, fin)
+    assert tabla.ocupado(otro_inicio, otro_fin)
+
+def test_intervalos_excluye_el_propio(tabla, horario):
+    inicio, fin = horario
+    tabla.apartar('a', inicio, fin)
+    desde, hasta = inicio - timedelta(hours=1), fin + timedelta(hours=1)
+    assert tabla.intervalos(desde, hasta) == [(int(inicio.timestamp()), int(fin.timestamp()))]
+    assert tabla.intervalos(desde, hasta, excepto='a') == []